@@ -0,0 +1,210 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List
+from .hedging import attempt_abandoned
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+llm_max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+image_max_concurrency = int(os.getenv("IMAGE_MAX_CONCURRENCY", "32"))
+# The window only grows while the average latency (seconds) stays under these targets
+llm_latency_target = float(os.getenv("LLM_LATENCY_TARGET", "30"))
+image_latency_target = float(os.getenv("IMAGE_LATENCY_TARGET", "60"))
+
+#==================================================================================================
+# AIMD Concurrency Control
+#==================================================================================================
+
+
+def is_overload(error: BaseException) -> bool:
+    """
+     Check whether an exception means the upstream is overloaded (HTTP 429 or 503). Works for openai errors,
+     requests.HTTPError and aiohttp.ClientResponseError without importing them.
+
+     @param error - The exception raised by the call
+
+     @return True if the window should be decreased
+    """
+    status = getattr(error, "http_status", None) or getattr(error, "status", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    if status in (429, 503):
+        return True
+    return type(error).__name__ in ("RateLimitError", "ServiceUnavailableError")
+
+
+class AIMDController:
+    """
+     Limits the number of in-flight calls to an upstream with additive-increase / multiplicative-decrease.
+     The window grows by about one slot per window of healthy calls and is halved on 429/503, so the
+     concurrency settles at whatever the provider sustains.
+    """
+
+    def __init__(self,
+                 name: str,
+                 initial: float = 4,
+                 minimum: float = 1,
+                 maximum: float = 32,
+                 decrease: float = 0.5,
+                 latency_target: float = None,
+                 max_error_rate: float = 0.2):
+        self.name = name
+        self.window = float(initial)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.error_rate = 0.0
+        self.overloads = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        # Futures of the coroutines waiting for a slot, with the event loop each one belongs to
+        self._async_waiters: Dict[asyncio.Future, asyncio.AbstractEventLoop] = {}
+
+    def _notify(self) -> None:
+        """Wake every thread and coroutine waiting for a slot, the caller holds the lock."""
+        self._condition.notify_all()
+        for waiter, loop in self._async_waiters.items():
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # The loop was closed, nothing waits on it anymore
+                pass
+        self._async_waiters.clear()
+
+    def acquire(self) -> None:
+        """
+         Block until a slot in the window is free.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.window):
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def async_acquire(self) -> None:
+        """
+         Asynchronous version of acquire. The coroutine waits on a future that release resolves.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self.in_flight < int(self.window):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters[waiter] = loop
+            try:
+                await waiter
+            finally:
+                with self._condition:
+                    self._async_waiters.pop(waiter, None)
+
+    def release(self, latency: float, error: BaseException = None, neutral: bool = False) -> None:
+        """
+         Free a slot and adjust the window from the outcome of the call.
+
+         @param latency - Seconds the call took
+         @param error - The exception raised by the call, if any
+         @param neutral - The outcome says nothing about the upstream, e.g. a hedged request that lost or was
+                          cancelled: only the slot is freed
+        """
+        now = time.monotonic()
+        with self._condition:
+            self.in_flight -= 1
+            if neutral:
+                self._notify()
+                return
+            failed = error is not None
+            self.error_rate = 0.9 * self.error_rate + 0.1 * failed
+            if failed and is_overload(error):
+                self.overloads += 1
+                # Only back off once per round trip, concurrent failures come from the same congestion
+                if now - self._last_decrease > (self.latency_ewma or 1.0):
+                    self.window = max(self.minimum, self.window * self.decrease)
+                    self._last_decrease = now
+            elif not failed:
+                self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+                healthy = ((self.latency_target is None or self.latency_ewma <= self.latency_target)
+                           and self.error_rate <= self.max_error_rate)
+                if healthy:
+                    self.window = min(self.maximum, self.window + 1 / self.window)
+            self._notify()
+
+    @contextmanager
+    def slot(self):
+        """
+         Hold a slot for the duration of a call, e.g. ``with llm_concurrency.slot(): ...``
+        """
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except GeneratorExit as e:
+            # A streamed reply whose reader stopped early, the upstream did nothing wrong
+            self.release(time.monotonic() - start, e, neutral=True)
+            raise
+        except BaseException as e:
+            self.release(time.monotonic() - start, e, neutral=attempt_abandoned())
+            raise
+        self.release(time.monotonic() - start, neutral=attempt_abandoned())
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """
+         Asynchronous version of slot.
+        """
+        await self.async_acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except asyncio.CancelledError as e:
+            # The losing request of a hedged call, or a site that was abandoned
+            self.release(time.monotonic() - start, e, neutral=True)
+            raise
+        except BaseException as e:
+            self.release(time.monotonic() - start, e)
+            raise
+        self.release(time.monotonic() - start)
+
+    def metrics(self) -> Dict:
+        """
+         Current state of the controller.
+
+         @return A dict with the window, the in-flight calls and the latency / error statistics
+        """
+        with self._condition:
+            return {
+                "name": self.name,
+                "window": round(self.window, 2),
+                "in_flight": self.in_flight,
+                "latency_ewma": self.latency_ewma,
+                "error_rate": round(self.error_rate, 3),
+                "overloads": self.overloads,
+            }
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+llm_concurrency = AIMDController("llm", initial=8, maximum=llm_max_concurrency, latency_target=llm_latency_target)
+image_concurrency = AIMDController("image", initial=4, maximum=image_max_concurrency, latency_target=image_latency_target)
+
+
+def concurrency_metrics() -> List[Dict]:
+    """
+     Metrics of every shared controller.
+
+     @return A list with the metrics dict of each controller
+    """
+    return [llm_concurrency.metrics(), image_concurrency.metrics()]
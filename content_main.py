@@ -1,3 +1,4 @@
+import asyncio
 import concurrent.futures
 import csv
 import io
@@ -9,11 +10,22 @@ import random
 import requests
 import sys
 import time
+import weakref
+import aiohttp
 from pathlib import Path
 from datetime import datetime, date, time, timezone
 from dotenv import load_dotenv
-from typing import List, Dict, TypedDict
+from typing import Any, AsyncIterator, Callable, Iterator, List, Dict, Tuple, TypedDict
 from concurrent.futures import ThreadPoolExecutor, wait
+from .hedging import chat_hedger
+from .http_session import close_async_client
+from .llm_cache import ResponseCache, make_key
+from .model_router import model_router
+from .concurrency import llm_concurrency
+from .rate_limiter import chat_rate_limiter, estimate_tokens, estimate_usage, make_requests_session, make_trace_config
+from .retry_policy import RetryPolicy, default_retry_policy, get_breaker
+from .singleflight import SingleFlight
+from .worker_pool import worker_pool
 
 #==================================================================================================
 # Load Parameters
@@ -27,18 +39,28 @@ openai_api_key = os.getenv("OPENAI_API_KEY", "")
 
 # Use the API key
 openai.api_key = openai_api_key
-openai.Model.list()
+# Send every request to the local fake server (fake_server.py) instead, for offline load tests
+fake_api_server = os.getenv("FAKE_API_SERVER", "").rstrip("/")
+if fake_api_server:
+    openai.api_base = f"{fake_api_server}/v1"
+    openai.api_key = openai_api_key or "fake"
+# Report the rate-limit headers of every response to the shared limiters
+openai.requestssession = make_requests_session
 
 # load memory directory
 memory_dir = os.getenv("MEMORY_DIRECTORY", "local")
 workspace_path = "./"
 # The workspace_path is the path to the workspace directory.
 if memory_dir == "production":
-    import boto3
     workspace_path = "/tmp"
 elif memory_dir == "local":
     workspace_path = "./"
 
+# Persistent cache of chat responses, shared by every run using the same workspace
+response_cache = ResponseCache(os.getenv("LLM_CACHE_PATH", os.path.join(workspace_path, "cache", "llm_cache.sqlite3")))
+# Concurrent identical cacheable requests share one upstream call
+chat_flight = SingleFlight()
+
 
 class Message(TypedDict):
     role: str
@@ -51,84 +73,325 @@ class Message(TypedDict):
 
 def retry_with_exponential_backoff(
     func,
-    initial_delay: float = 1,
-    exponential_base: float = 2,
-    jitter: bool = True,
-    max_retries: int = 10,
-    errors: tuple = (openai.error.RateLimitError,
-                     openai.error.Timeout,
-                     openai.error.ServiceUnavailableError,
-                     openai.error.APIError,
-                     openai.error.InvalidRequestError,
-                     openai.error.APIConnectionError),
+    policy: RetryPolicy = default_retry_policy,
+    endpoint: str = "openai",
 ):
-    """Retry a function with exponential backoff."""
+    """Retry a function on transient errors only, failing fast while the endpoint's circuit is open."""
+    breaker = get_breaker(endpoint)
 
     def wrapper(*args, **kwargs):
-        # Initialize variables
-        num_retries = 0
-        delay = initial_delay
+        return policy.call(breaker, func, *args, **kwargs)
 
-        # Loop until a successful response or max_retries is hit or an exception is raised
-        while True:
-            try:
-                return func(*args, **kwargs)
+    return wrapper
 
-            # Retry on specified errors
-            except errors as e:
-                # Increment retries
-                print (e)
-                num_retries += 1
 
-                # Check if max retries has been reached
-                if num_retries > max_retries:
-                    raise Exception(
-                        f"Maximum number of retries ({max_retries}) exceeded."
-                    )
+def async_retry_with_exponential_backoff(
+    func,
+    policy: RetryPolicy = default_retry_policy,
+    endpoint: str = "openai",
+):
+    """Retry a coroutine function on transient errors only, failing fast while the endpoint's circuit is open."""
+    breaker = get_breaker(endpoint)
 
-                # Increment the delay
-                delay *= exponential_base * (1 + jitter * random.random())
+    async def wrapper(*args, **kwargs):
+        return await policy.async_call(breaker, func, *args, **kwargs)
 
-                # Sleep for the delay
-                time.sleep(delay)
+    return wrapper
 
-            # Raise exceptions for any errors not specified
-            except Exception as e:
-                raise e
 
-    return wrapper
+# One aiohttp session per event loop, shared by every coroutine running on it
+_async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
 
 
-@retry_with_exponential_backoff
-def chat_with_gpt3(messages: str | List[Message], temp=1.0, p=1.0, freq=0.0, presence=0.0, model="gpt-3.5-turbo") -> str:
+async def get_async_session() -> aiohttp.ClientSession:
+    """
+     Get the aiohttp session of the running event loop, creating it on first use.
+     
+     @return The shared aiohttp.ClientSession
+    """
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600), trace_configs=[make_trace_config()])
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session() -> None:
+    """
+     Close the aiohttp sessions of the running event loop (OpenAI and image I/O). Call it once before the loop is shut down.
+    """
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+    await close_async_client()
+
+
+def build_messages(messages: str | List[Message]) -> List[Message]:
+    """
+     Build the chat messages for a request. A plain prompt is wrapped with the default system message.
+     
+     @param messages - A prompt string or a list of chat messages
+     
+     @return The list of chat messages to send
+    """
     if isinstance(messages, str):
-        response = openai.ChatCompletion.create(
-            model=f"{model}",
-            messages=[
-                    {"role": "system", "content": "You are an web designer with the objective to identify search engine optimized long-tail keywords and generate contents, with the goal of generating website contents and enhance website's visibility, driving organic traffic, and improving online business performance."},
-                    {"role": "user", "content": messages}
-                ],
-            temperature=temp,
-            # max_tokens=2500,
-            top_p=p,
-            frequency_penalty=freq,
-            presence_penalty=presence,
-        )
-        # print (response)
-        return response.choices[0].message['content']
-    elif isinstance(messages, List):
-        # print("messages: ", messages)
-        response = openai.ChatCompletion.create(
-            model=f"{model}",
-            messages=messages,
-            temperature=temp,
-            # max_tokens=2500,
-            top_p=p,
-            frequency_penalty=freq,
-            presence_penalty=presence,
-        )
-        # print (response)
-        return response.choices[0].message['content']
+        return [
+            {"role": "system", "content": "You are an web designer with the objective to identify search engine optimized long-tail keywords and generate contents, with the goal of generating website contents and enhance website's visibility, driving organic traffic, and improving online business performance."},
+            {"role": "user", "content": messages}
+        ]
+    return messages
+
+
+def chat_request(messages: str | List[Message], temp=1.0, p=1.0, freq=0.0, presence=0.0, model="gpt-3.5-turbo", function: Dict = None, n: int = 1) -> Dict:
+    """
+     Build the parameters of a chat completion request.
+     
+     @param function - Optional function definition (name, description, JSON schema parameters) the model is forced to call
+     @param n - Number of choices to generate for the same messages
+     
+     @return The keyword arguments for openai.ChatCompletion.create
+    """
+    request = {
+        "model": f"{model}",
+        "messages": build_messages(messages),
+        "temperature": temp,
+        # "max_tokens": 2500,
+        "top_p": p,
+        "frequency_penalty": freq,
+        "presence_penalty": presence,
+    }
+    if function is not None:
+        request["functions"] = [function]
+        request["function_call"] = {"name": function["name"]}
+    if n > 1:
+        request["n"] = n
+    return request
+
+
+def reply_content(message: Dict) -> str:
+    """
+     Extract the reply from a chat completion message: the arguments of a function call or the text content.
+     
+     @param message - The message of the first choice
+     
+     @return The reply as a string
+    """
+    if message.get("function_call"):
+        return message["function_call"]["arguments"]
+    return message['content']
+
+
+def replies(request: Dict, response: Dict) -> str | List[str]:
+    """
+     Extract the reply of a chat completion, or the reply of every choice when the request asked for several.
+     
+     @param request - The request sent
+     @param response - The chat completion returned
+     
+     @return The reply as a string, or a list of replies ordered by choice index
+    """
+    if request.get("n", 1) == 1:
+        return reply_content(response.choices[0].message)
+    return [reply_content(choice.message) for choice in sorted(response.choices, key=lambda choice: choice["index"])]
+
+
+@retry_with_exponential_backoff
+def _chat_completion(request: Dict) -> str | List[str]:
+    # Wait for the shared request and token budgets instead of running into RateLimitError
+    tokens = estimate_tokens(request["messages"], request.get("max_tokens"), request.get("n", 1))
+    chat_rate_limiter.acquire(tokens)
+    with llm_concurrency.slot():
+        response = openai.ChatCompletion.create(**request)
+    # print (response)
+    chat_rate_limiter.record_usage(tokens, response['usage']['total_tokens'])
+    return replies(request, response)
+
+
+@async_retry_with_exponential_backoff
+async def _async_chat_completion(request: Dict) -> str | List[str]:
+    # Route the request through the shared session instead of opening one per call
+    tokens = estimate_tokens(request["messages"], request.get("max_tokens"), request.get("n", 1))
+    await chat_rate_limiter.async_acquire(tokens)
+    openai.aiosession.set(await get_async_session())
+    async with llm_concurrency.async_slot():
+        response = await openai.ChatCompletion.acreate(**request)
+    chat_rate_limiter.record_usage(tokens, response['usage']['total_tokens'])
+    return replies(request, response)
+
+
+def _send_chat(request: Dict, stage: str = None, hedge: bool = False) -> str:
+    if hedge:
+        return chat_hedger.call(stage or request["model"], _chat_completion, request)
+    return _chat_completion(request)
+
+
+async def _async_send_chat(request: Dict, stage: str = None, hedge: bool = False) -> str:
+    if hedge:
+        return await chat_hedger.async_call(stage or request["model"], _async_chat_completion, request)
+    return await _async_chat_completion(request)
+
+
+def _fetch_chat(key: str, request: Dict, stage: str = None, hedge: bool = False, validate: Callable[[str], bool] = None) -> str:
+    content = _send_chat(request, stage, hedge)
+    # A reply the caller rejects would be served again from the cache instead of being regenerated
+    if validate is None or validate(content):
+        response_cache.set(key, content)
+    return content
+
+
+async def _async_fetch_chat(key: str, request: Dict, stage: str = None, hedge: bool = False, validate: Callable[[str], bool] = None) -> str:
+    content = await _async_send_chat(request, stage, hedge)
+    if validate is None or validate(content):
+        # SQLite calls block, they run in the io lane instead of on the event loop
+        await worker_pool.run("io", response_cache.set, key, content)
+    return content
+
+
+def chat_with_gpt3(messages: str | List[Message], temp=1.0, p=1.0, freq=0.0, presence=0.0, model: str = None, cache=True, function: Dict = None,
+                   stage: str = None, hedge: bool = False, validate: Callable[[str], bool] = None) -> str:
+    """
+     Send a chat completion request. Identical requests are answered from the response cache, and concurrent
+     identical requests share a single upstream call.
+     
+     @param messages - A prompt string or a list of chat messages
+     @param model - The model to use, by default the one the routing table assigns to the stage
+     @param cache - Set to False for creative stages that must not reuse an earlier (or a concurrent) answer
+     @param function - Optional function definition the model must call, its JSON arguments are returned
+     @param stage - Name of the pipeline stage, it selects the model and keeps the latency history used for hedging
+     @param hedge - Send a second request if this one is slower than usual (only when HEDGING is on)
+     @param validate - Returns True if the reply can be used, only such replies are cached
+     
+     @return The content of the reply
+    """
+    request = chat_request(messages, temp, p, freq, presence, model or model_router.model(stage), function)
+    if not cache:
+        return _send_chat(request, stage, hedge)
+    key = make_key(request)
+    cached = response_cache.get(key)
+    if cached is not None and (validate is None or validate(cached)):
+        return cached
+    return chat_flight.do(key, _fetch_chat, key, request, stage, hedge, validate)
+
+
+async def async_chat_with_gpt3(messages: str | List[Message], temp=1.0, p=1.0, freq=0.0, presence=0.0, model: str = None, cache=True, function: Dict = None,
+                               stage: str = None, hedge: bool = False, validate: Callable[[str], bool] = None) -> str:
+    """
+     Asynchronous version of chat_with_gpt3.
+     
+     @param messages - A prompt string or a list of chat messages
+     @param model - The model to use, by default the one the routing table assigns to the stage
+     @param cache - Set to False for creative stages that must not reuse an earlier (or a concurrent) answer
+     @param function - Optional function definition the model must call, its JSON arguments are returned
+     @param stage - Name of the pipeline stage, it selects the model and keeps the latency history used for hedging
+     @param hedge - Send a second request if this one is slower than usual (only when HEDGING is on)
+     @param validate - Returns True if the reply can be used, only such replies are cached
+     
+     @return The content of the reply
+    """
+    request = chat_request(messages, temp, p, freq, presence, model or model_router.model(stage), function)
+    if not cache:
+        return await _async_send_chat(request, stage, hedge)
+    key = make_key(request)
+    cached = await worker_pool.run("io", response_cache.get, key)
+    if cached is not None and (validate is None or validate(cached)):
+        return cached
+    return await chat_flight.async_do(key, _async_fetch_chat, key, request, stage, hedge, validate)
+
+
+def chat_choices_with_gpt3(messages: str | List[Message], n: int, temp=1.0, p=1.0, freq=0.0, presence=0.0, model: str = None, stage: str = None) -> List[str]:
+    """
+     Generate n independent replies to the same messages in a single request, the prompt is sent and charged once.
+     The replies are not cached, like chat_with_gpt3 with cache=False.
+     
+     @param messages - A prompt string or a list of chat messages
+     @param n - Number of replies
+     @param model - The model to use, by default the one the routing table assigns to the stage
+     @param stage - Name of the pipeline stage
+     
+     @return The n replies
+    """
+    request = chat_request(messages, temp, p, freq, presence, model or model_router.model(stage), n=n)
+    content = _chat_completion(request)
+    return content if isinstance(content, list) else [content]
+
+
+async def async_chat_choices_with_gpt3(messages: str | List[Message], n: int, temp=1.0, p=1.0, freq=0.0, presence=0.0, model: str = None, stage: str = None) -> List[str]:
+    """
+     Asynchronous version of chat_choices_with_gpt3.
+     
+     @param messages - A prompt string or a list of chat messages
+     @param n - Number of replies
+     
+     @return The n replies
+    """
+    request = chat_request(messages, temp, p, freq, presence, model or model_router.model(stage), n=n)
+    content = await _async_chat_completion(request)
+    return content if isinstance(content, list) else [content]
+
+
+@retry_with_exponential_backoff
+def _open_chat_stream(request: Dict):
+    return openai.ChatCompletion.create(stream=True, **request)
+
+
+def stream_chat_with_gpt3(messages: str | List[Message], temp=1.0, p=1.0, freq=0.0, presence=0.0, model: str = None, stage: str = None) -> Iterator[str]:
+    """
+     Send a chat completion request and yield the reply as it is generated. Streamed replies are not cached.
+     Opening the stream is retried like chat_with_gpt3, an error in the middle of the stream is raised.
+     
+     @param messages - A prompt string or a list of chat messages
+     @param model - The model to use, by default the one the routing table assigns to the stage
+     @param stage - Name of the pipeline stage
+     
+     @return An iterator over the text fragments of the reply
+    """
+    request = chat_request(messages, temp, p, freq, presence, model or model_router.model(stage))
+    tokens = estimate_tokens(request["messages"], request.get("max_tokens"))
+    chat_rate_limiter.acquire(tokens)
+    reply = []
+    try:
+        with llm_concurrency.slot():
+            for chunk in _open_chat_stream(request):
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    reply.append(delta)
+                    yield delta
+    finally:
+        # Streamed replies report no usage, correct the budget from what was received
+        chat_rate_limiter.record_usage(tokens, estimate_usage(request["messages"], "".join(reply)))
+
+
+@async_retry_with_exponential_backoff
+async def _async_open_chat_stream(request: Dict):
+    openai.aiosession.set(await get_async_session())
+    return await openai.ChatCompletion.acreate(stream=True, **request)
+
+
+async def async_stream_chat_with_gpt3(messages: str | List[Message], temp=1.0, p=1.0, freq=0.0, presence=0.0, model: str = None,
+                                      stage: str = None) -> AsyncIterator[str]:
+    """
+     Asynchronous version of stream_chat_with_gpt3.
+     
+     @param messages - A prompt string or a list of chat messages
+     @param model - The model to use, by default the one the routing table assigns to the stage
+     @param stage - Name of the pipeline stage
+     
+     @return An async iterator over the text fragments of the reply
+    """
+    request = chat_request(messages, temp, p, freq, presence, model or model_router.model(stage))
+    tokens = estimate_tokens(request["messages"], request.get("max_tokens"))
+    await chat_rate_limiter.async_acquire(tokens)
+    reply = []
+    try:
+        async with llm_concurrency.async_slot():
+            async for chunk in await _async_open_chat_stream(request):
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    reply.append(delta)
+                    yield delta
+    finally:
+        chat_rate_limiter.record_usage(tokens, estimate_usage(request["messages"], "".join(reply)))
     
     
 # ##==================================================================================================
@@ -167,6 +430,114 @@ def processjson(jsonf: str) -> Dict:
             print(e)
             return {}
 
+
+def loads_lenient(text: str) -> Any:
+    """
+     Parse a JSON value, retrying once without the trailing commas the model sometimes leaves in lists and objects.
+     
+     @param text - the JSON text to parse
+     
+     @return the parsed value or None if it is not valid JSON
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        try:
+            return json.loads(re.sub(r",\s*([}\]])", r"\1", text))
+        except ValueError:
+            return None
+
+
+class SectionStreamParser:
+    """
+     Incremental parser for a streamed JSON object. Text is fed as it arrives and every top-level
+     member (e.g. "banner", "faq") is returned as soon as its value is complete.
+     Text before the first "{" is ignored, like processjson does.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._state = "key"
+        self._key = None
+        self._token_start = 0
+        self._value_start = 0
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """
+         Consume the next piece of text.
+         
+         @param chunk - the text received since the last call
+         
+         @return the (section, value) pairs completed by this chunk
+        """
+        self.text += chunk
+        sections = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            if self.done:
+                break
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._state == "key":
+                        self._key = loads_lenient(text[self._token_start:i + 1])
+                        self._state = "colon"
+                    elif self._depth == 1 and self._state == "string":
+                        self._emit(sections, i + 1)
+                continue
+            if self._depth == 0:
+                if c == "{":
+                    self._depth = 1
+                continue
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._state == "key":
+                    self._token_start = i
+                elif self._depth == 1 and self._state == "value":
+                    self._value_start = i
+                    self._state = "string"
+            elif c == ":" and self._depth == 1 and self._state == "colon":
+                self._state = "value"
+            elif c in "{[":
+                if self._depth == 1 and self._state == "value":
+                    self._value_start = i
+                    self._state = "nested"
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._state == "nested":
+                    self._emit(sections, i + 1)
+                elif self._depth == 0:
+                    if self._state == "scalar":
+                        self._emit(sections, i)
+                    self.done = True
+            elif c == "," and self._depth == 1:
+                if self._state == "scalar":
+                    self._emit(sections, i)
+                self._state = "key"
+            elif self._depth == 1 and self._state == "value" and not c.isspace():
+                self._value_start = i
+                self._state = "scalar"
+        self._pos = len(text)
+        return sections
+
+    def _emit(self, sections: List[Tuple[str, Any]], end: int) -> None:
+        value = loads_lenient(self.text[self._value_start:end].strip())
+        if self._key is not None and value is not None:
+            sections.append((self._key, value))
+        self._key = None
+        self._state = "after"
+
 # ##===================================================================================================
 # Content Generation Methods
 # ##===================================================================================================
@@ -181,7 +552,7 @@ def get_industry(topic: str) -> str:
      @return identified industry for keyword
     """
     prompt = f"Generate an industry for these keywords, no explanation is needed: {topic}"
-    industry = chat_with_gpt3(prompt, temp=0.2, p=0.1)
+    industry = chat_with_gpt3(prompt, temp=0.2, p=0.1, stage="Industry Identification", hedge=True)
     print("Industry Found")
     return industry
 
@@ -196,7 +567,7 @@ def get_audience(topic: str) -> List[str]:
     """
     audienceList = []
     prompt = f"Generate a list of target audience for these keywords, no explanation is needed: {topic}"
-    audience = chat_with_gpt3("Target Search", prompt, temp=0.2, p=0.1)
+    audience = chat_with_gpt3(prompt, temp=0.2, p=0.1, stage="Target Search")
     audiences = audience.split('\n')  # split the keywords into a list assuming they are comma-separated
     audiences = [target.replace('"', '') for target in audiences]
     audiences = [re.sub(r'^\d+\.\s*', '', target) for target in audiences]
@@ -213,7 +584,7 @@ def get_location(topic: str) -> str:
     """
     print("Identifying Location..")
     prompt = f"Generate an address (Building number, Street name, Postal Code, City/Town name, State, Country) in one line for this keywords, no explanation is needed: {topic}"
-    location = chat_with_gpt3(prompt, temp=0.2, p=0.1)
+    location = chat_with_gpt3(prompt, temp=0.2, p=0.1, stage="Location Identification", hedge=True)
     print("Location Found")
     return location
 
@@ -228,7 +599,11 @@ def generate_long_tail_keywords(topic: str) -> List[str]:
     """
     keyword_clusters = []
     prompt = f"Generate 5 SEO-optimized long-tail keywords related to the topic: {topic}."
-    keywords_str = chat_with_gpt3(prompt, temp=0.2, p=0.1)
+    valid = lambda reply: len([keyword for keyword in reply.split('\n') if keyword.strip()]) >= 5
+    keywords_str = model_router.call(
+        "Keyword Clusters Search",
+        lambda model: chat_with_gpt3(prompt, temp=0.2, p=0.1, model=model, stage="Keyword Clusters Search", validate=valid),
+        valid)
     keywords = keywords_str.split('\n')  # split the keywords into a list assuming they are comma-separated
     keywords = [keyword.replace('"', '') for keyword in keywords]
     keywords = [re.sub(r'^\d+\.\s*', '', keyword) for keyword in keywords]
@@ -248,12 +623,135 @@ def generate_title(company_name: str,
     @return The title as a string
     """
     prompt = f"Suggest 1 SEO optimized headline about '{keyword}' for the company {company_name}"
-    title = chat_with_gpt3(prompt, temp=0.7, p=0.8)
+    title = chat_with_gpt3(prompt, temp=0.7, p=0.8, cache=False, stage="Title Generation", hedge=True)
     title = title.replace('"', '')
     print("Titles Generated")
     return title
 
 
+SITE_BRIEF_FUNCTION = {
+    "name": "site_brief",
+    "description": "Record the brief used to generate the website of a company",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "industry": {
+                "type": "string",
+                "description": "The industry of the keywords, no explanation"
+            },
+            "address": {
+                "type": "string",
+                "description": "An address (Building number, Street name, Postal Code, City/Town name, State, Country) in one line"
+            },
+            "long_tail_keywords": {
+                "type": "array",
+                "items": {"type": "string"},
+                "minItems": 5,
+                "maxItems": 5,
+                "description": "5 SEO-optimized long-tail keywords related to the keywords"
+            },
+            "selected_keyword": {
+                "type": "string",
+                "description": "One of the long-tail keywords"
+            },
+            "title": {
+                "type": "string",
+                "description": "1 SEO optimized headline about the selected keyword for the company"
+            }
+        },
+        "required": ["industry", "address", "long_tail_keywords", "selected_keyword", "title"]
+    }
+}
+
+
+def site_brief_complete(reply: str) -> bool:
+    """
+    Check that a site brief reply has every field, with 5 long tail keywords.
+    
+    @param reply - The JSON arguments returned for SITE_BRIEF_FUNCTION
+    
+    @return True if no field has to be generated separately
+    """
+    brief = loads_lenient(reply)
+    if not isinstance(brief, dict):
+        return False
+    keywords = brief.get("long_tail_keywords")
+    return (all(isinstance(brief.get(field), str) and brief[field].strip() for field in ("industry", "address", "selected_keyword", "title"))
+            and isinstance(keywords, list) and len([k for k in keywords if isinstance(k, str) and k.strip()]) >= 5)
+
+
+def generate_site_brief(company_name: str,
+                        topic: str) -> Dict:
+    """
+    Generate the industry, the address, the long tail keywords and the title in a single request.
+    Any field missing from the reply is generated with its own function (get_industry, get_location,
+    generate_long_tail_keywords, generate_title) instead.
+    
+    @param company_name - The name of the company
+    @param topic - keyword from user input
+    
+    @return dict with industry, location, long_tail_keywords, selected_keyword and title
+    """
+    print("Generating Site Brief..")
+    prompt = f"""
+    Create the brief of a SEO optimized website for the company {company_name} about these keywords: {topic}
+    Identify the industry, generate an address, generate 5 SEO-optimized long-tail keywords related to the keywords,
+    select one of them and suggest 1 SEO optimized headline about it for the company.
+    """
+    try:
+        brief = loads_lenient(model_router.call(
+            "Site Brief",
+            lambda model: chat_with_gpt3(prompt, temp=0.2, p=0.1, model=model, function=SITE_BRIEF_FUNCTION, stage="Site Brief", hedge=True,
+                                         validate=site_brief_complete),
+            site_brief_complete))
+    except Exception as e:
+        print(f"Site brief failed: {e}")
+        brief = None
+    if not isinstance(brief, dict):
+        brief = {}
+
+    industry = brief.get("industry")
+    if not isinstance(industry, str) or not industry.strip():
+        industry = get_industry(topic)
+    location = brief.get("address")
+    if not isinstance(location, str) or not location.strip():
+        location = get_location(topic)
+    keywords = brief.get("long_tail_keywords")
+    if not isinstance(keywords, list) or len([k for k in keywords if isinstance(k, str) and k.strip()]) < 5:
+        keywords = generate_long_tail_keywords(topic)
+    keywords = [re.sub(r'^\d+\.\s*', '', str(keyword).replace('"', '')) for keyword in keywords]
+    selected_keyword = brief.get("selected_keyword")
+    title = brief.get("title")
+    if not isinstance(selected_keyword, str) or not isinstance(title, str) or not title.strip():
+        selected_keyword = random.choice(keywords[:5])
+        title = generate_title(company_name, selected_keyword)
+    print("Site Brief Generated")
+    return {
+        "industry": industry,
+        "location": location,
+        "long_tail_keywords": keywords,
+        "selected_keyword": selected_keyword,
+        "title": title.replace('"', ''),
+    }
+
+
+def meta_description_prompt(topic: str,
+                            keywords: str) -> str:
+    """
+    Build the prompt used to generate a meta description.
+    
+    @param topic - Topic for which we want to generate a meta description
+    @param keywords - Keywords that will be used in the meta description
+    
+    @return The prompt as a string
+    """
+    prompt = f"""
+    Generate a meta description for a website based on this topic: '{topic}'.
+    Use these keywords in the meta description: {keywords}
+    """
+    return prompt
+
+
 def generate_meta_description(company_name: str,
                               topic: str,
                               keywords: str) -> str:
@@ -267,11 +765,26 @@ def generate_meta_description(company_name: str,
     @return Meta description as a string
     """
     print("Generating meta description...")
-    prompt = f"""
-    Generate a meta description for a website based on this topic: '{topic}'.
-    Use these keywords in the meta description: {keywords}
+    prompt = meta_description_prompt(topic, keywords)
+    meta_description = chat_with_gpt3(prompt, temp=0.7, p=0.8, cache=False, stage="Meta Description Generation")
+    return meta_description
+
+
+async def async_generate_meta_description(company_name: str,
+                                          topic: str,
+                                          keywords: str) -> str:
     """
-    meta_description = chat_with_gpt3(prompt, temp=0.7, p=0.8)
+    Asynchronous version of generate_meta_description.
+    
+    @param company_name - Company name to be used in the message
+    @param topic - Topic for which we want to generate a meta description
+    @param keywords - Keywords that will be used in the meta description
+    
+    @return Meta description as a string
+    """
+    print("Generating meta description...")
+    prompt = meta_description_prompt(topic, keywords)
+    meta_description = await async_chat_with_gpt3(prompt, temp=0.7, p=0.8, cache=False, stage="Meta Description Generation")
     return meta_description
 
 
@@ -311,14 +824,13 @@ def generate_footer(company_name: str,
     return footer_json
 
 
-def generate_content(company_name: str,
-                     topic: str,
-                     industry: str,
-                     keyword: str,
-                     title: str,
-                     location: str) -> str:
+def content_prompt(company_name: str,
+                   topic: str,
+                   industry: str,
+                   keyword: str,
+                   title: str) -> str:
     """
-    Generates content for the template. This is a function that takes care of the creation of the content
+    Build the prompt used to generate the content of the template.
     
     @param company_name - The name of the company
     @param topic - The keyword of the users
@@ -326,12 +838,8 @@ def generate_content(company_name: str,
     @param keyword - The keyword found
     @param title - The title of the content
     
-    @return The JSON string of the content
+    @return The prompt as a string
     """
-
-    print("Generating Content...")
-    directory_path = os.path.join(workspace_path, "content")
-    os.makedirs(directory_path, exist_ok=True)
     json1 = """
     {
         "banner": {
@@ -418,16 +926,182 @@ def generate_content(company_name: str,
     2) The content should be engaging and unique.
     3) The FAQ section should follow the SERP and rich result guidelines
     """
-    content = chat_with_gpt3(prompt, temp=0.7, p=0.8, model="gpt-3.5-turbo-16k")
+    return prompt
+
+
+def content_complete(reply: str) -> bool:
+    """
+    Check that a content reply can be parsed into its sections.
+    
+    @param reply - The raw JSON string returned for the content prompt
+    
+    @return True if the reply can be used
+    """
+    return bool(processjson(reply))
+
+
+def generate_content(company_name: str,
+                     topic: str,
+                     industry: str,
+                     keyword: str,
+                     title: str,
+                     location: str) -> str:
+    """
+    Generates content for the template. This is a function that takes care of the creation of the content
+    
+    @param company_name - The name of the company
+    @param topic - The keyword of the users
+    @param industry - The industry of the topic
+    @param keyword - The keyword found
+    @param title - The title of the content
+    
+    @return The JSON string of the content
+    """
+
+    print("Generating Content...")
+    directory_path = os.path.join(workspace_path, "content")
+    os.makedirs(directory_path, exist_ok=True)
+    prompt = content_prompt(company_name, topic, industry, keyword, title)
+    content = model_router.call(
+        "Content Generation",
+        lambda model: chat_with_gpt3(prompt, temp=0.7, p=0.8, model=model, cache=False, stage="Content Generation"),
+        content_complete)
+    return content
+
+
+async def async_generate_content(company_name: str,
+                                 topic: str,
+                                 industry: str,
+                                 keyword: str,
+                                 title: str,
+                                 location: str) -> str:
+    """
+    Asynchronous version of generate_content.
+    
+    @param company_name - The name of the company
+    @param topic - The keyword of the users
+    @param industry - The industry of the topic
+    @param keyword - The keyword found
+    @param title - The title of the content
+    
+    @return The JSON string of the content
+    """
+    print("Generating Content...")
+    prompt = content_prompt(company_name, topic, industry, keyword, title)
+    content = await model_router.async_call(
+        "Content Generation",
+        lambda model: async_chat_with_gpt3(prompt, temp=0.7, p=0.8, model=model, cache=False, stage="Content Generation"),
+        content_complete)
     return content
 
 
+def generate_content_sections(company_name: str,
+                              topic: str,
+                              industry: str,
+                              keyword: str,
+                              title: str,
+                              location: str) -> Iterator[Tuple[str, Any]]:
+    """
+    Streaming version of generate_content. Every top-level section of the content (banner, about, blogs, faq, blog2)
+    is yielded as soon as the model has finished writing it, before the rest of the completion has arrived.
+    
+    @param company_name - The name of the company
+    @param topic - The keyword of the users
+    @param industry - The industry of the topic
+    @param keyword - The keyword found
+    @param title - The title of the content
+    
+    @return An iterator of (section, value) pairs
+    """
+    print("Generating Content...")
+    prompt = content_prompt(company_name, topic, industry, keyword, title)
+    parser = SectionStreamParser()
+    emitted = set()
+    for delta in stream_chat_with_gpt3(prompt, temp=0.7, p=0.8, stage="Content Generation"):
+        for section, value in parser.feed(delta):
+            emitted.add(section)
+            yield section, value
+    # If the incremental parser lost track of the object, recover what it missed from the whole reply
+    if not parser.done:
+        recovered = processjson(parser.text)
+        escalate = model_router.route("Content Generation").get("escalate")
+        if not recovered and escalate:
+            # Truncated or invalid reply, complete the missing sections with the stronger model
+            print(f"Content Generation reply failed validation, retrying on {escalate}")
+            recovered = processjson(chat_with_gpt3(prompt, temp=0.7, p=0.8, model=escalate, cache=False,
+                                                   stage="Content Generation"))
+        for section, value in recovered.items():
+            if section not in emitted:
+                yield section, value
+
+
+async def async_generate_content_sections(company_name: str,
+                                          topic: str,
+                                          industry: str,
+                                          keyword: str,
+                                          title: str,
+                                          location: str) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Asynchronous version of generate_content_sections.
+    
+    @param company_name - The name of the company
+    @param topic - The keyword of the users
+    @param industry - The industry of the topic
+    @param keyword - The keyword found
+    @param title - The title of the content
+    
+    @return An async iterator of (section, value) pairs
+    """
+    print("Generating Content...")
+    prompt = content_prompt(company_name, topic, industry, keyword, title)
+    parser = SectionStreamParser()
+    emitted = set()
+    async for delta in async_stream_chat_with_gpt3(prompt, temp=0.7, p=0.8, stage="Content Generation"):
+        for section, value in parser.feed(delta):
+            emitted.add(section)
+            yield section, value
+    if not parser.done:
+        recovered = processjson(parser.text)
+        escalate = model_router.route("Content Generation").get("escalate")
+        if not recovered and escalate:
+            print(f"Content Generation reply failed validation, retrying on {escalate}")
+            recovered = processjson(await async_chat_with_gpt3(prompt, temp=0.7, p=0.8, model=escalate, cache=False,
+                                                               stage="Content Generation"))
+        for section, value in recovered.items():
+            if section not in emitted:
+                yield section, value
+
+
+def assemble_content(title: str,
+                     description: str,
+                     content: str | Dict,
+                     footer: dict) -> dict:
+    """
+    Merge the generated pieces into the content dict used by the template.
+    
+    @param title - The generated title
+    @param description - The generated meta description
+    @param content - The raw JSON string returned by generate_content or the already parsed sections
+    @param footer - The footer returned by generate_footer
+    
+    @return dict with meta information about the content
+    """
+    contentjson = processjson(content) if isinstance(content, str) else content
+    updated_json = {"meta": {"title": title, "description": description}}
+    updated_json.update(contentjson)
+    updated_json.update(footer)
+    print("Content Generated")
+    # print(json.dumps(updated_json, indent=4))
+    return updated_json
+
+
 def content_generation(company_name: str,
                        topic: str,
                        industry: str,
                        keyword: str,
                        title: str,
-                       location: str) -> dict:
+                       location: str,
+                       on_section: Callable[[str, Any], None] = None) -> dict:
     """
     Generates and returns content. This is the main function of the content generation process
     
@@ -437,20 +1111,52 @@ def content_generation(company_name: str,
     @param keyword - The keyword of the industry to generate
     @param title - The title of the industry to generate
     @param location - The location of the industry to generate
+    @param on_section - Optional callback; when given the content is streamed and on_section(section, value)
+                        is called for every section as soon as it is complete
     
     @return dict with meta information about the content
     """
     print("Starting Content Process")
     try:
         description = generate_meta_description(company_name, topic, keyword)
-        content = generate_content(company_name, topic, industry, keyword, title, location)
+        if on_section is None:
+            content = generate_content(company_name, topic, industry, keyword, title, location)
+        else:
+            content = {}
+            for section, value in generate_content_sections(company_name, topic, industry, keyword, title, location):
+                content[section] = value
+                on_section(section, value)
         footer = generate_footer(company_name, topic, industry, keyword, title, location)
     except Exception as e:
         return {'error': str(e)}
-    contentjson = processjson(content)
-    updated_json = {"meta": {"title": title, "description": description}}
-    updated_json.update(contentjson)
-    updated_json.update(footer)
-    print("Content Generated")
-    # print(json.dumps(updated_json, indent=4))
-    return updated_json
+    return assemble_content(title, description, content, footer)
+
+
+async def async_content_generation(company_name: str,
+                                   topic: str,
+                                   industry: str,
+                                   keyword: str,
+                                   title: str,
+                                   location: str) -> dict:
+    """
+    Asynchronous version of content_generation. The meta description and the content are requested concurrently.
+    
+    @param company_name - The name of the company
+    @param topic - The topic of the industry to generate
+    @param industry - The industry of the industry to generate
+    @param keyword - The keyword of the industry to generate
+    @param title - The title of the industry to generate
+    @param location - The location of the industry to generate
+    
+    @return dict with meta information about the content
+    """
+    print("Starting Content Process")
+    try:
+        description, content = await asyncio.gather(
+            async_generate_meta_description(company_name, topic, keyword),
+            async_generate_content(company_name, topic, industry, keyword, title, location),
+        )
+        footer = generate_footer(company_name, topic, industry, keyword, title, location)
+    except Exception as e:
+        return {'error': str(e)}
+    return assemble_content(title, description, content, footer)
@@ -13,9 +13,11 @@ import base64
 from PIL import Image
 from pathlib import Path
 from dotenv import load_dotenv
-from typing import List, Dict, TypedDict
+from typing import Callable, List, Dict, TypedDict
 from concurrent.futures import ThreadPoolExecutor, wait
-from diffusers import StableDiffusionPipeline, EulerDiscreteScheduler
+from http_session import http_get, http_post
+from llm_cache import ResponseCache, make_key
+from model_router import model_router
 
 # Load .env file
 load_dotenv()
@@ -25,9 +27,15 @@ openai_api_key = os.getenv("OPENAI_API_KEY", "")
 API_URL = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-2-1-base"
 headers = {"Authorization": f"Bearer {os.getenv('STABILITY_KEY')}"}
 
+# Send every request to the local fake server (fake_server.py) instead, for offline load tests
+fake_api_server = os.getenv("FAKE_API_SERVER", "").rstrip("/")
+if fake_api_server:
+    openai.api_base = f"{fake_api_server}/v1"
+    openai_api_key = openai_api_key or "fake"
+    API_URL = f"{fake_api_server}/models/stabilityai/stable-diffusion-2-1-base"
+
 # Use the API key
 openai.api_key = openai_api_key
-openai.Model.list()
 
 # load memory directory
 memory_dir = "local"
@@ -37,6 +45,9 @@ if memory_dir == "production":
 elif memory_dir == "local":
     workspace_path = "./"
 
+# Persistent cache of chat responses
+response_cache = ResponseCache(os.getenv("LLM_CACHE_PATH", os.path.join(workspace_path, "cache", "llm_cache.sqlite3")))
+
 
 class Message(TypedDict):
     role: str
@@ -49,7 +60,7 @@ class Message(TypedDict):
 
 def query(query_parameters: Dict[str, str]) -> bytes:
     try:
-        response = requests.post(API_URL, headers=headers, json=query_parameters, timeout=10)
+        response = http_post(API_URL, headers=headers, json=query_parameters, timeout=10)
         response.raise_for_status()
         return response.content
     except requests.exceptions.RequestException as e:
@@ -204,11 +215,23 @@ def chat_with_gpt3(stage: str,
                    p: float = 0.5,
                    freq: float = 0,
                    presence: float = 0,
-                   model: str = "gpt-3.5-turbo") -> str:
+                   model: str = None,
+                   cache: bool = True,
+                   validate: Callable[[str], bool] = None) -> str:
     max_retries = 5
+    model = model or model_router.model(stage)
+    key = make_key({"model": model, "messages": prompt, "temperature": temp, "top_p": p,
+                    "frequency_penalty": freq, "presence_penalty": presence})
+    if cache:
+        cached = response_cache.get(key)
+        if cached is not None and (validate is None or validate(cached)):   # Answered from the cache, no tokens used
+            write_to_csv((stage, 0, 0, 0, None, None))
+            return cached
     response, prompt_tokens, completion_tokens, total_tokens = generate_content_response(prompt, temp, p, freq, presence, max_retries, model)
     if response is not None:   # If a response was successfully received
         write_to_csv((stage, prompt_tokens, completion_tokens, total_tokens, None, None))
+        if cache and (validate is None or validate(response)):   # Rejected replies are regenerated, not cached
+            response_cache.set(key, response)
         return response
     else:
         return None
@@ -293,7 +316,7 @@ def sanitize_filename(filename: str) -> str:
 
 def url_to_base64(url: str) -> str:
     try:
-        response = requests.get(url)
+        response = http_get(url)
         if response.status_code == 200:
             # Get the content of the response
             image_data = response.content
@@ -339,7 +362,11 @@ def get_audience(topic: str) -> List[str]:
 def generate_long_tail_keywords(topic: str) -> List[str]:
     keyword_clusters = []
     prompt = f"Generate 5 SEO-optimized long-tail keywords related to the topic: {topic}."
-    keywords_str = chat_with_gpt3("Keyword Clusters Search", prompt, temp=0.2, p=0.1)
+    valid = lambda reply: reply is not None and len([keyword for keyword in reply.split('\n') if keyword.strip()]) >= 5
+    keywords_str = model_router.call(
+        "Keyword Clusters Search",
+        lambda model: chat_with_gpt3("Keyword Clusters Search", prompt, temp=0.2, p=0.1, model=model, validate=valid),
+        valid)
     keywords = keywords_str.split('\n')  # split the keywords into a list assuming they are comma-separated
     keywords = [keyword.replace('"', '') for keyword in keywords]
     keywords = [re.sub(r'^\d+\.\s*', '', keyword) for keyword in keywords]
@@ -351,7 +378,7 @@ def generate_long_tail_keywords(topic: str) -> List[str]:
 def generate_title(company_name: str,
                    keyword: str) -> str:
     prompt = f"Suggest 1 SEO optimized headline about '{keyword}' for the company {company_name}"
-    title = chat_with_gpt3("Title Generation", prompt, temp=0.7, p=0.8)
+    title = chat_with_gpt3("Title Generation", prompt, temp=0.7, p=0.8, cache=False)
     title = title.replace('"', '')
     print("Titles Generated")
     return title
@@ -365,7 +392,7 @@ def generate_meta_description(company_name: str,
     Generate a meta description for a website based on this topic: '{topic}'.
     Use these keywords in the meta description: {keywords}
     """
-    meta_description = chat_with_gpt3("Meta Description Generation", prompt, temp=0.7, p=0.8)
+    meta_description = chat_with_gpt3("Meta Description Generation", prompt, temp=0.7, p=0.8, cache=False)
     return meta_description
 
 
@@ -449,7 +476,11 @@ def generate_content(company_name: str,
     2) The content should be engaging and unique.
     3) The FAQ section should follow the SERP and rich result guidelines
     """
-    content = chat_with_gpt3("Content Generation", prompt, temp=0.7, p=0.8, model="gpt-3.5-turbo-16k")
+    valid = lambda reply: reply is not None and bool(processjson(reply))
+    content = model_router.call(
+        "Content Generation",
+        lambda model: chat_with_gpt3("Content Generation", prompt, temp=0.7, p=0.8, model=model, cache=False),
+        valid)
     return content
 
 
@@ -551,7 +582,7 @@ def get_image_context(company_name: str,
          "content": f"Generate 1 detailed description of an image about {keyword}. The image should also be about {topic} "}
     ]
 
-    image_context = chat_with_gpt3("Image Description Generation", prompt_messages, temp=0.7, p=0.8)
+    image_context = chat_with_gpt3("Image Description Generation", prompt_messages, temp=0.7, p=0.8, cache=False)
     image_context += " No fonts included."
     imageurl = chat_with_dall_e(image_context, section)
     # print(imageurl)
@@ -0,0 +1,356 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import numpy as np
+from aiohttp import web
+from PIL import Image
+from typing import Callable, Dict, List
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Latency distributions, e.g. "fixed:0.5", "uniform:0.2,1.5", "lognormal:0.8,0.5" (median, sigma) or "exponential:0.5" (mean)
+fake_chat_latency = os.getenv("FAKE_CHAT_LATENCY", "lognormal:0.8,0.4")
+fake_image_latency = os.getenv("FAKE_IMAGE_LATENCY", "lognormal:3,0.3")
+# Share of requests answered with 429, 503 or left hanging until fake_timeout_seconds
+fake_rate_limit_rate = float(os.getenv("FAKE_RATE_LIMIT_RATE", "0"))
+fake_unavailable_rate = float(os.getenv("FAKE_UNAVAILABLE_RATE", "0"))
+fake_timeout_rate = float(os.getenv("FAKE_TIMEOUT_RATE", "0"))
+fake_timeout_seconds = float(os.getenv("FAKE_TIMEOUT_SECONDS", "130"))
+
+#==================================================================================================
+# Latency and Fault Injection
+#==================================================================================================
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+     Parse a latency distribution.
+
+     @param spec - "fixed:s", "uniform:low,high", "lognormal:median,sigma" or "exponential:mean", in seconds
+
+     @return A function returning one latency sample in seconds
+    """
+    kind, _, values = (spec or "fixed:0").partition(":")
+    args = [float(value) for value in values.split(",") if value]
+    if kind == "fixed":
+        return lambda: args[0]
+    if kind == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(np.log(args[0]), args[1])
+    if kind == "exponential":
+        return lambda: random.expovariate(1 / args[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FaultConfig:
+    """Latency and error rates of the fake server."""
+
+    def __init__(self,
+                 chat_latency: str = fake_chat_latency,
+                 image_latency: str = fake_image_latency,
+                 rate_limit_rate: float = fake_rate_limit_rate,
+                 unavailable_rate: float = fake_unavailable_rate,
+                 timeout_rate: float = fake_timeout_rate,
+                 timeout_seconds: float = fake_timeout_seconds):
+        self.chat_latency = parse_latency(chat_latency)
+        self.image_latency = parse_latency(image_latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.unavailable_rate = unavailable_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+
+
+def openai_error(status: int, message: str, error_type: str) -> web.Response:
+    headers = {"retry-after": "1"} if status == 429 else {}
+    return web.json_response({"error": {"message": message, "type": error_type, "param": None, "code": None}},
+                             status=status, headers=headers)
+
+
+async def inject_fault(config: FaultConfig, hf: bool = False) -> web.Response | None:
+    """
+     Draw the injected error of a request, if any.
+
+     @param config - The fault configuration
+     @param hf - Answer in the HuggingFace format instead of the OpenAI one
+
+     @return The error response or None if the request should succeed
+    """
+    roll = random.random()
+    if roll < config.timeout_rate:
+        await asyncio.sleep(config.timeout_seconds)
+        return web.Response(status=504, text="Gateway Timeout")
+    roll -= config.timeout_rate
+    if roll < config.rate_limit_rate:
+        if hf:
+            return web.json_response({"error": "Rate limit reached"}, status=429, headers={"retry-after": "1"})
+        return openai_error(429, "Rate limit reached for requests", "requests")
+    roll -= config.rate_limit_rate
+    if roll < config.unavailable_rate:
+        if hf:
+            return web.json_response({"error": "Model is currently loading", "estimated_time": 2.0}, status=503)
+        return openai_error(503, "The server is overloaded or not ready yet.", "server_error")
+    return None
+
+#==================================================================================================
+# Fake Payloads
+#==================================================================================================
+
+# Answer to the site content prompt, the same shape as the "Format" of content_prompt
+SITE_CONTENT = {
+    "banner": {"h1": "Lorem Ipsum Dolor", "h2": "Sit amet consectetur adipiscing elit",
+               "button": [{"name": "Learn More", "layout": 1, "style": []}, {"name": "Contact Us", "layout": 2, "style": []}]},
+    "about": {"h2": "About Us", "p": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4},
+    "blogs": {"h2": "Our Services", "post": [{"h3": f"Service {i}", "p": "Sed do eiusmod tempor incididunt ut labore. " * 3} for i in range(1, 4)]},
+    "faq": {"h2": "Frequently Asked Questions", "question": [{"id": i, "h3": f"Question {i}?", "p": "Ut enim ad minim veniam."} for i in range(1, 6)]},
+    "blog2": {"h2": "Our Mission", "p": "Duis aute irure dolor in reprehenderit in voluptate velit esse. " * 3},
+}
+
+
+def fake_value(schema: Dict, name: str = "value"):
+    """
+     Build a value matching a JSON schema, used to answer function calls.
+
+     @param schema - The JSON schema
+     @param name - The property name, used as placeholder text
+
+     @return The generated value
+    """
+    kind = schema.get("type", "string")
+    if kind == "object":
+        return {key: fake_value(value, key) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        count = max(schema.get("minItems", 1), 1)
+        return [fake_value(schema.get("items", {}), f"{name} {i + 1}") for i in range(count)]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    return f"Lorem {name}".replace("_", " ")
+
+
+def fake_reply(request: Dict) -> Dict:
+    """
+     Build the assistant message answering a chat request. Every plain text reply is different, like the
+     choices of a sampled completion.
+
+     @param request - The chat completion request body
+
+     @return The message dict (content or function_call)
+    """
+    functions = request.get("functions")
+    if functions:
+        function = functions[0]
+        arguments = fake_value(function.get("parameters", {}))
+        return {"role": "assistant", "content": None,
+                "function_call": {"name": function["name"], "arguments": json.dumps(arguments)}}
+    prompt = request["messages"][-1].get("content") or ""
+    if '"banner"' in prompt:
+        return {"role": "assistant", "content": json.dumps(SITE_CONTENT)}
+    return {"role": "assistant", "content": f"Lorem ipsum dolor sit amet, consectetur adipiscing elit {uuid.uuid4().hex[:8]}."}
+
+
+def placeholder_jpeg(prompt: str, size: str = "512x512") -> bytes:
+    """
+     Render a placeholder JPEG: a gradient whose colours are derived from the prompt, overlaid with a coarse
+     pattern and some noise so it is neither blank nor perceptually similar across prompts.
+
+     @param prompt - The image prompt
+     @param size - "WIDTHxHEIGHT"
+
+     @return The JPEG bytes
+    """
+    try:
+        width, height = (int(value) for value in size.lower().split("x"))
+    except ValueError:
+        width = height = 512
+    seed = int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:4], "big")
+    rng = np.random.default_rng(seed)
+    start, end = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+    ramp = np.linspace(0, 1, width)[None, :, None]
+    # An 8x8 pattern of light and dark blocks, so the perceptual hashes of different prompts differ
+    pattern = np.kron(rng.normal(0, 50, (8, 8)), np.ones((height // 8 + 1, width // 8 + 1)))[:height, :width, None]
+    pixels = start + (end - start) * ramp + pattern + rng.normal(0, 12, (height, width, 3))
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+#==================================================================================================
+# Handlers
+#==================================================================================================
+
+
+def rate_limit_headers() -> Dict[str, str]:
+    return {"x-ratelimit-limit-requests": "10000", "x-ratelimit-remaining-requests": "9999",
+            "x-ratelimit-limit-tokens": "2000000", "x-ratelimit-remaining-tokens": "1999000"}
+
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    config = request.app["config"]
+    body = await request.json()
+    fault = await inject_fault(config)
+    if fault is not None:
+        return fault
+    await asyncio.sleep(config.chat_latency())
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    messages = [fake_reply(body) for _ in range(body.get("n", 1))]
+    prompt_tokens = sum(len(message.get("content") or "") // 4 + 4 for message in body["messages"])
+    completion_tokens = sum(len(message.get("content") or "") // 4 for message in messages)
+    if not body.get("stream"):
+        return web.json_response({
+            "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": i, "message": message, "finish_reason": "stop"} for i, message in enumerate(messages)],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }, headers=rate_limit_headers())
+
+    # Server-sent events, a few words per chunk
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **rate_limit_headers()})
+    await response.prepare(request)
+    content = messages[0].get("content") or ""
+    for start in range(0, len(content), 24):
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"),
+                 "choices": [{"index": 0, "delta": {"content": content[start:start + 24]}, "finish_reason": None}]}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+    done = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    await response.write(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def image_generations(request: web.Request) -> web.Response:
+    config = request.app["config"]
+    body = await request.json()
+    fault = await inject_fault(config)
+    if fault is not None:
+        return fault
+    await asyncio.sleep(config.image_latency())
+    data = []
+    for i in range(body.get("n", 1)):
+        prompt = f"{body.get('prompt', '')}#{i}"
+        size = body.get("size", "1024x1024")
+        if body.get("response_format") == "b64_json":
+            data.append({"b64_json": base64.b64encode(placeholder_jpeg(prompt, size)).decode("ascii")})
+        else:
+            token = base64.urlsafe_b64encode(json.dumps({"prompt": prompt, "size": size}).encode("utf-8")).decode("ascii")
+            data.append({"url": f"{request.url.origin()}/files/{token}.jpg"})
+    return web.json_response({"created": int(time.time()), "data": data}, headers={"x-ratelimit-limit-requests": "1000", "x-ratelimit-remaining-requests": "999"})
+
+
+async def image_file(request: web.Request) -> web.Response:
+    token = request.match_info["token"]
+    try:
+        params = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except ValueError:
+        return web.Response(status=404)
+    return web.Response(body=placeholder_jpeg(params["prompt"], params["size"]), content_type="image/jpeg")
+
+
+async def huggingface_inference(request: web.Request) -> web.Response:
+    config = request.app["config"]
+    body = await request.json()
+    fault = await inject_fault(config, hf=True)
+    if fault is not None:
+        return fault
+    await asyncio.sleep(config.image_latency())
+    size = body.get("size") or body.get("parameters", {}).get("size") or "512x512"
+    inputs = body.get("inputs", "")
+    if isinstance(inputs, list):
+        # Batch endpoint: one base64 image per input
+        return web.json_response([base64.b64encode(placeholder_jpeg(str(prompt), size)).decode("ascii") for prompt in inputs])
+    return web.Response(body=placeholder_jpeg(str(inputs), size), content_type="image/jpeg")
+
+
+async def list_models(request: web.Request) -> web.Response:
+    models = ["gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-4"]
+    return web.json_response({"object": "list", "data": [{"id": model, "object": "model", "owned_by": "fake"} for model in models]})
+
+
+def make_app(config: FaultConfig = None) -> web.Application:
+    """
+     Create the fake server. It answers the OpenAI chat completion (with streaming and function calls), image
+     generation and model list endpoints under /v1, and HuggingFace inference under /models/{model}.
+
+     @param config - Latency and error rates, read from the environment by default
+
+     @return The aiohttp application
+    """
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app["config"] = config or FaultConfig()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/images/generations", image_generations)
+    app.router.add_get("/v1/models", list_models)
+    app.router.add_get("/files/{token}.jpg", image_file)
+    app.router.add_post("/models/{model:.+}", huggingface_inference)
+    return app
+
+
+def start_server(host: str = "127.0.0.1", port: int = 8080, config: FaultConfig = None) -> Callable[[], None]:
+    """
+     Start the fake server on its own event loop in a background thread, e.g. from a load test. The pipeline
+     makes blocking calls, so the server must not share their event loop.
+
+     @return A function stopping the server
+    """
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app(config))
+    ready = threading.Event()
+    errors = []
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        except OSError as e:
+            errors.append(e)
+            return
+        finally:
+            ready.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=serve, name="fake-server", daemon=True)
+    thread.start()
+    ready.wait()
+    if errors:
+        raise errors[0]
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI and HuggingFace inference APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--chat-latency", default=fake_chat_latency)
+    parser.add_argument("--image-latency", default=fake_image_latency)
+    parser.add_argument("--rate-limit-rate", type=float, default=fake_rate_limit_rate)
+    parser.add_argument("--unavailable-rate", type=float, default=fake_unavailable_rate)
+    parser.add_argument("--timeout-rate", type=float, default=fake_timeout_rate)
+    parser.add_argument("--timeout-seconds", type=float, default=fake_timeout_seconds)
+    args = parser.parse_args()
+    config = FaultConfig(args.chat_latency, args.image_latency, args.rate_limit_rate, args.unavailable_rate,
+                         args.timeout_rate, args.timeout_seconds)
+    print(f"Fake API server on http://{args.host}:{args.port} (set FAKE_API_SERVER to use it)")
+    web.run_app(make_app(config), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
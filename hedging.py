@@ -0,0 +1,200 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+from .worker_pool import worker_pool
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Hedging is opt-in: HEDGING=on enables it for the calls that ask for it
+hedging_enabled = os.getenv("HEDGING", "off").lower() in ("1", "on", "true", "yes")
+# Send the second request once the call is slower than this percentile of its stage's history
+hedge_percentile = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+# At most this fraction of calls may be hedged, which bounds the extra cost
+hedge_max_ratio = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+# No hedging until a stage has this many latency samples
+hedge_min_samples = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+#==================================================================================================
+# Hedged Requests
+#==================================================================================================
+
+
+class LatencyTracker:
+    """Keeps the latest latencies of every stage to compute the hedging threshold."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, latency: float) -> None:
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, stage: str, percentile: float, min_samples: int) -> Optional[float]:
+        """
+         Latency percentile of a stage.
+
+         @return The latency in seconds or None until the stage has min_samples samples
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(stage, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[min(len(samples) - 1, int(percentile * len(samples)))]
+
+
+# The abandoned event of the hedged attempt running in the current thread
+_attempt = threading.local()
+
+
+def attempt_abandoned() -> bool:
+    """
+     Check whether the current thread runs a hedged attempt that lost to the other one. Its outcome says nothing
+     about the upstream and is not recorded as a normal call.
+
+     @return True once the result of the attempt is no longer wanted
+    """
+    abandoned = getattr(_attempt, "abandoned", None)
+    return abandoned is not None and abandoned.is_set()
+
+
+def _run_attempt(abandoned: threading.Event, func: Callable, args: tuple, kwargs: dict):
+    if abandoned.is_set():
+        raise concurrent.futures.CancelledError()
+    previous = getattr(_attempt, "abandoned", None)
+    _attempt.abandoned = abandoned
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _attempt.abandoned = previous
+
+
+class Hedger:
+    """
+     Sends a second copy of a slow request. When a call has not returned after the configured percentile of its
+     stage's latency, the same request is sent again, the first answer wins and the other one is cancelled.
+     The share of hedged calls is capped by max_ratio. Both attempts of a synchronous call run in the llm lane
+     of the worker pool, a call made from that lane runs inline and cannot be hedged. Neither can a call made
+     from a later lane (e.g. image), which must not wait on the llm lane: it runs in its own thread unhedged.
+    """
+
+    def __init__(self,
+                 percentile: float = hedge_percentile,
+                 max_ratio: float = hedge_max_ratio,
+                 min_samples: int = hedge_min_samples,
+                 enabled: bool = hedging_enabled):
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.enabled = enabled
+        self.latencies = LatencyTracker()
+        self.calls = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def _threshold(self, stage: str) -> Optional[float]:
+        with self._lock:
+            self.calls += 1
+        if not self.enabled:
+            return None
+        return self.latencies.percentile(stage, self.percentile, self.min_samples)
+
+    def _allow_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.max_ratio * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def call(self, stage: str, func: Callable, *args, **kwargs):
+        """
+         Call func, hedging it if it is slower than usual for its stage.
+
+         @param stage - The stage name the latency history is kept under
+         @param func - The function performing the request
+
+         @return The first successful result. If both requests fail the error of the last one is raised.
+        """
+        start = time.monotonic()
+        threshold = self._threshold(stage)
+        if threshold is None or worker_pool.waits_backwards("llm"):
+            result = func(*args, **kwargs)
+            self.latencies.record(stage, time.monotonic() - start)
+            return result
+
+        attempts: Dict[concurrent.futures.Future, threading.Event] = {}
+
+        def send() -> concurrent.futures.Future:
+            abandoned = threading.Event()
+            future = worker_pool.submit("llm", _run_attempt, abandoned, func, args, kwargs)
+            attempts[future] = abandoned
+            return future
+
+        pending = {send()}
+        done, pending = concurrent.futures.wait(pending, timeout=threshold)
+        if not done and self._allow_hedge():
+            print(f"Hedging {stage} request after {round(threshold, 2)} seconds")
+            pending.add(send())
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    # A queued loser is cancelled, a running one cannot be interrupted: it is marked abandoned
+                    # so that its outcome is not recorded as a normal call
+                    for loser in pending:
+                        attempts[loser].set()
+                        loser.cancel()
+                    self.latencies.record(stage, time.monotonic() - start)
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                raise error
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    async def async_call(self, stage: str, func: Callable, *args, **kwargs):
+        """
+         Asynchronous version of call, func must be a coroutine function. The losing request is cancelled.
+        """
+        start = time.monotonic()
+        threshold = self._threshold(stage)
+        if threshold is None:
+            result = await func(*args, **kwargs)
+            self.latencies.record(stage, time.monotonic() - start)
+            return result
+
+        pending = {asyncio.ensure_future(func(*args, **kwargs))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=threshold)
+            if not done and self._allow_hedge():
+                print(f"Hedging {stage} request after {round(threshold, 2)} seconds")
+                pending.add(asyncio.ensure_future(func(*args, **kwargs)))
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies.record(stage, time.monotonic() - start)
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def metrics(self) -> Dict:
+        """
+         Number of calls and of hedged calls.
+        """
+        with self._lock:
+            return {"calls": self.calls, "hedges": self.hedges}
+
+
+chat_hedger = Hedger()
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import threading
+import weakref
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Connections kept alive per host, callers wait for a free one beyond that
+http_max_connections_per_host = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "32"))
+# Number of hosts whose connection pools are kept
+http_max_hosts = int(os.getenv("HTTP_MAX_HOSTS", "10"))
+# Seconds to open a connection, and to wait for the server between two reads
+http_connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+http_read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+
+#==================================================================================================
+# Pooled Sessions
+#==================================================================================================
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+     Get the process-wide requests session used for image inference and downloads, creating it on first use.
+     Connections are kept alive and reused across threads, gzip responses are decoded transparently and
+     idempotent requests are retried on connection errors and 502/503/504.
+
+     @return The shared requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                          allowed_methods=frozenset({"GET", "HEAD"}), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=http_max_hosts, pool_maxsize=http_max_connections_per_host,
+                                  pool_block=True, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            _session = session
+        return _session
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """
+     GET through the shared session, with the default connect and read timeouts unless others are given.
+    """
+    kwargs.setdefault("timeout", (http_connect_timeout, http_read_timeout))
+    return get_session().get(url, **kwargs)
+
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    """
+     POST through the shared session, with the default connect and read timeouts unless others are given.
+    """
+    kwargs.setdefault("timeout", (http_connect_timeout, http_read_timeout))
+    return get_session().post(url, **kwargs)
+
+
+# One aiohttp client per event loop, shared by every coroutine running on it
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+
+
+async def get_async_client() -> aiohttp.ClientSession:
+    """
+     Asynchronous version of get_session: the aiohttp client of the running event loop, with the same
+     per-host connection limit and timeouts.
+
+     @return The shared aiohttp.ClientSession
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.closed:
+        connector = aiohttp.TCPConnector(limit=http_max_hosts * http_max_connections_per_host,
+                                         limit_per_host=http_max_connections_per_host, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(sock_connect=http_connect_timeout, sock_read=http_read_timeout)
+        client = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=True)
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_client() -> None:
+    """
+     Close the aiohttp client of the running event loop. Call it once before the loop is shut down.
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None and not client.closed:
+        await client.close()
+
+
+def raise_for_status(response: aiohttp.ClientResponse, body: bytes) -> None:
+    """
+     Raise the ClientResponseError of a failed aiohttp response with its body attached as e.body, which aiohttp
+     leaves out, so that the retry policy can tell a model that is loading from an outage.
+
+     @param response - The response
+     @param body - The body already read from it
+    """
+    try:
+        response.raise_for_status()
+    except aiohttp.ClientResponseError as e:
+        e.body = body
+        raise
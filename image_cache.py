@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from .llm_cache import make_key
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Disable the cache with IMAGE_CACHE=off
+image_cache_enabled = os.getenv("IMAGE_CACHE", "on").lower() not in ("0", "off", "false", "no")
+# Least recently used images are evicted above this many megabytes
+image_cache_max_mb = float(os.getenv("IMAGE_CACHE_MAX_MB", "1024"))
+# Images not used for this many seconds are removed on their next lookup (0 disables expiry)
+image_cache_ttl = float(os.getenv("IMAGE_CACHE_TTL", str(30 * 24 * 60 * 60)))
+
+#==================================================================================================
+# Image Cache
+#==================================================================================================
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+     Normalize an image prompt so that prompts differing only in case or whitespace share an entry. The text
+     encoders of the image models lowercase the prompt anyway.
+
+     @param prompt - The image prompt
+
+     @return The normalized prompt
+    """
+    return " ".join(prompt.lower().split())
+
+
+def image_key(provider: str, model: str, prompt: str, size: str, seed: Optional[int] = None) -> str:
+    """
+     Hash the parameters that determine a rendered image into a cache key.
+
+     @param provider - The image provider, e.g. "huggingface" or "dalle"
+     @param model - The model or endpoint the image is rendered with
+     @param prompt - The image prompt
+     @param size - The requested size, e.g. "1024x1024"
+     @param seed - The sampling seed, if the request sets one
+
+     @return The hex sha256 digest of the normalized parameters
+    """
+    return make_key({"provider": provider, "model": model, "prompt": normalize_prompt(prompt), "size": size, "seed": seed})
+
+
+class ImageCache:
+    """
+     Disk cache for rendered images, one file per key, with LRU eviction above a total size and expiry of the
+     images unused for ttl seconds. The index of the files is read from the directory on first use and the access
+     order is kept in the file modification times, so it survives restarts.
+    """
+
+    def __init__(self, path: str, max_bytes: float = image_cache_max_mb * 1024 * 1024, enabled: bool = image_cache_enabled,
+                 ttl: float = image_cache_ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries: Optional["OrderedDict[str, int]"] = None
+        self._size = 0
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def _index(self) -> "OrderedDict[str, int]":
+        if self._entries is None:
+            files = []
+            for root, _, names in os.walk(self.path):
+                for name in names:
+                    if name.endswith(".part"):
+                        continue
+                    stat = os.stat(os.path.join(root, name))
+                    files.append((stat.st_mtime, name, stat.st_size))
+            self._entries = OrderedDict((name, size) for _, name, size in sorted(files))
+            self._size = sum(self._entries.values())
+        return self._entries
+
+    def _remove(self, key: str) -> None:
+        self._size -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+         Look up a rendered image.
+
+         @param key - The key returned by image_key
+
+         @return The image bytes or None on a miss
+        """
+        if not self.enabled:
+            return None
+        try:
+            with self._lock:
+                entries = self._index()
+                if key not in entries:
+                    return None
+                now = time.time()
+                if self.ttl and now - os.path.getmtime(self._file(key)) > self.ttl:
+                    self._remove(key)
+                    return None
+                with open(self._file(key), "rb") as f:
+                    data = f.read()
+                entries.move_to_end(key)
+                os.utime(self._file(key), (now, now))
+                return data
+        except OSError as e:
+            print(f"Image cache unavailable: {e}")
+            return None
+
+    def set(self, key: str, data: bytes) -> None:
+        """
+         Store a rendered image and evict the least recently used images above max_bytes.
+
+         @param key - The key returned by image_key
+         @param data - The image bytes
+        """
+        if not self.enabled or not data:
+            return
+        try:
+            with self._lock:
+                entries = self._index()
+                path = self._file(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".part", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".part", path)
+                self._size += len(data) - entries.pop(key, 0)
+                entries[key] = len(data)
+                while self._size > self.max_bytes and len(entries) > 1:
+                    self._remove(next(iter(entries)))
+        except OSError as e:
+            print(f"Image cache unavailable: {e}")
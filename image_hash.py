@@ -0,0 +1,191 @@
+import argparse
+import io
+import os
+import threading
+from pathlib import Path
+from typing import List, Tuple
+import numpy as np
+from PIL import Image
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Set to "off" to keep near-duplicate gallery images
+gallery_dedup = os.getenv("GALLERY_DEDUP", "on")
+# Images whose 64-bit hashes differ in at most this many bits are near-duplicates
+dhash_threshold = int(os.getenv("DHASH_THRESHOLD", "10"))
+# Number of gallery hashes kept by gallery_index for the cross-site scan, the oldest are replaced above it
+gallery_index_size = int(os.getenv("GALLERY_INDEX_SIZE", "10000"))
+
+#==================================================================================================
+# Perceptual Hashing
+#==================================================================================================
+
+
+def dhash(data: bytes, hash_size: int = 8) -> int:
+    """
+     Difference hash of an image: shrink it to a (hash_size + 1) x hash_size grayscale grid and keep one bit per
+     pair of horizontal neighbours, set when the brightness increases. Resizing, recompression and small edits
+     barely change it. JPEG images are decoded at reduced scale.
+
+     @param data - The encoded image
+     @param hash_size - The grid height, the hash has hash_size * hash_size bits
+
+     @return The hash as an integer
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """
+     Number of differing bits between every hash of an array and one hash.
+
+     @param hashes - A uint64 array of hashes
+     @param value - The hash to compare with
+
+     @return An int array of distances
+    """
+    differences = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(differences.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class HashIndex:
+    """
+     Thread-safe index of 64-bit image hashes, searched with vectorised Hamming distances. The hash array grows
+     geometrically, and once an index with a capacity is full every new hash replaces the oldest one.
+    """
+
+    def __init__(self, threshold: int = dhash_threshold, capacity: int = None):
+        self.threshold = threshold
+        self.capacity = capacity
+        self._names: List[str] = []
+        self._hashes = np.zeros(16 if capacity is None else min(16, capacity), dtype=np.uint64)
+        self._oldest = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def _nearest(self, value: int) -> Tuple[str, int]:
+        if not self._names:
+            return None, None
+        distances = hamming_distances(self._hashes[:len(self._names)], value)
+        index = int(distances.argmin())
+        return self._names[index], int(distances[index])
+
+    def find(self, value: int) -> str:
+        """
+         Look for a near-duplicate of a hash.
+
+         @param value - The hash returned by dhash
+
+         @return The name of the closest indexed image within the threshold, or None
+        """
+        with self._lock:
+            name, distance = self._nearest(value)
+        return name if distance is not None and distance <= self.threshold else None
+
+    def add(self, name: str, value: int, unique: bool = False) -> str:
+        """
+         Index the hash of an image.
+
+         @param name - The name the image is reported with
+         @param value - The hash returned by dhash
+         @param unique - Do not index the hash when the index already has a near-duplicate
+
+         @return The name of the near-duplicate that prevented the insertion, or None if the hash was indexed
+        """
+        with self._lock:
+            if unique:
+                duplicate, distance = self._nearest(value)
+                if distance is not None and distance <= self.threshold:
+                    return duplicate
+            size = len(self._names)
+            if self.capacity is not None and size >= self.capacity:
+                self._names[self._oldest] = name
+                self._hashes[self._oldest] = value
+                self._oldest = (self._oldest + 1) % size
+                return None
+            if size == len(self._hashes):
+                grown = size * 2 if self.capacity is None else min(size * 2, self.capacity)
+                self._hashes = np.concatenate((self._hashes, np.zeros(grown - size, dtype=np.uint64)))
+            self._names.append(name)
+            self._hashes[size] = value
+        return None
+
+    def duplicates(self) -> List[Tuple[str, str, int]]:
+        """
+         Find every pair of near-duplicate images of the index in one pass.
+
+         @return (name, name, distance) tuples
+        """
+        with self._lock:
+            names, hashes = list(self._names), self._hashes[:len(self._names)].copy()
+        pairs = []
+        for index in range(len(hashes) - 1):
+            distances = hamming_distances(hashes[index + 1:], int(hashes[index]))
+            for offset in np.flatnonzero(distances <= self.threshold):
+                pairs.append((names[index], names[index + 1 + offset], int(distances[offset])))
+        return pairs
+
+
+# Hashes of the latest gallery images of every site generated by the process
+gallery_index = HashIndex(capacity=gallery_index_size)
+
+#==================================================================================================
+# Duplicate Scan
+#==================================================================================================
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def index_directory(directory: str, threshold: int = dhash_threshold) -> HashIndex:
+    """
+     Hash every image of a directory, such as the content directory shared by the generated sites.
+
+     @param directory - The directory to scan, subdirectories included
+     @param threshold - Maximum number of differing bits of near-duplicates
+
+     @return The index of the images, named by their path
+    """
+    index = HashIndex(threshold)
+    for path in sorted(Path(directory).rglob("*")):
+        if path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        try:
+            index.add(str(path), dhash(path.read_bytes()))
+        except (OSError, ValueError) as e:
+            print(f"Unable to read {path}: {e}")
+    return index
+
+
+def find_duplicates(directory: str, threshold: int = dhash_threshold) -> List[Tuple[str, str, int]]:
+    """
+     Find the near-duplicate images of a directory, across every site whose images it holds.
+
+     @param directory - The directory to scan, subdirectories included
+     @param threshold - Maximum number of differing bits of near-duplicates
+
+     @return (path, path, distance) tuples, closest pairs first
+    """
+    return sorted(index_directory(directory, threshold).duplicates(), key=lambda pair: pair[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the near-duplicate images of a directory")
+    parser.add_argument("directory", help="e.g. the content directory of the workspace")
+    parser.add_argument("--threshold", type=int, default=dhash_threshold)
+    args = parser.parse_args()
+    pairs = find_duplicates(args.directory, args.threshold)
+    for first, second, distance in pairs:
+        print(f"{distance}\t{first}\t{second}")
+    print(f"{len(pairs)} near-duplicate pairs")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
+import asyncio
 import concurrent.futures
+import hashlib
 import io
 import json
 import os
@@ -7,15 +9,30 @@ import re
 import random
 import requests
 import time
+import uuid
 import base64
+import aiohttp
 from PIL import Image
 from pathlib import Path
 from datetime import datetime, date, time, timezone
+from time import monotonic, sleep
 from dotenv import load_dotenv
-from typing import List, Dict, TypedDict
+from typing import AsyncIterator, Iterable, Iterator, List, Dict, TypedDict
 from concurrent.futures import ThreadPoolExecutor, wait
-from diffusers import StableDiffusionPipeline, EulerDiscreteScheduler
-from .content_main import chat_with_gpt3
+from .content_main import chat_with_gpt3, async_chat_with_gpt3, chat_choices_with_gpt3, async_chat_choices_with_gpt3, retry_with_exponential_backoff, async_retry_with_exponential_backoff, get_async_session
+from .concurrency import image_concurrency
+from .http_session import get_async_client, http_get, http_post, raise_for_status
+from .image_cache import ImageCache, image_key
+from .image_hash import HashIndex, dhash, gallery_dedup, gallery_index
+from .image_validation import InvalidImage, image_render_attempts, render_backoff, validate_image
+from .image_variants import SLOT_WIDTHS, image_variants, make_variants
+from .llm_cache import make_key
+from .local_diffusion import local_batch_size, local_batcher, local_image_size, local_inference_steps, local_model_id
+from .rate_limiter import image_rate_limiter
+from .retry_policy import CircuitBreaker, CircuitOpenError, get_breaker, retry_max_elapsed
+from .singleflight import SingleFlight
+from .storage import AssetManifest, AssetStore, content_name, make_backend
+from .worker_pool import worker_pool
 
 #==================================================================================================
 # Load Parameters
@@ -29,21 +46,41 @@ openai.api_key = os.getenv("OPENAI_API_KEY", "")
 API_URL = os.getenv("API_URL", "")
 headers = {"Authorization": f"Bearer {os.getenv('STABILITY_KEY')}"}
 image_model = os.getenv("IMAGE_MODEL", "")
-# Use the API key
-
-openai.Model.list()
+# Prompts sent in one HuggingFace request. The hosted Inference API (the usual API_URL) renders a single input, so
+# batching is off by default; raise it for endpoints that accept a list of inputs and answer with base64 images
+hf_batch_size = int(os.getenv("HF_BATCH_SIZE", "1"))
+# Images DALL-E renders in one request for the same prompt
+dall_e_max_n = 10
+# Images of the gallery, and rounds of new renders for the ones that were near-duplicates or failed
+gallery_size = 8
+gallery_rerenders = int(os.getenv("GALLERY_RERENDERS", "1"))
+# Sizes requested from each provider
+hf_image_size = "1280x1280"
+dall_e_image_size = "1024x1024"
+# Send every request to the local fake server (fake_server.py) instead, for offline load tests
+fake_api_server = os.getenv("FAKE_API_SERVER", "").rstrip("/")
+if fake_api_server:
+    API_URL = f"{fake_api_server}/models/stabilityai/stable-diffusion-2-1-base"
+    openai.api_key = openai.api_key or "fake"
 
 # load memory directory
 memory_dir = os.getenv("MEMORY_DIRECTORY", "local")
 workspace_path = "./"
 # The workspace_path is the path to the workspace directory.
 if memory_dir == "production":
-    import boto3
     workspace_path = "/tmp"
 elif memory_dir == "local":
     workspace_path = "./"
 
 
+# Concurrent identical render requests share one upstream call
+image_flight = SingleFlight()
+# Rendered images reused across runs for the same prompt
+image_cache = ImageCache(os.getenv("IMAGE_CACHE_PATH", os.path.join(workspace_path, "cache", "images")))
+# Saved images are published to the storage backend in the background, the manifest counts the sites using each
+asset_store = AssetStore(make_backend(workspace_path), AssetManifest(os.path.join(workspace_path, "content", "manifest.json")))
+
+
 class Message(TypedDict):
     role: str
     content: str
@@ -55,99 +92,629 @@ class Message(TypedDict):
 
 def query(query_parameters: Dict[str, str]) -> bytes:
     """
-     Query the VirusTotal API with the given parameters. This is a wrapper around requests. post that does not raise exceptions.
+     Query the VirusTotal API with the given parameters. This is a wrapper around the pooled session's post that does not raise exceptions.
+     Concurrent identical queries share one request.
      
      @param query_parameters - A dictionary of key value pairs that are used to make the query.
      
-     @return The response as a byte string or an empty string
+     @return The response as a byte string, the JSON error body of a failed request or an empty string
     """
+    key = make_key({"url": API_URL, "parameters": query_parameters})
+    return image_flight.do(key, _query, query_parameters)
+
+
+def _query(query_parameters: Dict[str, str]) -> bytes:
     try:
-        response = requests.post(API_URL, headers=headers, json=query_parameters, timeout=120)
-        response.raise_for_status()
+        with get_breaker("huggingface").guard(), image_concurrency.slot():
+            response = http_post(API_URL, headers=headers, json=query_parameters)
+            response.raise_for_status()
         return response.content
-    except requests.exceptions.RequestException as e:
+    except requests.exceptions.HTTPError as e:
+        print(f"An error occurred: {e}")
+        # The body says why, e.g. the estimated_time of a model that is still loading
+        return e.response.content if e.response is not None else b""
+    except (requests.exceptions.RequestException, CircuitOpenError) as e:
         print(f"An error occurred: {e}")
         return b""
 
 
-def stabilityai_generate(prompt: str) -> str:
+def hf_parameters(prompt: str, fresh: bool = False) -> Dict:
+    """
+    Build the HuggingFace request of a prompt.
+    
+    @param prompt - The image prompt
+    @param fresh - Ask for a new image: the Inference API does not answer from its cache, which would return the
+                   image that was just rejected, and samples with a new seed
+    
+    @return The JSON parameters of the request
+    """
+    parameters = {
+        "inputs": f"{prompt}",
+        "size": hf_image_size
+    }
+    if fresh:
+        parameters["options"] = {"use_cache": False}
+        parameters["parameters"] = {"seed": random.randrange(2 ** 32)}
+    return parameters
+
+
+def stabilityai_generate(prompt: str, fresh: bool = False) -> str:
     """
     Generate stabilityai jpg image. This is a wrapper around query that allows you to specify the size and section of the image you want to generate
     
     @param prompt - prompt to provide to the user
-    @param size - size of the image in pixels ( must be between 1 and 1024 )
-    @param section - section of the image that will be generated ( ex : images. jpg)
+    @param fresh - Bypass the cache of the Inference API and use a new seed, to replace a rejected image
     
     @return path to generated jpg
     """
     print(f"Generating Image...")
-    image_bytes = query({
-        "inputs": f"{prompt}",
-        "size": "1280x1280"
-    })
+    image_bytes = query(hf_parameters(prompt, fresh))
     return image_bytes
 
-def retry_with_exponential_backoff(
-    func,
-    initial_delay: float = 1,
-    exponential_base: float = 2,
-    jitter: bool = True,
-    max_retries: int = 10,
-    errors: tuple = (openai.error.RateLimitError,
-                     openai.error.Timeout,
-                     openai.error.ServiceUnavailableError,
-                     openai.error.APIError,
-                     openai.error.InvalidRequestError,
-                     openai.error.APIConnectionError),
-):
-    """Retry a function with exponential backoff."""
-
-    def wrapper(*args, **kwargs):
-        # Initialize variables
-        num_retries = 0
-        delay = initial_delay
-
-        # Loop until a successful response or max_retries is hit or an exception is raised
-        while True:
-            try:
-                return func(*args, **kwargs)
 
-            # Retry on specified errors
-            except errors as e:
-                # Increment retries
-                print (e)
-                num_retries += 1
+async def async_query(query_parameters: Dict[str, str]) -> bytes:
+    """
+     Asynchronous version of query. It shares the pooled aiohttp client of the running event loop and does not raise exceptions.
+     
+     @param query_parameters - A dictionary of key value pairs that are used to make the query.
+     
+     @return The response as a byte string, the JSON error body of a failed request or an empty string
+    """
+    key = make_key({"url": API_URL, "parameters": query_parameters})
+    return await image_flight.async_do(key, _async_query, query_parameters)
 
-                # Check if max retries has been reached
-                if num_retries > max_retries:
-                    raise Exception(
-                        f"Maximum number of retries ({max_retries}) exceeded."
-                    )
 
-                # Increment the delay
-                delay *= exponential_base * (1 + jitter * random.random())
+async def _async_query(query_parameters: Dict[str, str]) -> bytes:
+    client = await get_async_client()
+    body = b""
+    try:
+        with get_breaker("huggingface").guard():
+            async with image_concurrency.async_slot():
+                async with client.post(API_URL, headers=headers, json=query_parameters) as response:
+                    body = await response.read()
+                    raise_for_status(response, body)
+                    return body
+    except aiohttp.ClientResponseError as e:
+        print(f"An error occurred: {e}")
+        # The body says why, e.g. the estimated_time of a model that is still loading
+        return body
+    except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+        print(f"An error occurred: {e}")
+        return b""
 
-                # Sleep for the delay
-                time.sleep(delay)
 
-            # Raise exceptions for any errors not specified
-            except Exception as e:
-                raise e
+async def async_stabilityai_generate(prompt: str, fresh: bool = False) -> bytes:
+    """
+    Asynchronous version of stabilityai_generate.
+    
+    @param prompt - prompt to provide to the user
+    @param fresh - Bypass the cache of the Inference API and use a new seed, to replace a rejected image
+    
+    @return The generated image as a byte string
+    """
+    print(f"Generating Image...")
+    image_bytes = await async_query(hf_parameters(prompt, fresh))
+    return image_bytes
+
+
+def local_generate_batch(prompts: List[str]) -> List[bytes]:
+    """
+    Render prompts with the local Stable Diffusion pipeline (IMAGE_MODEL=local). The prompts join the batches of
+    the other renders in progress, several prompts share a forward pass in a diffusion worker process.
+    
+    @param prompts - The image prompts
+    
+    @return The JPEG bytes of each prompt, an empty string for the ones that failed
+    """
+    print(f"Generating Image...")
+    futures = [local_batcher.submit(prompt) for prompt in prompts]
+    return [_local_result(future) for future in futures]
 
-    return wrapper
+
+def _local_result(future: concurrent.futures.Future) -> bytes:
+    try:
+        return future.result()
+    except ImportError as e:
+        print(f"IMAGE_MODEL=local needs diffusers, transformers and torch: {e}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    return b""
+
+
+def local_generate(prompt: str) -> bytes:
+    """
+    Render a prompt with the local Stable Diffusion pipeline.
+    
+    @param prompt - The image prompt
+    
+    @return The generated image as a byte string
+    """
+    return local_generate_batch([prompt])[0]
+
+
+async def async_local_generate_batch(prompts: List[str]) -> List[bytes]:
+    """
+    Asynchronous version of local_generate_batch.
+    """
+    print(f"Generating Image...")
+    futures = [asyncio.wrap_future(local_batcher.submit(prompt)) for prompt in prompts]
+    await asyncio.wait(futures)
+    return [_local_result(future) for future in futures]
+
+
+async def async_local_generate(prompt: str) -> bytes:
+    """
+    Asynchronous version of local_generate.
+    """
+    return (await async_local_generate_batch([prompt]))[0]
 
 
-@retry_with_exponential_backoff
 def chat_with_dall_e(messages: str) -> str:
+    """
+     Render an image with DALL-E. Concurrent identical prompts share one request.
+     
+     @param messages - The image prompt
+     
+     @return The url of the generated image
+    """
+    return image_flight.do(make_key({"provider": "dalle", "prompt": messages}), _chat_with_dall_e, messages)
+
+
+async def async_chat_with_dall_e(messages: str) -> str:
+    """
+     Asynchronous version of chat_with_dall_e.
+     
+     @param messages - The image prompt
+     
+     @return The url of the generated image
+    """
+    return await image_flight.async_do(make_key({"provider": "dalle", "prompt": messages}), _async_chat_with_dall_e, messages)
+
+
+def _chat_with_dall_e(messages: str) -> str:
+    return _dall_e_images(messages, 1)[0]
+
+
+async def _async_chat_with_dall_e(messages: str) -> str:
+    return (await _async_dall_e_images(messages, 1))[0]
+
+
+@retry_with_exponential_backoff
+def _dall_e_images(messages: str, n: int) -> List[str]:
+    image_rate_limiter.acquire()
     print("Generating Image...")
-    response = openai.Image.create(
-        prompt=messages,
-        n=1,
-        size="1024x1024",
-    )
+    with image_concurrency.slot():
+        response = openai.Image.create(
+            prompt=messages,
+            n=n,
+            size=dall_e_image_size,
+        )
     # print (response)
     # print (type(response['data'][0]['url']))
-    return response['data'][0]['url']
+    return [image['url'] for image in response['data']]
+
+
+@async_retry_with_exponential_backoff
+async def _async_dall_e_images(messages: str, n: int) -> List[str]:
+    await image_rate_limiter.async_acquire()
+    print("Generating Image...")
+    openai.aiosession.set(await get_async_session())
+    async with image_concurrency.async_slot():
+        response = await openai.Image.acreate(
+            prompt=messages,
+            n=n,
+            size=dall_e_image_size,
+        )
+    return [image['url'] for image in response['data']]
+
+
+#==================================================================================================
+# Image Cache
+#==================================================================================================
+
+def image_cache_key(prompt: str) -> str:
+    """
+    Key of an image in the image cache, from the provider and the model of the configured IMAGE_MODEL.
+    
+    @param prompt - The image prompt
+    
+    @return The cache key
+    """
+    if image_model == "dalle":
+        return image_key("dalle", "dall-e-2", prompt, dall_e_image_size)
+    if image_model == "local":
+        return image_key("local", f"{local_model_id}:{local_inference_steps}", prompt, f"{local_image_size}x{local_image_size}")
+    return image_key("huggingface", API_URL, prompt, hf_image_size)
+
+
+def download_image(image: str | bytes) -> bytes:
+    """
+    Get the bytes of a rendered image, downloading it if the provider returned a url.
+    
+    @param image - The url or bytes returned by the image method
+    
+    @return The image bytes or None if the download failed
+    """
+    if type(image) != str:
+        return image
+    try:
+        response = http_get(image)
+    except requests.exceptions.RequestException as e:
+        print(f"An error occurred while trying to download the image: {e}")
+        return None
+    if response.status_code != 200:
+        print("Unable to download image")
+        return None
+    return response.content
+
+
+async def async_download_image(image: str | bytes) -> bytes:
+    """
+    Asynchronous version of download_image.
+    """
+    if type(image) != str:
+        return image
+    client = await get_async_client()
+    try:
+        async with client.get(image) as response:
+            if response.status != 200:
+                print("Unable to download image")
+                return None
+            return await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"An error occurred while trying to download the image: {e}")
+        return None
+
+
+def store_image(key: str, image: str | bytes) -> str | bytes:
+    """
+    Store a rendered image in the image cache, downloading it first if the provider returned a url.
+    
+    @param key - The cache key, None to leave the image out of the cache
+    @param image - The url or bytes returned by the image method
+    
+    @return The image bytes, or the image unchanged if it could not be stored
+    """
+    if key is None or not image:
+        return image
+    data = download_image(image)
+    if not data:
+        return image
+    image_cache.set(key, data)
+    return data
+
+
+async def async_store_image(key: str, image: str | bytes) -> str | bytes:
+    """
+    Asynchronous version of store_image.
+    """
+    if key is None or not image:
+        return image
+    data = await async_download_image(image)
+    if not data:
+        return image
+    await worker_pool.run("io", image_cache.set, key, data)
+    return data
+
+
+def cached_images(prompts: List[str]) -> tuple:
+    """
+    Look the prompts up in the image cache. A prompt repeated in the list is rendered again, so that it gets a
+    different image, and is not cached.
+    
+    @param prompts - The image prompts
+    
+    @return The cached images (None for the misses), the cache key of each prompt by index and the indexes to render
+    """
+    results: List[str | bytes] = [None] * len(prompts)
+    if not image_cache.enabled:
+        return results, {}, list(range(len(prompts)))
+    keys, misses = {}, []
+    for index, prompt in enumerate(prompts):
+        key = image_cache_key(prompt)
+        if key not in keys.values():
+            keys[index] = key
+            results[index] = image_cache.get(key)
+        if results[index] is None:
+            misses.append(index)
+    return results, keys, misses
+
+
+def cached_render(method_name, prompt: str) -> str | bytes:
+    """
+    Render a prompt with method_name unless an earlier run already rendered it.
+    
+    @param method_name - The single image method selected by select_image_method
+    @param prompt - The image prompt
+    
+    @return The url or bytes of the image
+    """
+    return render_batch(method_name, [prompt])[0]
+
+
+async def async_cached_render(method_name, prompt: str) -> str | bytes:
+    """
+    Asynchronous version of cached_render.
+    """
+    return (await async_render_batch(method_name, [prompt]))[0]
+
+
+#==================================================================================================
+# Batch Rendering
+#==================================================================================================
+
+def _query_batch(prompts: List[str]) -> List[bytes]:
+    try:
+        with get_breaker("huggingface").guard(), image_concurrency.slot():
+            response = http_post(API_URL, headers=headers, json={"inputs": prompts, "size": hf_image_size})
+            response.raise_for_status()
+        images = [base64.b64decode(image) for image in response.json()]
+    except (requests.exceptions.RequestException, CircuitOpenError, ValueError, TypeError) as e:
+        print(f"Batch query failed, rendering the prompts one by one: {e}")
+        return []
+    return images if len(images) == len(prompts) else []
+
+
+async def _async_query_batch(prompts: List[str]) -> List[bytes]:
+    client = await get_async_client()
+    try:
+        with get_breaker("huggingface").guard():
+            async with image_concurrency.async_slot():
+                async with client.post(API_URL, headers=headers, json={"inputs": prompts, "size": hf_image_size}) as response:
+                    body = await response.read()
+                    raise_for_status(response, body)
+        images = [base64.b64decode(image) for image in json.loads(body)]
+    except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError, ValueError, TypeError) as e:
+        print(f"Batch query failed, rendering the prompts one by one: {e}")
+        return []
+    return images if len(images) == len(prompts) else []
+
+
+def batch_groups(prompts: List[str]) -> List[List[int]]:
+    """
+    Group the prompts into the requests of a batch: identical prompts for DALL-E (one request with n images),
+    consecutive chunks of HF_BATCH_SIZE prompts for HuggingFace, of LOCAL_BATCH_SIZE prompts for the local
+    pipeline, one prompt per request otherwise.
+    
+    @param prompts - The prompts to render
+    
+    @return The indexes of the prompts sent in each request
+    """
+    if image_model == "dalle":
+        groups: Dict[str, List[int]] = {}
+        for index, prompt in enumerate(prompts):
+            groups.setdefault(prompt, []).append(index)
+        return [indexes[start:start + dall_e_max_n] for indexes in groups.values() for start in range(0, len(indexes), dall_e_max_n)]
+    size = {"stabilityai": hf_batch_size, "local": local_batch_size}.get(image_model, 1)
+    return [list(range(start, min(start + size, len(prompts)))) for start in range(0, len(prompts), max(size, 1))]
+
+
+def _render_group(method_name, prompts: List[str], group: List[int]) -> List[str | bytes]:
+    if len(group) == 1:
+        return [method_name(prompts[group[0]])]
+    if image_model == "dalle":
+        return _dall_e_images(prompts[group[0]], len(group))
+    if image_model == "local":
+        return local_generate_batch([prompts[index] for index in group])
+    images = _query_batch([prompts[index] for index in group])
+    return images or [method_name(prompts[index]) for index in group]
+
+
+async def _async_render_group(method_name, prompts: List[str], group: List[int]) -> List[str | bytes]:
+    if len(group) == 1:
+        return [await method_name(prompts[group[0]])]
+    if image_model == "dalle":
+        return await _async_dall_e_images(prompts[group[0]], len(group))
+    if image_model == "local":
+        return await async_local_generate_batch([prompts[index] for index in group])
+    images = await _async_query_batch([prompts[index] for index in group])
+    return images or list(await asyncio.gather(*(method_name(prompts[index]) for index in group)))
+
+
+def image_breaker() -> CircuitBreaker:
+    """
+    @return The circuit breaker of the configured IMAGE_MODEL, None for the local pipeline
+    """
+    if image_model == "local":
+        return None
+    return get_breaker("openai" if image_model == "dalle" else "huggingface")
+
+
+def rerender_image(method_name, prompt: str) -> str | bytes:
+    """
+    Render a prompt again after its image was rejected. The HuggingFace API is asked for a fresh image, since an
+    identical request may be answered with the same image from its cache.
+    
+    @param method_name - The single image method selected by select_image_method
+    @param prompt - The image prompt
+    
+    @return The url or bytes of the image, None while the circuit of the provider is open
+    """
+    try:
+        if image_model == "stabilityai":
+            return stabilityai_generate(prompt, fresh=True)
+        return method_name(prompt)
+    except CircuitOpenError as e:
+        print(f"An error occurred: {e}")
+        return None
+
+
+async def async_rerender_image(method_name, prompt: str) -> str | bytes:
+    """
+    Asynchronous version of rerender_image. method_name must be a coroutine function.
+    """
+    try:
+        if image_model == "stabilityai":
+            return await async_stabilityai_generate(prompt, fresh=True)
+        return await method_name(prompt)
+    except CircuitOpenError as e:
+        print(f"An error occurred: {e}")
+        return None
+
+
+def _render_delay(attempt: int, error: InvalidImage, deadline: float) -> tuple:
+    # While the circuit of the provider is open the render never reached it, wait for the probe instead of
+    # counting an attempt, as long as the wait ends before the deadline
+    breaker = image_breaker()
+    wait = breaker.retry_in() if breaker is not None else 0.0
+    if wait > 0 and monotonic() + wait <= deadline:
+        print(f"Image provider unavailable, rendering the image again in {round(wait, 2)} seconds")
+        return attempt, wait
+    attempt += 1
+    if attempt >= image_render_attempts:
+        print(f"Invalid image, giving up: {error}")
+        return attempt, None
+    delay = render_backoff(attempt - 1, error.retry_after)
+    print(f"Invalid image, rendering it again in {round(delay, 2)} seconds: {error}")
+    return attempt, delay
+
+
+def valid_image(method_name, prompt: str, image: str | bytes) -> bytes:
+    """
+    Validate a rendered image and render the prompt again while it is empty, an error payload or blank, waiting
+    as long as the provider estimates (e.g. while a HuggingFace model is loading) or until its circuit lets a
+    probe through. Only this image is rendered again.
+    
+    @param method_name - The single image method selected by select_image_method
+    @param prompt - The image prompt
+    @param image - The url or bytes returned by the image method
+    
+    @return The image bytes or None if no valid image was rendered in IMAGE_RENDER_ATTEMPTS attempts
+    """
+    deadline = monotonic() + retry_max_elapsed
+    attempt = 0
+    while True:
+        try:
+            data = download_image(image) if image else None
+            validate_image(data)
+            return data
+        except InvalidImage as e:
+            attempt, delay = _render_delay(attempt, e, deadline)
+            if delay is None:
+                return None
+            sleep(delay)
+            image = rerender_image(method_name, prompt)
+
+
+async def async_valid_image(method_name, prompt: str, image: str | bytes) -> bytes:
+    """
+    Asynchronous version of valid_image. method_name must be a coroutine function.
+    """
+    deadline = monotonic() + retry_max_elapsed
+    attempt = 0
+    while True:
+        try:
+            data = await async_download_image(image) if image else None
+            await worker_pool.run("cpu", validate_image, data)
+            return data
+        except InvalidImage as e:
+            attempt, delay = _render_delay(attempt, e, deadline)
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+            image = await async_rerender_image(method_name, prompt)
+
+
+def _render_stored(method_name, prompts: List[str], group: List[int], keys: Dict[int, str]) -> List[bytes]:
+    images = _render_group(method_name, prompts, group)
+    return [store_image(keys.get(index), valid_image(method_name, prompts[index], image)) for index, image in zip(group, images)]
+
+
+async def _async_render_stored(method_name, prompts: List[str], group: List[int], keys: Dict[int, str]) -> tuple:
+    images = await _async_render_group(method_name, prompts, group)
+    images = await asyncio.gather(*(async_valid_image(method_name, prompts[index], image) for index, image in zip(group, images)))
+    return group, await asyncio.gather(*(async_store_image(keys.get(index), image) for index, image in zip(group, images)))
+
+
+def _miss_groups(prompts: List[str], misses: List[int]) -> List[List[int]]:
+    return [[misses[position] for position in group] for group in batch_groups([prompts[index] for index in misses])]
+
+
+def iter_render_batch(method_name,
+                      prompts: List[str]) -> Iterator[tuple]:
+    """
+    Render several prompts like render_batch, yielding each image as soon as its request completes. Cached images
+    come first. The images that failed are not yielded.
+    
+    @param method_name - The single image method selected by select_image_method
+    @param prompts - The prompts to render
+    
+    @return An iterator of (index of the prompt, url or bytes of the image)
+    """
+    results, keys, misses = cached_images(prompts)
+    for index, image in enumerate(results):
+        if image is not None:
+            yield index, image
+    futures = {worker_pool.submit("image", _render_stored, method_name, prompts, group, keys): group for group in _miss_groups(prompts, misses)}
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            images = future.result()
+        except Exception as e:
+            print(f"An exception occurred during execution: {e}")
+            continue
+        for index, image in zip(futures[future], images):
+            if image:
+                yield index, image
+
+
+async def async_iter_render_batch(method_name,
+                                  prompts: List[str]) -> AsyncIterator[tuple]:
+    """
+    Asynchronous version of iter_render_batch. method_name must be a coroutine function such as async_stabilityai_generate.
+    The cache files are read, written and evicted in the io lane instead of on the event loop.
+    """
+    results, keys, misses = await worker_pool.run("io", cached_images, prompts)
+    for index, image in enumerate(results):
+        if image is not None:
+            yield index, image
+    tasks = [asyncio.ensure_future(_async_render_stored(method_name, prompts, group, keys)) for group in _miss_groups(prompts, misses)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            try:
+                group, images = await task
+            except Exception as e:
+                print(f"An exception occurred during execution: {e}")
+                continue
+            for index, image in zip(group, images):
+                if image:
+                    yield index, image
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def render_batch(method_name,
+                 prompts: List[str]) -> List[str | bytes]:
+    """
+    Render several prompts with as few requests as the provider allows, then split the results back in the order
+    of the prompts. Requests that cannot be batched are sent with method_name, in parallel. Prompts rendered by an
+    earlier run are taken from the image cache.
+    
+    @param method_name - The single image method selected by select_image_method
+    @param prompts - The prompts to render
+    
+    @return The url or bytes of each image, None for the images that failed
+    """
+    results: List[str | bytes] = [None] * len(prompts)
+    for index, image in iter_render_batch(method_name, prompts):
+        results[index] = image
+    return results
+
+
+async def async_render_batch(method_name,
+                             prompts: List[str]) -> List[str | bytes]:
+    """
+    Asynchronous version of render_batch. method_name must be a coroutine function such as async_stabilityai_generate.
+    
+    @param method_name - The single image method selected by select_image_method
+    @param prompts - The prompts to render
+    
+    @return The url or bytes of each image, None for the images that failed
+    """
+    results: List[str | bytes] = [None] * len(prompts)
+    async for index, image in async_iter_render_batch(method_name, prompts):
+        results[index] = image
+    return results
 
 
 #==================================================================================================
@@ -179,7 +746,7 @@ def url_to_base64(url: str) -> str:
      @return The base64 string of the image or None if there was an error
     """
     try:
-        response = requests.get(url)
+        response = http_get(url)
         # Returns the image data as a base64 encoded string
         if response.status_code == 200:
             # Get the content of the response
@@ -195,6 +762,87 @@ def url_to_base64(url: str) -> str:
         return None
 
 
+# Leading bytes of the formats the providers return
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+
+def sniff_image_format(header: bytes) -> str:
+    """
+     Detect the format of an image from its first bytes, without decoding it.
+     
+     @param header - The first 12 bytes (or more) of the image
+     
+     @return "jpeg", "png", "gif", "webp" or None if the format is unknown
+    """
+    for signature, image_format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def save_as_jpg(chunks: bytes | Iterable[bytes], directory: Path) -> str:
+    """
+     Write an image to a directory as a JPEG named after the sha256 of its bytes, so the same image always has
+     the same name and is only written once. A JPEG is streamed to disk as it is, any other format is decoded
+     and converted. The file only appears once it is complete.
+     
+     @param chunks - The image data, in one piece or an iterable of pieces
+     @param directory - The directory to write to
+     
+     @return The file name of the image
+    """
+    data = None
+    if isinstance(chunks, bytes):
+        data, header = chunks, chunks[:12]
+    else:
+        chunks = iter(chunks)
+        header = b""
+        for chunk in chunks:
+            header += chunk
+            if len(header) >= 12:
+                break
+    if sniff_image_format(header) != "jpeg":
+        image = Image.open(io.BytesIO(data if data is not None else header + b"".join(chunks)))
+        # JPEG has no alpha channel or palette
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG")
+        data = buffer.getvalue()
+
+    if data is not None:
+        # Bytes in memory are named before writing, an image saved before is not written again
+        filename = content_name(hashlib.sha256(data).hexdigest(), "jpg")
+        if (directory / filename).exists():
+            return filename
+        chunks, header = iter(()), data
+
+    # A download is hashed as it is written, and renamed once its name is known
+    digest = hashlib.sha256()
+    partial = directory / f"{uuid.uuid4().hex}.part"
+    try:
+        with open(partial, "wb") as f:
+            digest.update(header)
+            f.write(header)
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+        filename = content_name(digest.hexdigest(), "jpg")
+        if not (directory / filename).exists():
+            os.replace(partial, directory / filename)
+        return filename
+    finally:
+        if partial.exists():
+            partial.unlink()
+
+
 def url_to_jpg(url: str | bytes, section: str) -> str:
     """
      Downloads and saves the image to jpg. This is used to generate the image for the user
@@ -205,89 +853,66 @@ def url_to_jpg(url: str | bytes, section: str) -> str:
      @return The filename of the image or None if there was an error
     """
     try:
+        directory = Path(workspace_path) / 'content'
+        os.makedirs(directory, exist_ok=True)
+
+        # Save the image as a .jpg file named after its content, a download is streamed to the file
         if type(url) == str:
-            response = requests.get(url)
-            if response.status_code == 200:
-                image_data = response.content
-            else:
-                print("Unable to download image")
-                return None
+            with http_get(url, stream=True) as response:
+                if response.status_code != 200:
+                    print("Unable to download image")
+                    return None
+                filename = save_as_jpg(response.iter_content(chunk_size=64 * 1024), directory)
         elif type(url) == bytes:
-            image_data = url
+            filename = save_as_jpg(url, directory)
         else:
             print("Unable to get image")
             return None
 
-        byteImgIO = io.BytesIO(image_data)
-        image = Image.open(byteImgIO)
-        directory = Path(workspace_path) / 'content'
-        os.makedirs(directory, exist_ok=True)
-
-        # Get the current timestamp and format it as a string
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
-        filename = f"{section}_{timestamp}.jpg"
-        # Save the image object as a .jpg file with the timestamp as the filename
-        image.save(directory / filename)
-
-        if memory_dir == "production":
-            campaign_id = os.getenv("CAMPAIGN_ID", "0")
-            bucket_name = os.getenv("BUCKET_NAME", None)
-
-            s3_path = str(campaign_id) + "/asset/" + filename
-            s3 = boto3.client('s3')
-            print("Uploading {}...".format(s3_path))
-            s3.upload_file(Filename=directory / filename,
-                            Bucket=bucket_name,
-                            Key=s3_path)
-            return s3_path
-        return filename
+        # The upload overlaps with the next render, main waits for it before the site is done
+        return asset_store.publish(directory / filename)
     
     except Exception as e:
         print(f"An error occurred while trying to download the image: {e}")
         return None
 
+
+async def async_url_to_jpg(url: str | bytes, section: str) -> str:
+    """
+     Asynchronous version of url_to_jpg. The download is awaited on the event loop, saving and uploading run in the io lane.
+     
+     @param url - The url of the image
+     @param section - The section of the image to be downloaded
+     
+     @return The filename of the image or None if there was an error
+    """
+    if type(url) == str:
+        client = await get_async_client()
+        try:
+            async with client.get(url) as response:
+                if response.status != 200:
+                    print("Unable to download image")
+                    return None
+                url = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"An error occurred while trying to download the image: {e}")
+            return None
+    return await worker_pool.run("io", url_to_jpg, url, section)
+
 # =======================================================================================================================
 # Image Generation
 # =======================================================================================================================
 
-def get_image(method_name,
-              keyword: str,
-              section: str,
-              topic: str,
-              industry: str) -> str:
+def image_context_messages(keyword: str,
+                           topic: str) -> List[Message]:
     """
-    Generate a context for an image. It is used to determine the location of the image and the context of the industry
+    Build the few-shot conversation used to describe an image.
     
     @param keyword - The keyword that is being viewed in the context
-    @param section - The section that is being viewed in the context
     @param topic - The topic that is being viewed in the context
-    @param industry - The industry that is being viewed in the context
     
-    @return The context of the industry as a string
-    """
-    print("Generating Context...")
-    examples = """
-    Wide shot of a sleek and modern chair design that is currently trending on Artstation, sleek and modern design, artstation trending, highly detailed, beautiful setting in the background, art by wlop, greg rutkowski, thierry doizon, charlie bowater, alphonse mucha, golden hour lighting, ultra realistic./
-    Close-up of a modern designer handbag with beautiful background, photorealistic, unreal engine, from Vogue Magazine./
-    Vintage-inspired watch an elegant and timeless design with intricate details, and detailed lighting, trending on Artstation, unreal engine, smooth finish, looking towards the viewer./
-    Close-up of modern designer a minimalist and contemporary lamp design, with clean lines and detailed lighting, trending on Artstation, detailed lighting, perfect for any contemporary space./
-    Overhead view of a sleek and futuristic concept car with aerodynamic curves, and a glossy black finish driving on a winding road with mountains in the background, sleek and stylish design, highly detailed, ultra realistic, concept art, intricate textures, interstellar background, space travel, art by alphonse mucha, greg rutkowski, ross tran, leesha hannigan, ignacio fernandez rios, kai carpenter, perfect for any casual occasion./
-    Close-up of a designer hand-crafting a sofa with intricate details, and detailed lighting, trending on Artstation, unreal engine, smooth finish./
-    Low angle shot of a modern and sleek design with reflective lenses, worn by a model standing on a city street corner with tall buildings in the background, sleek and stylish design, highly detailed, ultra realistic./
-    Saw and sawdust, blurred workshop background, 3D, digital art./
-    Easy bake oven, fisher-price, toy, bright colors, blurred playroom background, natural-lighting./
-    Fine acoustic guitar, side angle, natural lighting, bioluminescence./
-    Tained glass window of fish, side angle, rubble, dramatic-lighting, light rays, digital art./
-    Photo angles – a macro shot of the subject, or an overhead shot or a drone shot./
-    Lighting – studio lighting, indoor lighting, outdoor lighting, backlit shots. /
-    Photo lens effects – fisheye lens, double exposure /
-    """
-    prompt = f"""
-    Generate 1 short paragraph about the detailed description of an image about {keyword}.
-    The image should also be about {topic} 
-    Use these as example descriptions: {examples}
+    @return The chat messages for the image description request
     """
-
     prompt_messages: List[Message] = [
         {"role": "system",
          "content": "You are an web designer with the objective to create a stunning, unique and attractive design for the company to gain more traffic on the company's website."},
@@ -338,52 +963,178 @@ def get_image(method_name,
         {"role": "user",
          "content": f"Generate 1 short paragraph about the detailed description of an image about {keyword}. The image should also be about {topic} "}
     ]
+    return prompt_messages
+
 
-    image_context = chat_with_gpt3(prompt_messages, temp=0.7, p=0.8)
+def get_image(method_name,
+              keyword: str,
+              section: str,
+              topic: str,
+              industry: str) -> str:
+    """
+    Generate a context for an image. It is used to determine the location of the image and the context of the industry.
+    It waits on the llm and image lanes, so it runs in the stage lane or outside the worker pool.
+    
+    @param keyword - The keyword that is being viewed in the context
+    @param section - The section that is being viewed in the context
+    @param topic - The topic that is being viewed in the context
+    @param industry - The industry that is being viewed in the context
+    
+    @return The context of the industry as a string
+    """
+    print("Generating Context...")
+    prompt_messages = image_context_messages(keyword, topic)
+
+    image_context = chat_with_gpt3(prompt_messages, temp=0.7, p=0.8, cache=False, stage="Image Description Generation", hedge=True)
     # print(image_context)
-    image_context += "Detailed 4K photorealistic. No fonts or text."
-    imageurl = method_name(image_context)
-    if image_model == "dalle":
+    return render_image(method_name, image_context, section)
+
+
+def image_prompt(image_context: str) -> str:
+    """
+    Build the prompt sent to the image model from an image description.
+    
+    @param image_context - The description of the image
+    
+    @return The image prompt
+    """
+    return image_context + "Detailed 4K photorealistic. No fonts or text."
+
+
+def render_image(method_name,
+                 image_context: str,
+                 section: str) -> str:
+    """
+    Render an image description with the selected image method and save it.
+    
+    @param image_context - The description of the image
+    @param section - The section the image is for
+    
+    @return The filename of the image or None if there was an error
+    """
+    imageurl = cached_render(method_name, image_prompt(image_context))
+    if image_model == "dalle" and type(imageurl) == str:
         print(imageurl)
     image_jpg = url_to_jpg(imageurl, section)
     # image_base64 = url_to_base64(imageurl)
     return image_jpg
 
 
-def generate_logo(method_name,
-                  keyword: str,
-                  section: str,
-                  topic: str,
-                  industry: str) -> str:
+def generate_image_descriptions(keyword: str,
+                                topic: str,
+                                count: int) -> List[str]:
     """
-    Generate a logo for a company. This is a function that can be used to generate a logo for an industry that provides a topic and keyword
+    Generate several distinct image descriptions in a single request, sending the few-shot conversation once
+    instead of once per image. Duplicate or empty choices are requested again once.
     
-    @param topic - The topic to generate a logo for
-    @param keyword - The keyword to generate a logo for
-    @param industry - The industry for which we want to generate a logo
+    @param keyword - The keyword that is being viewed in the context
+    @param topic - The topic that is being viewed in the context
+    @param count - The number of descriptions
     
-    @return The path to the generated logo or None if none
+    @return Up to count distinct descriptions
+    """
+    print("Generating Context...")
+    prompt_messages = image_context_messages(keyword, topic)
+    descriptions = []
+    for _ in range(2):
+        choices = chat_choices_with_gpt3(prompt_messages, count - len(descriptions), temp=0.7, p=0.8, stage="Image Description Generation")
+        descriptions.extend(unique_descriptions(choices, descriptions))
+        if len(descriptions) >= count:
+            break
+    return descriptions[:count]
+
+
+async def async_generate_image_descriptions(keyword: str,
+                                            topic: str,
+                                            count: int) -> List[str]:
     """
+    Asynchronous version of generate_image_descriptions.
     
-    print("Generating Logo")
-    prompt = f"""
-    Describe the details and design of a logo for the company that provides {topic} in the {industry} industry.
-    Only talk about the objects and the color.
-    Example: 
-    "Flat vector logo of a curved wave, blue, trending on Dribble"/
-    "Line art logo of a owl, golden, minimal, solid black background"/
-    "Gradient color logo, a gradient in 2 circles"/
-    "Geometrical logo of a pyramid, dreamy pastel color palette, gradient color"
-    "Organic logo, shape of a leaf"/
-    "Typographical logo, floral, letter” A”, serif typeface"/
-    "Emblem of chess team, royal, coat of arms, golden color, knight"
-    "hamburger 3D logo, very cute shape, miniature small scale painting style, minimalism, lite object style, up view, matte, white background, soft round form, ultra high definition details, 8k"/
-    "Minimal logo of a cafe, a coffee bean, gradient brown color"/
-    "Graphic logo of a red wine company, eagle, modern, classy, high end, red and gold — v 5"
-    "A 2d, symmetrical, flat logo for a blockchain company that is sleek and simple. It should be of black shade and should be subtle."/ 
-    Write it in a few sentences.
+    @param keyword - The keyword that is being viewed in the context
+    @param topic - The topic that is being viewed in the context
+    @param count - The number of descriptions
+    
+    @return Up to count distinct descriptions
+    """
+    print("Generating Context...")
+    prompt_messages = image_context_messages(keyword, topic)
+    descriptions = []
+    for _ in range(2):
+        choices = await async_chat_choices_with_gpt3(prompt_messages, count - len(descriptions), temp=0.7, p=0.8, stage="Image Description Generation")
+        descriptions.extend(unique_descriptions(choices, descriptions))
+        if len(descriptions) >= count:
+            break
+    return descriptions[:count]
+
+
+def unique_descriptions(choices: List[str],
+                        known: List[str]) -> List[str]:
     """
+    Keep the non-empty choices that are not already known.
     
+    @param choices - The generated descriptions
+    @param known - The descriptions kept so far
+    
+    @return The new distinct descriptions
+    """
+    seen = {description.strip().lower() for description in known}
+    unique = []
+    for choice in choices:
+        normalized = (choice or "").strip().lower()
+        if normalized and normalized not in seen:
+            seen.add(normalized)
+            unique.append(choice.strip())
+    return unique
+
+
+async def async_get_image(method_name,
+                          keyword: str,
+                          section: str,
+                          topic: str,
+                          industry: str) -> str:
+    """
+    Asynchronous version of get_image. method_name must be a coroutine function such as async_stabilityai_generate.
+    
+    @param keyword - The keyword that is being viewed in the context
+    @param section - The section that is being viewed in the context
+    @param topic - The topic that is being viewed in the context
+    @param industry - The industry that is being viewed in the context
+    
+    @return The filename of the image or None if there was an error
+    """
+    print("Generating Context...")
+    prompt_messages = image_context_messages(keyword, topic)
+    image_context = await async_chat_with_gpt3(prompt_messages, temp=0.7, p=0.8, cache=False, stage="Image Description Generation", hedge=True)
+    return await async_render_image(method_name, image_context, section)
+
+
+async def async_render_image(method_name,
+                             image_context: str,
+                             section: str) -> str:
+    """
+    Asynchronous version of render_image. method_name must be a coroutine function such as async_stabilityai_generate.
+    
+    @param image_context - The description of the image
+    @param section - The section the image is for
+    
+    @return The filename of the image or None if there was an error
+    """
+    imageurl = await async_cached_render(method_name, image_prompt(image_context))
+    if image_model == "dalle" and type(imageurl) == str:
+        print(imageurl)
+    return await async_url_to_jpg(imageurl, section)
+
+
+def logo_context_messages(topic: str,
+                          industry: str) -> List[Message]:
+    """
+    Build the few-shot conversation used to describe a logo.
+    
+    @param topic - The topic to generate a logo for
+    @param industry - The industry for which we want to generate a logo
+    
+    @return The chat messages for the logo description request
+    """
     prompt_messages: List[Message] = [
         {"role": "system",
          "content": "You are an web designer with the objective to create a stunning and unique logo to attract the attention of people."},
@@ -450,25 +1201,119 @@ def generate_logo(method_name,
         {"role": "user",
          "content": f"Describe the details and design of a logo for the companythat provides {topic} in the {industry} industry."}
     ]
-    logo_context = chat_with_gpt3(prompt_messages, temp=0.7, p=0.8)
+    return prompt_messages
+
+
+def generate_logo(method_name,
+                  keyword: str,
+                  section: str,
+                  topic: str,
+                  industry: str) -> str:
+    """
+    Generate a logo for a company. This is a function that can be used to generate a logo for an industry that provides a topic and keyword
+    
+    @param topic - The topic to generate a logo for
+    @param keyword - The keyword to generate a logo for
+    @param industry - The industry for which we want to generate a logo
+    
+    @return The path to the generated logo or None if none
+    """
+    
+    print("Generating Logo")
+    prompt_messages = logo_context_messages(topic, industry)
+    logo_context = chat_with_gpt3(prompt_messages, temp=0.7, p=0.8, cache=False, stage="Logo Description Generation")
     logo_context += " with no text. No fonts included."
     print(logo_context)
     # logo_context = "The newest f1 car but perodua brand"
-    imageurl = method_name(logo_context)
-    if image_model == "dalle":
+    imageurl = cached_render(method_name, logo_context)
+    if image_model == "dalle" and type(imageurl) == str:
         print(imageurl)
     image_jpg = url_to_jpg(imageurl, section="logo")
     # image_base = url_to_base64(imageurl)
     return image_jpg
+
+
+async def async_generate_logo(method_name,
+                              keyword: str,
+                              section: str,
+                              topic: str,
+                              industry: str) -> str:
+    """
+    Asynchronous version of generate_logo. method_name must be a coroutine function such as async_stabilityai_generate.
+    
+    @param topic - The topic to generate a logo for
+    @param keyword - The keyword to generate a logo for
+    @param industry - The industry for which we want to generate a logo
+    
+    @return The path to the generated logo or None if none
+    """
+    print("Generating Logo")
+    prompt_messages = logo_context_messages(topic, industry)
+    logo_context = await async_chat_with_gpt3(prompt_messages, temp=0.7, p=0.8, cache=False, stage="Logo Description Generation")
+    logo_context += " with no text. No fonts included."
+    print(logo_context)
+    imageurl = await async_cached_render(method_name, logo_context)
+    if image_model == "dalle" and type(imageurl) == str:
+        print(imageurl)
+    return await async_url_to_jpg(imageurl, section="logo")
+    
+    
+def _save_unique(data: bytes, section: str, seen: HashIndex) -> str:
+    try:
+        image_hash = dhash(data)
+    except (OSError, ValueError) as e:
+        print(f"Unable to read {section}: {e}")
+        return None
+    duplicate = seen.add(section, image_hash, unique=True)
+    if duplicate is not None:
+        print(f"{section} is a near-duplicate of {duplicate}")
+        return None
+    filename = url_to_jpg(data, section)
+    if filename:
+        gallery_index.add(filename, image_hash)
+    return filename
+
+
+def save_gallery_image(image: str | bytes,
+                       section: str,
+                       seen: HashIndex) -> str:
+    """
+    Save a gallery image unless it is a near-duplicate of an image already kept for the gallery, comparing their
+    perceptual hashes. Kept images are also added to gallery_index, shared by every site of the process.
     
+    @param image - The url or bytes returned by the image method
+    @param section - The name of the image
+    @param seen - The hashes of the images already kept for the gallery
     
+    @return The filename of the image, or None if it is a near-duplicate or could not be saved
+    """
+    if gallery_dedup == "off":
+        return url_to_jpg(image, section)
+    data = download_image(image)
+    return _save_unique(data, section, seen) if data else None
+
+
+async def async_save_gallery_image(image: str | bytes,
+                                   section: str,
+                                   seen: HashIndex) -> str:
+    """
+    Asynchronous version of save_gallery_image.
+    """
+    if gallery_dedup == "off":
+        return await async_url_to_jpg(image, section)
+    data = await async_download_image(image)
+    return await worker_pool.run("io", _save_unique, data, section, seen) if data else None
+
+
 def generate_gallery_images(method_name,
                             keyword: str,
                             section: str,
                             topic: str, 
                             industry: str) -> List[str]:
     """
-        Generate gallery images for a company. This is a thread safe function to call get_image in parallel
+        Generate gallery images for a company. The descriptions of all the images are generated in one request,
+        then the images are rendered in as few requests as the provider allows and saved in parallel. Images that
+        are near-duplicates of another gallery image are dropped and rendered again from new descriptions
         
         @param company_name - The company's name
         @param keyword - The generated keyword
@@ -478,33 +1323,66 @@ def generate_gallery_images(method_name,
         @return A list of image ids that were generated from DALL E 
     """
     gallery = []
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(get_image, method_name, keyword, f"gallery{i}", topic, industry): i for i in range(8)}
+    seen = HashIndex()
+    for attempt in range(1 + gallery_rerenders):
+        descriptions = generate_image_descriptions(keyword, topic, gallery_size - len(gallery))
+        # Each image is checked and saved as soon as it is rendered
+        prompts = [image_prompt(description) for description in descriptions]
+        futures = [worker_pool.submit("io", save_gallery_image, image, f"gallery{len(gallery) + index}", seen)
+                   for index, image in iter_render_batch(method_name, prompts)]
 
         # Get the result of all futures in concurrent. futures. as_completed.
         for future in concurrent.futures.as_completed(futures):
             try:
                 result = future.result()  # Get the result of the future
-                gallery.append(result)
+                if result:
+                    gallery.append(result)
             except Exception as e:
                 print(f"An exception occurred during execution: {e}")
+        if len(gallery) >= gallery_size:
+            break
+        print(f"Rendering {gallery_size - len(gallery)} gallery images again")
     return gallery
 
 
-def image_generation(topic: str,
-                     industry: str,
-                     keyword: str) -> Dict:
+async def async_generate_gallery_images(method_name,
+                                        keyword: str,
+                                        section: str,
+                                        topic: str,
+                                        industry: str) -> List[str]:
     """
-    Generates images for a topic industry and keyword. This function is used to generate a json file that can be uploaded to Snapchat
-    
-    @param topic - User's keyword
-    @param industry - The industry of topic
-    @param keyword - The keyword that will be used for the image generation
+        Asynchronous version of generate_gallery_images. The images are rendered concurrently on the running event loop.
+        
+        @param keyword - The generated keyword
+        @param topic - User's keyword
+        @param industry - The industry of the topic
+        
+        @return A list of image ids that were generated
+    """
+    gallery = []
+    seen = HashIndex()
+    for attempt in range(1 + gallery_rerenders):
+        descriptions = await async_generate_image_descriptions(keyword, topic, gallery_size - len(gallery))
+        prompts = [image_prompt(description) for description in descriptions]
+        tasks = [asyncio.ensure_future(async_save_gallery_image(image, f"gallery{len(gallery) + index}", seen))
+                 async for index, image in async_iter_render_batch(method_name, prompts)]
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(f"An exception occurred during execution: {result}")
+            elif result:
+                gallery.append(result)
+        if len(gallery) >= gallery_size:
+            break
+        print(f"Rendering {gallery_size - len(gallery)} gallery images again")
+    return gallery
+
+
+def new_image_json() -> Dict:
+    """
+    Create the empty image dict filled in by image_generation.
     
-    @return A dict with the name of image for each entry
+    @return A dict with an empty image entry for each section
     """
-    print("Starting Image Process...")
     image_json = {
         "logo": {
             "image": ""
@@ -531,35 +1409,161 @@ def image_generation(topic: str,
             }
         
     }
+    return image_json
+
+
+def generate_variants(image_json: Dict) -> Dict[str, List[Dict]]:
+    """
+    Create the responsive variants of every image of the site, resized to the widths of its slot. The encoding
+    runs in the process pool so the images are encoded in parallel.
+    
+    @param image_json - The dict returned by image_generation
     
+    @return The variants of each image by file name, for the srcset of the layouts
+    """
+    if image_variants == "off":
+        return {}
+    directory = Path(workspace_path) / 'content'
+    futures = {}
+    for section, entry in image_json.items():
+        images = entry["image"] if isinstance(entry["image"], list) else [entry["image"]]
+        for file_name in images:
+            if file_name and file_name not in futures.values():
+                path = directory / os.path.basename(file_name)
+                futures[worker_pool.submit_process(make_variants, str(path), SLOT_WIDTHS.get(section, ()))] = file_name
+
+    variants = {}
+    for future in concurrent.futures.as_completed(futures):
+        file_name = futures[future]
+        try:
+            variants[file_name] = future.result()
+        except Exception as e:
+            print(f"Unable to create the variants of {file_name}: {e}")
+            continue
+        for variant in variants[file_name]:
+            # The full-size JPEG is the image itself, published and counted already
+            if variant["file_name"] != os.path.basename(file_name):
+                variant["file_name"] = asset_store.publish(directory / variant["file_name"])
+            else:
+                variant["file_name"] = file_name
+    return variants
+
+
+async def async_generate_variants(image_json: Dict) -> Dict[str, List[Dict]]:
+    """
+    Asynchronous version of generate_variants, waiting on the process pool from the stage lane.
+    """
+    return await worker_pool.run("stage", generate_variants, image_json)
+
+
+def asset_keys(image_json: Dict, variants: Dict[str, List[Dict]] = None) -> List[str]:
+    """
+    List the assets a site refers to, to wait for their uploads.
+    
+    @param image_json - The dict returned by image_generation
+    @param variants - The dict returned by generate_variants
+    
+    @return The keys of the images and of their variants
+    """
+    keys = []
+    for entry in image_json.values():
+        images = entry["image"] if isinstance(entry["image"], list) else [entry["image"]]
+        keys.extend(file_name for file_name in images if file_name)
+    for entries in (variants or {}).values():
+        keys.extend(variant["file_name"] for variant in entries)
+    return list(dict.fromkeys(keys))
+
+
+def select_image_method(asynchronous: bool = False):
+    """
+    Select the image generation function for the configured IMAGE_MODEL.
+    
+    @param asynchronous - Return the coroutine version of the function
+    
+    @return The function used to render an image from a prompt
+    """
     if image_model == "stabilityai":
-        method_name = stabilityai_generate
+        return async_stabilityai_generate if asynchronous else stabilityai_generate
     elif image_model == "dalle":
-        method_name = chat_with_dall_e
+        return async_chat_with_dall_e if asynchronous else chat_with_dall_e
+    elif image_model == "local":
+        return async_local_generate if asynchronous else local_generate
     else:
         print("Invalid Model")
         raise NotImplementedError
-    image_json["logo"]["image"] = generate_logo(method_name, keyword, "Logo", topic, industry)
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Start the threads and collect the futures for non-gallery sections
-       
-        futures = {executor.submit(get_image, method_name, keyword, section, topic, industry): section for section in ["banner", "about", "contactus", "blog2"]}
 
-        # Add the gallery futures
 
-        # Returns the image url of the image.
-        for future in concurrent.futures.as_completed(futures):
-            section = futures[future]
-            try:
-                image: str = future.result()
-            except Exception as exc:
-                print('%r generated an exception: %s' % (section, exc))
-            else:
-                # Set image_url to the image_json section
-                if image:
-                    image_json[section]["image"] = image
+def image_generation(topic: str,
+                     industry: str,
+                     keyword: str) -> Dict:
+    """
+    Generates images for a topic industry and keyword. This function is used to generate a json file that can be uploaded to Snapchat
+    
+    @param topic - User's keyword
+    @param industry - The industry of topic
+    @param keyword - The keyword that will be used for the image generation
+    
+    @return A dict with the name of image for each entry
+    """
+    print("Starting Image Process...")
+    image_json = new_image_json()
+    method_name = select_image_method()
+    image_json["logo"]["image"] = generate_logo(method_name, keyword, "Logo", topic, industry)
+    # The descriptions are generated here, an image lane thread must not wait on the llm lane. The renders of the
+    # non-gallery sections then start in the shared image lane
+    sections = ["banner", "about", "contactus", "blog2"]
+    descriptions = generate_image_descriptions(keyword, topic, len(sections))
+    futures = {worker_pool.submit("image", render_image, method_name, description, section): section for section, description in zip(sections, descriptions)}
+
+    # Returns the image url of the image.
+    for future in concurrent.futures.as_completed(futures):
+        section = futures[future]
+        try:
+            image: str = future.result()
+        except Exception as exc:
+            print('%r generated an exception: %s' % (section, exc))
+        else:
+            # Set image_url to the image_json section
+            if image:
+                image_json[section]["image"] = image
                     
     image_json["gallery"]["image"] = (generate_gallery_images(method_name, keyword, "gallery", topic, industry))            
         
     print("Images Generated")
     return image_json
+
+
+async def async_image_generation(topic: str,
+                                 industry: str,
+                                 keyword: str) -> Dict:
+    """
+    Asynchronous version of image_generation. The logo, the sections and the gallery are all generated concurrently.
+    
+    @param topic - User's keyword
+    @param industry - The industry of topic
+    @param keyword - The keyword that will be used for the image generation
+    
+    @return A dict with the name of image for each entry
+    """
+    print("Starting Image Process...")
+    image_json = new_image_json()
+    method_name = select_image_method(asynchronous=True)
+    sections = ["banner", "about", "contactus", "blog2"]
+    logo, gallery, *images = await asyncio.gather(
+        async_generate_logo(method_name, keyword, "Logo", topic, industry),
+        async_generate_gallery_images(method_name, keyword, "gallery", topic, industry),
+        *(async_get_image(method_name, keyword, section, topic, industry) for section in sections),
+        return_exceptions=True,
+    )
+    if isinstance(logo, Exception):
+        print('%r generated an exception: %s' % ("logo", logo))
+    else:
+        image_json["logo"]["image"] = logo
+    for section, image in zip(sections, images):
+        if isinstance(image, Exception):
+            print('%r generated an exception: %s' % (section, image))
+        elif image:
+            image_json[section]["image"] = image
+    image_json["gallery"]["image"] = gallery if not isinstance(gallery, Exception) else []
+    print("Images Generated")
+    return image_json
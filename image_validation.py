@@ -0,0 +1,101 @@
+import io
+import json
+import os
+import random
+from typing import Optional
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Renders of one image before its section is left empty
+image_render_attempts = int(os.getenv("IMAGE_RENDER_ATTEMPTS", "3"))
+# Longest wait before rendering an invalid image again, whatever the provider estimates
+image_max_backoff = float(os.getenv("IMAGE_MAX_BACKOFF", "60"))
+# Images whose grayscale standard deviation is below this are blank
+image_min_stddev = float(os.getenv("IMAGE_MIN_STDDEV", "3"))
+# Blank images darker than this mean brightness are the all-black images of the safety filter
+image_black_level = float(os.getenv("IMAGE_BLACK_LEVEL", "16"))
+
+#==================================================================================================
+# Image Validation
+#==================================================================================================
+
+
+class InvalidImage(Exception):
+    """
+     A rendered image that cannot be used. retry_after is the number of seconds the provider asked to wait
+     before trying again, if it said.
+    """
+
+    def __init__(self, reason: str, retry_after: Optional[float] = None):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def provider_error(data: bytes) -> Optional[InvalidImage]:
+    """
+     Parse the JSON error body a provider returned instead of an image, such as the HuggingFace
+     {"error": "Model ... is currently loading", "estimated_time": 20.0}.
+
+     @param data - The response body
+
+     @return The error, or None if the body is not a JSON error
+    """
+    if not data.lstrip().startswith(b"{"):
+        return None
+    try:
+        body = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    error = body.get("error")
+    if isinstance(error, dict):
+        error = error.get("message")
+    estimated_time = body.get("estimated_time")
+    return InvalidImage(f"Provider error: {error or body}",
+                        float(estimated_time) if isinstance(estimated_time, (int, float)) else None)
+
+
+def validate_image(data: Optional[bytes]) -> None:
+    """
+     Check that a rendered image is usable: not empty, not an error payload, decodable and not blank. The pixel
+     checks run on a small grayscale version of the image.
+
+     @param data - The image bytes
+
+     @raise InvalidImage - With the reason the image was rejected
+    """
+    if not data:
+        raise InvalidImage("Empty response")
+    error = provider_error(data)
+    if error is not None:
+        raise error
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft("L", (64, 64))
+            pixels = np.asarray(image.convert("L").resize((64, 64)), dtype=np.float32)
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        raise InvalidImage(f"Not an image: {e}")
+    if pixels.std() < image_min_stddev:
+        if pixels.mean() < image_black_level:
+            raise InvalidImage("Black image, the prompt was probably filtered")
+        raise InvalidImage("Blank image")
+
+
+def render_backoff(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+     Seconds to wait before rendering an invalid image again: the time the provider estimated if it gave one,
+     exponential backoff with jitter otherwise.
+
+     @param attempt - The number of invalid renders so far, starting at 0
+     @param retry_after - The seconds the provider asked to wait
+
+     @return The delay in seconds
+    """
+    if retry_after is not None:
+        return min(image_max_backoff, retry_after)
+    return random.uniform(0, min(image_max_backoff, 2 ** attempt))
@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List
+from PIL import Image
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Set to "off" to only keep the full-size images
+image_variants = os.getenv("IMAGE_VARIANTS", "on")
+# Formats of the variants, listed for srcset in this order
+variant_formats = [name.strip() for name in os.getenv("IMAGE_VARIANT_FORMATS", "webp,jpeg").split(",") if name.strip()]
+variant_quality = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+
+#==================================================================================================
+# Responsive Variants
+#==================================================================================================
+
+# Widths the layouts display each slot at, the full-size image is kept as the largest width
+SLOT_WIDTHS: Dict[str, tuple] = {
+    "logo": (128, 256),
+    "banner": (640, 1024),
+    "about": (480, 768),
+    "contactus": (480, 768),
+    "blog2": (480, 768),
+    # Shown 4 per row
+    "gallery": (320, 640),
+}
+# Extension, MIME type and encoder options of each format. WebP method 2 encodes about twice as fast as the
+# default 4 for nearly the same size
+FORMATS: Dict[str, tuple] = {
+    "webp": ("webp", "image/webp", {"method": 2}),
+    "jpeg": ("jpg", "image/jpeg", {"optimize": True}),
+}
+
+
+def make_variants(path: str,
+                  widths: Iterable[int],
+                  formats: Iterable[str] = tuple(variant_formats),
+                  quality: int = variant_quality) -> List[Dict]:
+    """
+     Write the width-stepped variants of an image next to it. Runs in a worker process, the image is decoded
+     once and every variant is resized from it. The variants are named after the image, which is named after
+     its content, and the encoder quality, so a variant already on disk is the same file and is not encoded
+     again.
+
+     @param path - The full-size image
+     @param widths - The widths to produce, those not smaller than the image are skipped
+     @param formats - Names from FORMATS
+     @param quality - The encoder quality of the variants
+
+     @return One dict per variant with the file name, the width, the height and the MIME type
+    """
+    path = Path(path)
+    with Image.open(path) as image:
+        image.load()
+        original_width, original_height = image.size
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        variants = []
+        for width in sorted({width for width in widths if width < original_width} | {original_width}):
+            height = max(1, round(original_height * width / original_width))
+            resized = None
+            for name in formats:
+                extension, mime_type, options = FORMATS[name]
+                if width == original_width and name == "jpeg" and path.suffix.lower() in (".jpg", ".jpeg"):
+                    # The full-size JPEG is the image itself
+                    file_name = path.name
+                else:
+                    file_name = f"{path.stem}_{width}w_q{quality}.{extension}"
+                    target = path.with_name(file_name)
+                    if not target.exists():
+                        if resized is None:
+                            resized = image if width == original_width else image.resize((width, height), Image.LANCZOS)
+                        partial = target.with_name(target.name + f".{os.getpid()}.part")
+                        resized.save(partial, name.upper(), quality=quality, **options)
+                        os.replace(partial, target)
+                variants.append({"file_name": file_name, "width": width, "height": height, "type": mime_type})
+    return variants
@@ -0,0 +1,98 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from package_alias import PACKAGE_ALIAS
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Seconds a cold import of the pipeline may take
+import_time_budget = float(os.getenv("IMPORT_TIME_BUDGET", "1.0"))
+# Modules that must only be imported on first use
+DEFERRED_MODULES = ("diffusers", "torch", "boto3")
+
+#==================================================================================================
+# Import-Time Benchmark
+#==================================================================================================
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The checkout directory may not be a valid module name, the child imports the modules through the package alias
+REGISTER = """
+import sys
+sys.path.insert(0, {package_dir!r})
+from package_alias import PACKAGE_ALIAS, register_package
+register_package()
+"""
+
+MEASURE = REGISTER + """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(",".join(name for name in {deferred!r} if name in sys.modules))
+"""
+
+
+def measure_import(module: str) -> tuple:
+    """
+     Import a module in a fresh interpreter, without any network access being needed.
+
+     @param module - The dotted module name, e.g. "seo_package.main"
+
+     @return The import time in seconds and the deferred modules it loaded anyway
+    """
+    result = subprocess.run([sys.executable, "-c", MEASURE.format(package_dir=package_dir, module=module, deferred=DEFERRED_MODULES)],
+                            cwd=os.path.dirname(package_dir), capture_output=True, text=True, check=True)
+    seconds, loaded = result.stdout.splitlines()[-2:]
+    return float(seconds), [name for name in loaded.split(",") if name]
+
+
+def slowest_imports(module: str, count: int = 10) -> list:
+    """
+     List the modules taking the longest to import, from python -X importtime.
+
+     @return (cumulative microseconds, module name) pairs
+    """
+    code = REGISTER.format(package_dir=package_dir) + f"import {module}"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=os.path.dirname(package_dir), capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the pipeline modules")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=import_time_budget)
+    parser.add_argument("--verbose", action="store_true", help="List the slowest imports")
+    args = parser.parse_args()
+
+    failed = False
+    for name in ("content_main", "image_main", "main"):
+        module = f"{PACKAGE_ALIAS}.{name}"
+        samples, loaded = [], []
+        for _ in range(args.runs):
+            seconds, loaded = measure_import(module)
+            samples.append(seconds)
+        median = statistics.median(samples)
+        status = "ok" if median <= args.budget and not loaded else "FAIL"
+        print(f"{module}: {round(median * 1000)} ms (budget {round(args.budget * 1000)} ms) {status}")
+        if loaded:
+            print(f"  imported at startup: {', '.join(loaded)}")
+        failed = failed or status == "FAIL"
+        if args.verbose:
+            for microseconds, imported in slowest_imports(module):
+                print(f"  {round(microseconds / 1000, 1):>8} ms {imported}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
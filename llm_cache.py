@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Disable the cache with LLM_CACHE=off
+cache_enabled = os.getenv("LLM_CACHE", "on").lower() not in ("0", "off", "false", "no")
+# Entries older than this many seconds are ignored and removed (0 disables expiry)
+cache_ttl = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 60 * 60)))
+# Least recently used entries are evicted above this many rows
+cache_max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+# Share of max_entries evicted at once, so that the writes in between do not evict anything
+cache_evict_fraction = float(os.getenv("LLM_CACHE_EVICT_FRACTION", "0.1"))
+
+#==================================================================================================
+# Response Cache
+#==================================================================================================
+
+
+def make_key(request: Dict) -> str:
+    """
+     Hash a request into a cache key. The request is serialised to canonical JSON (sorted keys, floats for
+     sampling parameters) so that equivalent requests always produce the same key.
+
+     @param request - The request parameters (model, messages, temperature, top_p, ...)
+
+     @return The hex sha256 digest of the normalized request
+    """
+    normalized = {key: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+                  for key, value in request.items()}
+    payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+     Persistent SQLite cache for LLM responses with a TTL and size bounded LRU eviction.
+     The connection is opened lazily and shared between threads behind a lock.
+     Eviction only runs when a write takes the cache over max_entries, and then removes the expired entries and
+     the least recently used ones down to evict_fraction below the limit.
+    """
+
+    def __init__(self, path: str, ttl: float = cache_ttl, max_entries: int = cache_max_entries, enabled: bool = cache_enabled,
+                 evict_fraction: float = cache_evict_fraction):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.evict_batch = max(1, int(max_entries * evict_fraction))
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        # Number of rows, counted when the connection is opened and kept up to date by the writes
+        self._count = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            connection.commit()
+            self._count = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            self._connection = connection
+        return self._connection
+
+    def get(self, key: str) -> Optional[str]:
+        """
+         Look up a cached response.
+
+         @param key - The key returned by make_key
+
+         @return The cached response or None on a miss
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                row = connection.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                value, created_at = row
+                if self.ttl and now - created_at > self.ttl:
+                    connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    connection.commit()
+                    self._count -= 1
+                    return None
+                connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                connection.commit()
+                return value
+        except sqlite3.Error as e:
+            print(f"Response cache unavailable: {e}")
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        """
+         Store a response, evicting a batch of entries if the cache is over max_entries.
+
+         @param key - The key returned by make_key
+         @param value - The response to store
+        """
+        if not self.enabled or value is None:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                exists = connection.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+                connection.execute("INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                                   (key, value, now, now))
+                if not exists:
+                    self._count += 1
+                if self.max_entries > 0 and self._count > self.max_entries:
+                    self._evict(connection, now)
+                connection.commit()
+        except sqlite3.Error as e:
+            print(f"Response cache unavailable: {e}")
+
+    def _evict(self, connection: sqlite3.Connection, now: float) -> None:
+        if self.ttl:
+            connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        # Other processes may share the file, recount before evicting
+        count = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            connection.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed_at LIMIT ?
+                )
+            """, (count - max(0, self.max_entries - self.evict_batch),))
+        self._count = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self) -> None:
+        """
+         Remove every cached response.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM responses")
+            connection.commit()
+            self._count = 0
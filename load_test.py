@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+#==================================================================================================
+# Load Test
+#==================================================================================================
+
+
+async def run_site(index: int, semaphore: asyncio.Semaphore, latencies: list, failures: list) -> None:
+    from .main import async_generate_site
+
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            result = await async_generate_site(f"Company {index}", f"Topic {index}")
+            if result is None:
+                raise ValueError("No results returned")
+            latencies.append(time.monotonic() - start)
+        except Exception as e:
+            print(f"Site {index} failed: {e}")
+            failures.append(index)
+
+
+async def load_test(sites: int, concurrency: int, port: int) -> None:
+    """
+     Generate sites against the fake API server and report the throughput.
+
+     @param sites - Number of sites to generate
+     @param concurrency - Number of sites generated at the same time
+     @param port - Port of the in-process fake server, used when FAKE_API_SERVER is not set
+    """
+    stop_server = None
+    if not os.getenv("FAKE_API_SERVER"):
+        from .fake_server import start_server
+        stop_server = start_server(port=port)
+        os.environ["FAKE_API_SERVER"] = f"http://127.0.0.1:{port}"
+    # Every site must reach the server, and the real account limits do not apply
+    os.environ.setdefault("LLM_CACHE", "off")
+    os.environ.setdefault("IMAGE_CACHE", "off")
+    os.environ.setdefault("OPENAI_RPM", "0")
+    os.environ.setdefault("OPENAI_TPM", "0")
+    os.environ.setdefault("OPENAI_IMAGE_RPM", "0")
+    # The HuggingFace backend, which the fake server provides, whatever .env selects
+    os.environ.setdefault("IMAGE_MODEL", "stabilityai")
+    # The fake server accepts a list of inputs, so the batched requests are load tested too
+    os.environ.setdefault("HF_BATCH_SIZE", "4")
+
+    from .concurrency import concurrency_metrics
+    from .content_main import close_async_session
+    from .image_hash import gallery_index
+    from .worker_pool import worker_pool
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, failures = [], []
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(run_site(index, semaphore, latencies, failures) for index in range(sites)))
+    finally:
+        await close_async_session()
+        if stop_server is not None:
+            stop_server()
+    elapsed = time.monotonic() - start
+
+    print(f"{len(latencies)} of {sites} sites in {round(elapsed, 2)} seconds, {round(len(latencies) * 60 / elapsed, 2)} sites per minute")
+    if latencies:
+        latencies.sort()
+        print(f"Site latency p50 {round(statistics.median(latencies), 2)}s, p95 {round(latencies[int(0.95 * (len(latencies) - 1))], 2)}s, max {round(latencies[-1], 2)}s")
+    for metrics in concurrency_metrics():
+        print(f"Concurrency {metrics['name']}: window {metrics['window']}, overloads {metrics['overloads']}")
+    for metrics in worker_pool.metrics():
+        print(f"Lane {metrics['name']}: peak {metrics['peak']} of {metrics['workers']} workers")
+    print(f"Gallery near-duplicates across sites: {len(gallery_index.duplicates())} pairs in {len(gallery_index)} images")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the site pipeline against the fake API server")
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    asyncio.run(load_test(args.sites, args.concurrency, args.port))
+
+
+if not __package__:
+    # Run as a script, the modules are imported through the package alias. This also runs in the spawned worker
+    # processes, which import this file again to unpickle their tasks
+    import importlib
+    from package_alias import register_package
+    register_package()
+
+
+if __name__ == "__main__":
+    if __package__:
+        main()
+    else:
+        importlib.import_module("seo_package.load_test").main()
@@ -0,0 +1,168 @@
+import concurrent.futures
+import io
+import os
+import threading
+from typing import Callable, List, Tuple
+from .worker_pool import diffusion_workers, worker_pool
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Any Stable Diffusion checkpoint of the HuggingFace Hub or a local directory. A tiny pipeline such as
+# hf-internal-testing/tiny-stable-diffusion-pipe renders noise in a fraction of a second, for tests
+local_model_id = os.getenv("LOCAL_MODEL_ID", "stabilityai/stable-diffusion-2-1-base")
+# "cuda", "mps" or "cpu", the GPU when there is one if empty
+local_device = os.getenv("LOCAL_DEVICE", "")
+# The Euler scheduler gives usable images in far fewer steps than the default 50
+local_inference_steps = int(os.getenv("LOCAL_INFERENCE_STEPS", "20"))
+local_guidance_scale = float(os.getenv("LOCAL_GUIDANCE_SCALE", "7.5"))
+# Width and height of the renders, the size the model was trained at
+local_image_size = int(os.getenv("LOCAL_IMAGE_SIZE", "512"))
+# Prompts rendered in one forward pass, and how long a prompt waits for others to join its batch
+local_batch_size = int(os.getenv("LOCAL_BATCH_SIZE", "4"))
+local_batch_window = float(os.getenv("LOCAL_BATCH_WINDOW_MS", "50")) / 1000
+# Compute attention in slices, slower but with a fraction of the peak memory
+local_attention_slicing = os.getenv("LOCAL_ATTENTION_SLICING", "on")
+
+#==================================================================================================
+# Pipeline
+#==================================================================================================
+
+# The pipeline of the current worker process, loaded by its first batch
+_pipeline = None
+
+
+def load_pipeline():
+    """
+     Load the Stable Diffusion pipeline of this process once. diffusers and torch are imported here, so that
+     only the diffusion worker processes pay for them.
+
+     @return The StableDiffusionPipeline
+    """
+    global _pipeline
+    if _pipeline is None:
+        import torch
+        from diffusers import EulerDiscreteScheduler, StableDiffusionPipeline
+        device = local_device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if device == "cpu":
+            # Share the cores between the worker processes instead of each one using all of them
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, diffusion_workers)))
+        scheduler = EulerDiscreteScheduler.from_pretrained(local_model_id, subfolder="scheduler")
+        # Half precision only on the GPU, most CPU kernels have no float16 version
+        pipeline = StableDiffusionPipeline.from_pretrained(local_model_id, scheduler=scheduler,
+                                                           torch_dtype=torch.float16 if device == "cuda" else torch.float32)
+        pipeline = pipeline.to(device)
+        if local_attention_slicing != "off":
+            pipeline.enable_attention_slicing()
+        pipeline.set_progress_bar_config(disable=True)
+        _pipeline = pipeline
+    return _pipeline
+
+
+def render_prompts(prompts: List[str]) -> List[bytes]:
+    """
+     Render several prompts in one forward pass of the pipeline. Runs in a worker process of the diffusion pool.
+
+     @param prompts - The image prompts
+
+     @return One JPEG per prompt, in the same order
+    """
+    import torch
+    pipeline = load_pipeline()
+    with torch.inference_mode():
+        images = pipeline(prompts,
+                          num_inference_steps=local_inference_steps,
+                          guidance_scale=local_guidance_scale,
+                          height=local_image_size,
+                          width=local_image_size).images
+    results = []
+    for image in images:
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=95)
+        results.append(buffer.getvalue())
+    return results
+
+#==================================================================================================
+# Prompt Batching
+#==================================================================================================
+
+
+class PromptBatcher:
+    """
+     Collects the prompts submitted from any thread into batches, so the sections rendered at the same time share
+     a forward pass. A batch is sent to the diffusion pool once it is full or window seconds after its first prompt.
+    """
+
+    def __init__(self, render: Callable[[List[str]], List[bytes]], batch_size: int = local_batch_size,
+                 window: float = local_batch_window):
+        self.render = render
+        self.batch_size = max(1, batch_size)
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, concurrent.futures.Future]] = []
+        self._timer = None
+
+    def submit(self, prompt: str) -> concurrent.futures.Future:
+        """
+         Queue a prompt.
+
+         @param prompt - The image prompt
+
+         @return The future of its JPEG bytes
+        """
+        future = concurrent.futures.Future()
+        batch = None
+        with self._lock:
+            self._pending.append((prompt, future))
+            if len(self._pending) >= self.batch_size:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._dispatch(batch)
+        return future
+
+    def _take(self) -> List[Tuple[str, concurrent.futures.Future]]:
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self) -> None:
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: List[Tuple[str, concurrent.futures.Future]]) -> None:
+        try:
+            result = worker_pool.submit_process(self.render, [prompt for prompt, _ in batch], pool="diffusion")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        def deliver(result: concurrent.futures.Future) -> None:
+            try:
+                images = result.result()
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            for (_, future), image in zip(batch, images):
+                future.set_result(image)
+            # The images come in prompt order, a short result must not leave the other prompts waiting forever
+            if len(images) != len(batch):
+                error = RuntimeError(f"{len(images)} images rendered for {len(batch)} prompts")
+                for _, future in batch[len(images):]:
+                    future.set_exception(error)
+
+        result.add_done_callback(deliver)
+
+
+# Prompts of every site generated by the process
+local_batcher = PromptBatcher(render_prompts)
@@ -1,3 +1,4 @@
+import asyncio
 import csv
 import concurrent.futures
 import io
@@ -11,15 +12,17 @@ import time
 from pathlib import Path
 from typing import List, Dict, TypedDict
 from concurrent.futures import ThreadPoolExecutor, wait
-from .content_main import get_industry, get_audience, get_location, generate_meta_description, generate_long_tail_keywords, generate_title, content_generation, processjson
-from .image_main import image_generation, get_image, generate_gallery_images, generate_logo, chat_with_dall_e, stabilityai_generate
+from .content_main import get_industry, get_audience, get_location, generate_meta_description, generate_long_tail_keywords, generate_title, generate_site_brief, content_generation, async_content_generation, processjson, async_generate_meta_description, generate_content_sections, async_generate_content_sections, generate_footer, assemble_content
+from .concurrency import concurrency_metrics
+from .image_main import image_generation, async_image_generation, get_image, generate_gallery_images, generate_logo, chat_with_dall_e, stabilityai_generate, async_get_image, async_generate_gallery_images, async_generate_logo, new_image_json, select_image_method, generate_variants, async_generate_variants, asset_keys, asset_store
+from .scheduler import Stage, StageScheduler
+from .worker_pool import worker_pool
 
 
 memory_dir = os.getenv("MEMORY_DIRECTORY", "local")
 workspace_path = "./"
 # The workspace_path is the path to the workspace directory.
 if memory_dir == "production":
-    import boto3
     workspace_path = "/tmp"
 elif memory_dir == "local":
     workspace_path = "./"
@@ -52,11 +55,55 @@ def deep_update(source, overrides):
     return source
 
 
-def update_json(data1):
+# Position in the layouts of every section written by the content generation
+CONTENT_LAYOUTS = {"banner": 1, "about": 2, "blogs": 3, "faq": 5, "blog2": 7}
+
+
+def content_layout(section: str, content: Dict, image: str = "") -> Dict:
+    """
+     Fill the layout of one content section, as soon as its text (and image) is ready.
+     
+     @param section - One of CONTENT_LAYOUTS
+     @param content - The generated content of the section
+     @param image - The file name of the image of the section, if it has one
+     
+     @return The values of the layout to merge into its template
+    """
+    if section == "banner":
+        # Layout_centered_image_1
+        return {
+            "h1": {"value": content['h1'], "html": content['h1']},
+            "h2": {"value": content['h2'], "html": content['h2']},
+            "button": content['button'],
+            "images": [{"file_name": image, "alt": ""}],
+        }
+    if section == "blogs":
+        # Layout_three_blogs_1
+        return {
+            "h2": {"value": content['h2'], "html": content['h2']},
+            "blogs": [{'h3': {'value': post['h3'], 'html': post['h3'], 'style': []}, 'paragraph': {'value': post['p'], 'html': post['p'], 'style': []}} for post in content['post']],
+        }
+    if section == "faq":
+        # Layout_frequently_asked_questions_1
+        return {
+            "h2": {"value": content['h2'], "html": content['h2']},
+            "faq": [{'h3': {'value': q['h3'], 'html': q['h3'], 'style': []}, 'paragraph': {'value': q['p'], 'html': q['p'], 'style': []}} for q in content['question']],
+        }
+    # Layout_right_image_1 and Layout_right_image_2
+    return {
+        "h2": {"value": content['h2'], "html": content['h2']},
+        "paragraph": {"value": content['p'], "html": content['p']},
+        "images": [{"file_name": image, "alt": ""}],
+    }
+
+
+def update_json(data1, variants: Dict = None, layouts: Dict = None):
     """
      Updates the JSON for front-end
      
      @param data1 - The JSON to update
+     @param variants - The responsive variants of each image by file name, listed with the images for srcset
+     @param layouts - The content_layout of the sections already filled in, by section
      
      @return The updated JSON as a Python dictionary
     """
@@ -298,35 +345,10 @@ def update_json(data1):
         }
     ]
 
-    # Layout_centered_image_1
-    data2['layouts'][1]['value']['h1']['value'] = data1['banner']['h1']
-    data2['layouts'][1]['value']['h1']['html'] = data1['banner']['h1']
-    data2['layouts'][1]['value']['h2']['value'] = data1['banner']['h2']
-    data2['layouts'][1]['value']['h2']['html'] = data1['banner']['h2']
-    data2['layouts'][1]['value']['button'] = data1['banner']['button']
-    data2['layouts'][1]['value']['images']: list = [
-        {
-            "file_name": data1['banner']['image'],
-            "alt": ""
-        }
-    ]
-
-    # Layout_right_image_1
-    data2['layouts'][2]['value']['h2']['value'] = data1['about']['h2']
-    data2['layouts'][2]['value']['h2']['html'] = data1['about']['h2']
-    data2['layouts'][2]['value']['paragraph']['value'] = data1['about']['p']
-    data2['layouts'][2]['value']['paragraph']['html'] = data1['about']['p']
-    data2['layouts'][2]['value']['images']: list = [
-        {
-            "file_name": data1['about']['image'],
-            "alt": ""
-        }
-    ]
-
-    # Layout_three_blogs_1
-    data2['layouts'][3]['value']['h2']['value'] = data1['blogs']['h2']
-    data2['layouts'][3]['value']['h2']['html'] = data1['blogs']['h2']
-    data2['layouts'][3]['value']['blogs'] = [{'h3': {'value': post['h3'], 'html': post['h3'], 'style': []}, 'paragraph': {'value': post['p'], 'html': post['p'], 'style': []}} for post in data1['blogs']['post']]
+    # The content sections, those streamed by the site pipeline are already filled in
+    for section, position in CONTENT_LAYOUTS.items():
+        layout = (layouts or {}).get(section) or content_layout(section, data1[section], data1[section].get('image', ""))
+        deep_update(data2['layouts'][position]['value'], layout)
 
     # Layout_contact_us_1
     data2["layouts"][4]['value']['images']: list = [
@@ -336,26 +358,9 @@ def update_json(data1):
         }
     ]
 
-    # Layout_frequently_asked_questions_1
-    data2['layouts'][5]['value']['h2']['value'] = data1['faq']['h2']
-    data2['layouts'][5]['value']['h2']['html'] = data1['faq']['h2']
-    data2['layouts'][5]['value']['faq'] = [{'h3': {'value': q['h3'], 'html': q['h3'], 'style': []}, 'paragraph': {'value': q['p'], 'html': q['p'], 'style': []}} for q in data1['faq']['question']]
-
     # Layout_gallery_1
     data2['layouts'][6]['value']['images'] = [{'file_name': img, 'alt': ''} for img in data1['gallery']['image']]
 
-    # Layout_right_image_2
-    data2["layouts"][7]['value']['h2']['html'] = data1['blog2']['h2']
-    data2["layouts"][7]['value']['h2']['value'] = data1['blog2']['h2']
-    data2["layouts"][7]['value']['paragraph']['value'] = data1['blog2']['p']
-    data2["layouts"][7]['value']['paragraph']['html'] = data1['blog2']['p']
-    data2["layouts"][7]['value']['images']: list = [
-        {
-            "file_name": data1['blog2']['image'],
-            "alt": ""
-        }
-    ]
-
     # Layout_map_1
     data2['layouts'][8]['value']['map_src'] = data1['map']['map_src']
 
@@ -368,6 +373,12 @@ def update_json(data1):
         }
     ]
 
+    # Responsive variants of the images
+    for layout in data2['layouts'] if variants else []:
+        for image in layout['value'].get('images', []):
+            if image['file_name'] in variants:
+                image['variants'] = variants[image['file_name']]
+
     # meta_data
     data2['meta_data']['title'] = data1['meta']['title']
     data2['meta_data']['description'] = data1['meta']['description']
@@ -397,27 +408,274 @@ def feature_function(company_name: str,
     
     @return A dictionary with the result of the content and image generation function or empty
     """
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        image_future = executor.submit(image_generation, topic, industry, selected_keyword)
-        content_future = executor.submit(content_generation, company_name, topic, industry, selected_keyword, title, location)
-        futures = [image_future, content_future]
-        done, not_done = concurrent.futures.wait(futures, timeout=60, return_when=concurrent.futures.ALL_COMPLETED)
-        try:
-            image_result = image_future.result()
-            content_result = content_future.result()
-        except Exception as e:
-            print("An exception occurred during execution: ", e)
+    image_future = worker_pool.submit("stage", image_generation, topic, industry, selected_keyword)
+    content_future = worker_pool.submit("llm", content_generation, company_name, topic, industry, selected_keyword, title, location)
+    futures = [image_future, content_future]
+    done, not_done = concurrent.futures.wait(futures, timeout=60, return_when=concurrent.futures.ALL_COMPLETED)
+    try:
+        image_result = image_future.result()
+        content_result = content_future.result()
+    except Exception as e:
+        print("An exception occurred during execution: ", e)
+
+    if image_result is None or content_result is None:
+        print("Error: No results returned")
+        return {}
+    variants = generate_variants(image_result)
+    # Update the result of the image and content, once every image and variant of the site is uploaded.
+    keys = asset_keys(image_result, variants)
+    if asset_store.wait(keys):
+        print("Error: No results returned")
+        return {}
+    else:
+        asset_store.register(site_name(company_name, topic), keys)
+        merged_dict = deep_update(content_result, image_result)
+        # print(json.dumps(merged_dict, indent=4))
+        final_result = update_json(merged_dict, variants)
+        # print(json.dumps(final_result, indent=4))
+        return final_result
 
-        # Update the result of the image and content.
-        if image_result is None or content_result is None:
-            print("Error: No results returned")
+
+async def async_feature_function(company_name: str,
+                                 topic: str,
+                                 industry: str,
+                                 selected_keyword: str,
+                                 title: str,
+                                 location: str) -> Dict:
+    """
+    Asynchronous version of feature_function. Image and content generation run concurrently on the running
+    event loop, so many sites can be generated from one loop without a thread per request.
+    
+    @param company_name - The name of the company
+    @param topic - User's keyword
+    @param industry - The industry of the feature
+    @param selected_keyword - Randomly selected keyword
+    @param title - The generated title
+    @param location - The generated location 
+    
+    @return A dictionary with the result of the content and image generation function or empty
+    """
+    image_result, content_result = await asyncio.gather(
+        async_image_generation(topic, industry, selected_keyword),
+        async_content_generation(company_name, topic, industry, selected_keyword, title, location),
+        return_exceptions=True,
+    )
+    for result in (image_result, content_result):
+        if isinstance(result, Exception):
+            print("An exception occurred during execution: ", result)
             return {}
-        else:
-            merged_dict = deep_update(content_result, image_result)
-            # print(json.dumps(merged_dict, indent=4))
-            final_result = update_json(merged_dict)
-            # print(json.dumps(final_result, indent=4))
-            return final_result
+
+    if image_result is None or content_result is None:
+        print("Error: No results returned")
+        return {}
+    variants = await async_generate_variants(image_result)
+    # Update the result of the image and content, once every image and variant of the site is uploaded.
+    keys = asset_keys(image_result, variants)
+    if await worker_pool.run("stage", asset_store.wait, keys):
+        print("Error: No results returned")
+        return {}
+    await worker_pool.run("io", asset_store.register, site_name(company_name, topic), keys)
+    merged_dict = deep_update(content_result, image_result)
+    return update_json(merged_dict, variants)
+
+# =======================================================================================================================
+# Site Pipeline
+# =======================================================================================================================
+
+IMAGE_SECTIONS = ["banner", "about", "contactus", "blog2"]
+
+
+def site_name(company_name: str, topic: str) -> str:
+    """
+    Identify a site in the asset manifest, generating the site again replaces its assets.
+    
+    @param company_name - The name of the company
+    @param topic - User's keyword
+    
+    @return The name of the site
+    """
+    return f"{company_name}/{topic}"
+
+
+def print_brief(brief: Dict) -> Dict:
+    """
+    Print the site brief as it is generated.
+    
+    @param brief - The dict returned by generate_site_brief
+    
+    @return The same brief
+    """
+    print(brief["industry"])
+    print(brief["location"])
+    for number, keyword in enumerate(brief["long_tail_keywords"]):
+        print(f"{number+1}. {keyword}")
+    print("Selected Keyword: " + brief["selected_keyword"])
+    print(brief["title"])
+    return brief
+
+
+def site_stages(asynchronous: bool = False) -> List[Stage]:
+    """
+    Declare the stages of one site and the inputs each one needs. Everything but the brief only depends on the
+    brief, so the meta description, the content, the footer, the logo and every image start together.
+    The content is streamed: the layout of each section is filled in as soon as its text (and image) is ready,
+    while the model is still writing the next sections.
+    
+    @param asynchronous - Use the coroutine versions of the stages, for StageScheduler.async_run
+    
+    @return The stages, run with the initial value site = {"company_name": ..., "topic": ...}
+    """
+    method_name = select_image_method(asynchronous)
+
+    def brief(site):
+        return print_brief(generate_site_brief(site["company_name"], site["topic"]))
+
+    def footer(site, brief):
+        return generate_footer(site["company_name"], site["topic"], brief["industry"], brief["selected_keyword"], brief["title"], brief["location"])
+
+    def content_json(brief, meta_description, content, footer):
+        return assemble_content(brief["title"], meta_description, content, footer)
+
+    def images(logo, banner, about, contactus, blog2, gallery):
+        image_json = new_image_json()
+        image_json["logo"]["image"] = logo
+        for section, image in zip(IMAGE_SECTIONS, (banner, about, contactus, blog2)):
+            if image:
+                image_json[section]["image"] = image
+        image_json["gallery"]["image"] = gallery or []
+        print("Images Generated")
+        return image_json
+
+    def variants(images):
+        return generate_variants(images)
+
+    def section_layout(section):
+        def fill(**inputs):
+            return content_layout(section, inputs[f"{section}_text"], inputs.get(section) or "")
+        return fill
+
+    def layout(content_json, images, variants, **layouts):
+        return update_json(deep_update(content_json, images), variants,
+                           {section: layouts[f"{section}_layout"] for section in CONTENT_LAYOUTS})
+
+    if asynchronous:
+        async def meta_description(site, brief):
+            return await async_generate_meta_description(site["company_name"], site["topic"], brief["selected_keyword"])
+
+        async def content(site, brief):
+            async for section, value in async_generate_content_sections(site["company_name"], site["topic"], brief["industry"], brief["selected_keyword"], brief["title"], brief["location"]):
+                yield f"{section}_text", value
+
+        async def logo(site, brief):
+            return await async_generate_logo(method_name, brief["selected_keyword"], "Logo", site["topic"], brief["industry"])
+
+        def section_image(section):
+            async def render(site, brief):
+                return await async_get_image(method_name, brief["selected_keyword"], section, site["topic"], brief["industry"])
+            return render
+
+        async def gallery(site, brief):
+            return await async_generate_gallery_images(method_name, brief["selected_keyword"], "gallery", site["topic"], brief["industry"])
+    else:
+        def meta_description(site, brief):
+            return generate_meta_description(site["company_name"], site["topic"], brief["selected_keyword"])
+
+        def content(site, brief):
+            for section, value in generate_content_sections(site["company_name"], site["topic"], brief["industry"], brief["selected_keyword"], brief["title"], brief["location"]):
+                yield f"{section}_text", value
+
+        def logo(site, brief):
+            return generate_logo(method_name, brief["selected_keyword"], "Logo", site["topic"], brief["industry"])
+
+        def section_image(section):
+            def render(site, brief):
+                return get_image(method_name, brief["selected_keyword"], section, site["topic"], brief["industry"])
+            return render
+
+        def gallery(site, brief):
+            return generate_gallery_images(method_name, brief["selected_keyword"], "gallery", site["topic"], brief["industry"])
+
+    return [
+        # The brief waits on its hedged requests in the llm lane
+        Stage("brief", brief, ["site"]),
+        Stage("meta_description", meta_description, ["site", "brief"], lane="llm"),
+        Stage("content", content, ["site", "brief"], lane="llm", outputs=[f"{section}_text" for section in CONTENT_LAYOUTS]),
+        Stage("footer", footer, ["site", "brief"], lane="llm"),
+        Stage("content_json", content_json, ["brief", "meta_description", "content", "footer"], lane="cpu"),
+        *(Stage(f"{section}_layout", section_layout(section), [f"{section}_text", *([section] if section in IMAGE_SECTIONS else [])], lane="cpu")
+          for section in CONTENT_LAYOUTS),
+        # A missing image leaves its section empty instead of failing the site
+        Stage("logo", logo, ["site", "brief"], optional=True, lane="image"),
+        # The section images wait on their hedged description in the llm lane, then on the image lane
+        *(Stage(section, section_image(section), ["site", "brief"], optional=True) for section in IMAGE_SECTIONS),
+        # The gallery waits on the image and io lanes
+        Stage("gallery", gallery, ["site", "brief"], optional=True),
+        Stage("images", images, ["logo", *IMAGE_SECTIONS, "gallery"], lane="cpu"),
+        # Encoded in the process pool, the site keeps the full-size images only if it fails
+        Stage("variants", variants, ["images"], optional=True),
+        Stage("layout", layout, ["content_json", "images", "variants", *(f"{section}_layout" for section in CONTENT_LAYOUTS)], lane="cpu"),
+    ]
+
+
+def generate_site(company_name: str,
+                  topic: str) -> Dict:
+    """
+    Generate the data of a whole site, every stage starting as soon as its inputs are ready.
+    
+    @param company_name - The name of the company
+    @param topic - User's keyword
+    
+    @return The layout JSON of the site or None if a required stage failed
+    """
+    scheduler = StageScheduler(site_stages())
+    results = scheduler.run(site={"company_name": company_name, "topic": topic})
+    print(f"Critical path: {scheduler.report()}")
+    # The layout refers to the assets by key, those of this site must all be uploaded
+    keys = asset_keys(results.get("images") or {}, results.get("variants"))
+    failed_uploads = asset_store.wait(keys)
+    if failed_uploads:
+        print(f"Error: {len(failed_uploads)} assets were not uploaded")
+        return None
+    if results.get("layout") is not None:
+        asset_store.register(site_name(company_name, topic), keys)
+    return results.get("layout")
+
+
+async def async_generate_site(company_name: str,
+                              topic: str) -> Dict:
+    """
+    Asynchronous version of generate_site, the stages run on the running event loop.
+    
+    @param company_name - The name of the company
+    @param topic - User's keyword
+    
+    @return The layout JSON of the site or None if a required stage failed
+    """
+    scheduler = StageScheduler(site_stages(asynchronous=True))
+    results = await scheduler.async_run(site={"company_name": company_name, "topic": topic})
+    print(f"Critical path: {scheduler.report()}")
+    keys = asset_keys(results.get("images") or {}, results.get("variants"))
+    failed_uploads = await worker_pool.run("stage", asset_store.wait, keys)
+    if failed_uploads:
+        print(f"Error: {len(failed_uploads)} assets were not uploaded")
+        return None
+    if results.get("layout") is not None:
+        await worker_pool.run("io", asset_store.register, site_name(company_name, topic), keys)
+    return results.get("layout")
+
+
+def delete_site(company_name: str,
+                topic: str) -> List[str]:
+    """
+    Release the assets of a deleted site and delete those no other site uses.
+    
+    @param company_name - The name of the company
+    @param topic - User's keyword
+    
+    @return The keys of the deleted assets
+    """
+    asset_store.release(site_name(company_name, topic))
+    return asset_store.collect()
 
 # =======================================================================================================================
 # Main Function
@@ -441,25 +699,8 @@ def main():
     
     while flag:
         try:
-            # Generate industry 
-            industry = get_industry(topic)
-            print(industry)
-            
-            location = get_location(topic)
-            print(location)
-
-            # Generate SEO keywords
-            long_tail_keywords = generate_long_tail_keywords(topic)
-            for number, keyword in enumerate(long_tail_keywords):
-                print(f"{number+1}. {keyword}")
-
-            # Generate title from keyword
-            selected_keyword = long_tail_keywords[random.randint(0, 4)]
-            print("Selected Keyword: " + selected_keyword)
-            title = generate_title(company_name, selected_keyword)
-            print(title)
-            
-            merged_dict = feature_function(company_name, topic, industry, selected_keyword, title, location)
+            # Generate the brief, then the content and every image as soon as the brief is ready
+            merged_dict = generate_site(company_name, topic)
             # Write the merged_dict to a data.json file.
             if merged_dict is None:
                 print("Error: No results returned")
@@ -477,8 +718,12 @@ def main():
                 os.makedirs(directory_path, exist_ok=True)
                 with open(os.path.join(directory_path, f'data.json'), 'w', encoding='utf-8') as f:
                     json.dump(merged_dict, f, ensure_ascii=False, indent=4)
+                # The new layout is in place, delete the assets only its previous version used
+                asset_store.collect()
                 
                 # End procedures
+                for metrics in concurrency_metrics():
+                    print(f"Concurrency {metrics['name']}: window {metrics['window']}, overloads {metrics['overloads']}")
                 
                 
         except Exception as e:
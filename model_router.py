@@ -0,0 +1,128 @@
+import json
+import os
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+default_model = os.getenv("DEFAULT_MODEL", "gpt-3.5-turbo")
+# Stronger model a failed cheap reply is retried on, for the stages that do not name their own
+escalation_model = os.getenv("ESCALATION_MODEL", "gpt-4")
+# Model of the stages of seo.py that send or return whole pages
+long_context_model = os.getenv("LONG_CONTEXT_MODEL", "gpt-3.5-turbo-16k")
+# Overrides of the routing table as JSON, e.g. {"Content Generation": {"model": "gpt-3.5-turbo-16k", "escalate": null}}
+model_routes = os.getenv("MODEL_ROUTES", "")
+
+#==================================================================================================
+# Routing Table
+#==================================================================================================
+
+# Cheapest model able to handle each stage, and the model used once when its reply fails validation.
+# The content prompt and reply fit in 4k tokens, the 16k model is only needed when the reply gets truncated.
+MODEL_ROUTES: Dict[str, Dict[str, Optional[str]]] = {
+    "Industry Identification": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Target Search": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Location Identification": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Keyword Clusters Search": {"model": "gpt-3.5-turbo", "escalate": escalation_model},
+    "Title Generation": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Site Brief": {"model": "gpt-3.5-turbo", "escalate": escalation_model},
+    "Outline Generation": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Meta Description Generation": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Content Generation": {"model": "gpt-3.5-turbo", "escalate": "gpt-3.5-turbo-16k"},
+    "Image Description Generation": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Logo Description Generation": {"model": "gpt-3.5-turbo", "escalate": None},
+}
+# seo.py outlines, writes and restyles whole pages without validating the replies, so its stages stay on the long
+# context model (SEO_DEFAULT) and only the stages with short prompts and replies use the cheap one
+SEO_MODEL_ROUTES: Dict[str, Dict[str, Optional[str]]] = {
+    "Industry Identification": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Target Search": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Keyword Clusters Search": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Title Generation": {"model": "gpt-3.5-turbo", "escalate": None},
+    "Meta Description Generation": {"model": "gpt-3.5-turbo", "escalate": None},
+}
+
+
+class ModelRouter:
+    """
+     Picks the model of every stage from the routing table and escalates a reply that fails validation once
+     to the stage's stronger model.
+    """
+
+    def __init__(self, routes: Dict[str, Dict[str, Optional[str]]], default: str = default_model):
+        self.routes = routes
+        self.default = default
+
+    def route(self, stage: Optional[str]) -> Dict[str, Optional[str]]:
+        """
+         Find the route of a stage. Stages named after a component (e.g. "Adding footer") match by prefix.
+
+         @param stage - The stage name
+
+         @return A dict with the model and the escalation model (None if the stage does not escalate)
+        """
+        if stage in self.routes:
+            return self.routes[stage]
+        for name, route in self.routes.items():
+            if stage and stage.startswith(f"{name} "):
+                return route
+        return {"model": self.default, "escalate": None}
+
+    def model(self, stage: Optional[str]) -> str:
+        return self.route(stage).get("model") or self.default
+
+    def call(self, stage: str, func: Callable[[str], T], validate: Callable[[T], bool]) -> T:
+        """
+         Run a stage on its cheap model and retry it once on the stronger one if the reply is not valid.
+
+         @param stage - The stage name
+         @param func - Performs the stage with the model it is given
+         @param validate - Returns True if the reply can be used
+
+         @return The reply of the cheap model or, when it failed validation, of the stronger model
+        """
+        route = self.route(stage)
+        result = func(route.get("model") or self.default)
+        if route.get("escalate") and not validate(result):
+            print(f"{stage} reply failed validation, retrying on {route['escalate']}")
+            result = func(route["escalate"])
+        return result
+
+    async def async_call(self, stage: str, func: Callable[[str], Awaitable[T]], validate: Callable[[T], bool]) -> T:
+        """
+         Asynchronous version of call, func must be a coroutine function.
+        """
+        route = self.route(stage)
+        result = await func(route.get("model") or self.default)
+        if route.get("escalate") and not validate(result):
+            print(f"{stage} reply failed validation, retrying on {route['escalate']}")
+            result = await func(route["escalate"])
+        return result
+
+
+def load_routes(table: Dict[str, Dict[str, Optional[str]]] = MODEL_ROUTES,
+                default: str = default_model) -> Dict[str, Dict[str, Optional[str]]]:
+    """
+     A routing table with the MODEL_ROUTES overrides applied.
+
+     @param table - The default routes
+     @param default - The model of the stages the overrides add
+
+     @return The routes by stage name
+    """
+    routes = {stage: dict(route) for stage, route in table.items()}
+    if model_routes:
+        try:
+            for stage, route in json.loads(model_routes).items():
+                routes.setdefault(stage, {"model": default, "escalate": None}).update(route)
+        except (ValueError, AttributeError) as e:
+            print(f"Invalid MODEL_ROUTES, using the default routes: {e}")
+    return routes
+
+
+model_router = ModelRouter(load_routes())
+# Routes of seo.py, whose unlisted stages run on the long context model
+seo_model_router = ModelRouter(load_routes(SEO_MODEL_ROUTES, long_context_model), long_context_model)
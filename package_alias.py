@@ -0,0 +1,28 @@
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+#==================================================================================================
+# Package Alias
+#==================================================================================================
+
+# The modules use relative imports and the repository has no __init__.py, so scripts and tests import them
+# through this package name whatever name the repository is checked out under (e.g. SEO-Content-Generation)
+PACKAGE_ALIAS = "seo_package"
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def register_package(name: str = PACKAGE_ALIAS) -> str:
+    """
+     Register the repository directory as a package, so that "import seo_package.main" works from any directory.
+
+     @param name - The package name to register
+
+     @return The package name
+    """
+    if name not in sys.modules:
+        spec = importlib.machinery.ModuleSpec(name, None, is_package=True)
+        spec.submodule_search_locations = [package_dir]
+        sys.modules[name] = importlib.util.module_from_spec(spec)
+    return name
@@ -0,0 +1,250 @@
+import asyncio
+import os
+import re
+import threading
+import time
+import aiohttp
+import requests
+from typing import Dict, List, Mapping, Optional
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Account limits, refined at runtime from the x-ratelimit-* response headers (0 disables a bucket)
+chat_requests_per_minute = int(os.getenv("OPENAI_RPM", "3500"))
+chat_tokens_per_minute = int(os.getenv("OPENAI_TPM", "90000"))
+image_requests_per_minute = int(os.getenv("OPENAI_IMAGE_RPM", "50"))
+# Completion tokens reserved for a request that does not set max_tokens
+default_completion_tokens = int(os.getenv("OPENAI_COMPLETION_ESTIMATE", "500"))
+
+#==================================================================================================
+# Token Buckets
+#==================================================================================================
+
+
+def parse_reset(value: str) -> float:
+    """
+     Parse an OpenAI reset duration such as "20ms", "1s" or "6m0s" into seconds.
+
+     @param value - The header value
+
+     @return The duration in seconds or 0 if it cannot be parsed
+    """
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def estimate_tokens(messages: List[Dict[str, str]], max_tokens: Optional[int] = None, n: int = 1) -> int:
+    """
+     Estimate the tokens a chat request will be charged for: roughly 4 characters per prompt token, a small
+     overhead per message and the completion tokens that will be reserved.
+
+     @param messages - The chat messages
+     @param max_tokens - The max_tokens of the request if it sets one
+     @param n - The number of choices requested, each one is charged as a separate completion
+
+     @return The estimated token cost
+    """
+    return _prompt_tokens(messages) + n * (max_tokens or default_completion_tokens)
+
+
+def estimate_usage(messages: List[Dict[str, str]], reply: str) -> int:
+    """
+     Estimate the tokens a finished request was charged for when the API does not report its usage, e.g. a
+     streamed reply.
+
+     @param messages - The chat messages
+     @param reply - The text of the reply
+
+     @return The estimated total_tokens
+    """
+    return _prompt_tokens(messages) + len(reply) // 4
+
+
+def _prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(4 + len(message.get("content") or "") // 4 for message in messages) + 3
+
+
+class _Bucket:
+    """A token bucket holding a per-minute budget that refills continuously."""
+
+    def __init__(self, limit: float):
+        self.limit = float(limit)
+        self.available = float(limit)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        cost = min(cost, self.limit)
+        if self.available >= cost:
+            return 0.0
+        return (cost - self.available) * 60 / self.limit
+
+
+class RateLimiter:
+    """
+     Process-wide limiter tracking requests-per-minute and tokens-per-minute. Callers block in acquire until both
+     budgets allow the request, and the budgets are corrected from the rate-limit headers of every response.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int = 0):
+        self._lock = threading.Lock()
+        self._requests = _Bucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = _Bucket(tokens_per_minute) if tokens_per_minute else None
+
+    def _reserve(self, tokens: int) -> float:
+        """Reserve the budget for one request. Returns 0 on success or the seconds to wait before trying again."""
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            for bucket, cost in ((self._requests, 1), (self._tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(cost, now))
+            if wait > 0:
+                return wait
+            if self._requests is not None:
+                self._requests.available -= 1
+            if self._tokens is not None:
+                self._tokens.available -= min(tokens, self._tokens.limit)
+            return 0.0
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+         Block until the request fits in both budgets.
+
+         @param tokens - The estimated token cost of the request
+        """
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def async_acquire(self, tokens: int = 0) -> None:
+        """
+         Asynchronous version of acquire.
+
+         @param tokens - The estimated token cost of the request
+        """
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated: int, actual: int) -> None:
+        """
+         Correct the token budget once the real usage of a request is known.
+
+         @param estimated - The tokens reserved by acquire
+         @param actual - The total_tokens reported by the API
+        """
+        if self._tokens is None or actual is None:
+            return
+        with self._lock:
+            self._tokens.available = min(self._tokens.limit, self._tokens.available + estimated - actual)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """
+         Update the budgets from the x-ratelimit-* and retry-after headers of a response.
+
+         @param headers - The response headers
+        """
+        if not headers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for bucket, kind in ((self._requests, "requests"), (self._tokens, "tokens")):
+                if bucket is None:
+                    continue
+                try:
+                    limit = headers.get(f"x-ratelimit-limit-{kind}")
+                    if limit:
+                        bucket.refill(now)
+                        bucket.limit = float(limit)
+                    remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                    if remaining is not None:
+                        bucket.refill(now)
+                        bucket.available = min(bucket.available, float(remaining))
+                        if float(remaining) < 1:
+                            reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}", ""))
+                            bucket.blocked_until = max(bucket.blocked_until, now + reset)
+                except ValueError:
+                    continue
+            retry_after = headers.get("retry-after")
+            if retry_after and self._requests is not None:
+                try:
+                    self._requests.blocked_until = max(self._requests.blocked_until, now + float(retry_after))
+                except ValueError:
+                    pass
+
+
+chat_rate_limiter = RateLimiter(chat_requests_per_minute, chat_tokens_per_minute)
+image_rate_limiter = RateLimiter(image_requests_per_minute)
+
+#==================================================================================================
+# Response Hooks
+#==================================================================================================
+
+
+def limiter_for_url(url: str) -> Optional[RateLimiter]:
+    """
+     Find the limiter responsible for an OpenAI endpoint.
+
+     @param url - The request url
+
+     @return The matching limiter or None for other endpoints
+    """
+    url = str(url)
+    if "/chat/completions" in url:
+        return chat_rate_limiter
+    if "/images/" in url:
+        return image_rate_limiter
+    return None
+
+
+def update_from_response(response: requests.Response, *args, **kwargs) -> None:
+    """
+     requests response hook feeding the rate-limit headers to the matching limiter.
+    """
+    limiter = limiter_for_url(response.url)
+    if limiter is not None:
+        limiter.update_from_headers(response.headers)
+
+
+def make_requests_session() -> requests.Session:
+    """
+     Create the requests session used by the openai library (set as openai.requestssession).
+
+     @return A session that reports every OpenAI response to the rate limiters
+    """
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(max_retries=2))
+    session.hooks["response"].append(update_from_response)
+    return session
+
+
+def make_trace_config() -> aiohttp.TraceConfig:
+    """
+     Create the aiohttp trace config that reports every OpenAI response to the rate limiters.
+
+     @return The trace config to pass to aiohttp.ClientSession
+    """
+    async def on_request_end(session, context, params):
+        limiter = limiter_for_url(params.url)
+        if limiter is not None:
+            limiter.update_from_headers(params.response.headers)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
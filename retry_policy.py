@@ -0,0 +1,359 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+retry_max_retries = int(os.getenv("RETRY_MAX_RETRIES", "6"))
+# Total seconds a call may spend retrying before its last error is raised
+retry_max_elapsed = float(os.getenv("RETRY_MAX_ELAPSED", "120"))
+# Consecutive upstream failures that open a circuit, and seconds before a probe request is let through
+circuit_failure_threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+circuit_reset_timeout = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# Longest wait honoured when a server asks to retry later (Retry-After, estimated_time of a loading model)
+retry_max_after = float(os.getenv("RETRY_MAX_AFTER", "60"))
+
+#==================================================================================================
+# Error Classification
+#==================================================================================================
+
+# Errors that may succeed when sent again: throttling, overload, timeouts and connection problems
+RETRYABLE_ERRORS = ("RateLimitError", "ServiceUnavailableError", "Timeout", "TryAgain", "APIConnectionError", "APIError",
+                    "ConnectionError", "ConnectTimeout", "ReadTimeout", "ChunkedEncodingError", "TimeoutError",
+                    "ClientConnectionError", "ClientConnectorError", "ServerDisconnectedError", "ClientPayloadError")
+# HTTP statuses worth retrying, every other 4xx is a fatal client error
+RETRYABLE_STATUSES = (408, 409, 425, 429, 500, 502, 503, 504)
+# A 503 whose body contains one of these is a HuggingFace model still loading, not an outage
+LOADING_MARKERS = (b"currently loading", b"estimated_time")
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """
+     Get the HTTP status of an openai, requests or aiohttp error.
+
+     @param error - The exception raised by the call
+
+     @return The status code or None if the error has no response
+    """
+    status = getattr(error, "http_status", None) or getattr(error, "status", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def error_body(error: BaseException) -> bytes:
+    """
+     Get the body of an error response: http_body of an openai error, the content of a requests response, or the
+     body attached to an aiohttp error by http_session.raise_for_status.
+
+     @param error - The exception raised by the call
+
+     @return The body, empty if the error has none
+    """
+    body = getattr(error, "http_body", None) or getattr(error, "body", None)
+    response = getattr(error, "response", None)
+    if body is None and response is not None:
+        body = getattr(response, "content", None)
+    if isinstance(body, str):
+        body = body.encode()
+    return body if isinstance(body, bytes) else b""
+
+
+def is_throttled(error: BaseException) -> bool:
+    """
+     Recognise an endpoint that is up but asks to be called later: a 429, or the 503 HuggingFace answers while a
+     model is loading. Throttling is retried after the wait the server asks for and leaves the circuit alone.
+
+     @param error - The exception raised by the call
+
+     @return True if the error is throttling
+    """
+    status = error_status(error)
+    if status == 429:
+        return True
+    if status == 503:
+        body = error_body(error).lower()
+        return any(marker in body for marker in LOADING_MARKERS)
+    return status is None and any(cls.__name__ == "RateLimitError" for cls in type(error).__mro__)
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+     Recognise the errors that count toward opening a circuit: 5xx responses other than throttling, and timeouts
+     or connection problems.
+
+     @param error - The exception raised by the call
+
+     @return True if the endpoint itself failed
+    """
+    if isinstance(error, CircuitOpenError) or is_throttled(error):
+        return False
+    status = error_status(error)
+    if status is not None:
+        return status >= 500
+    return is_retryable(error)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+     Separate transient errors from errors that will never succeed (invalid requests, authentication, ...).
+
+     @param error - The exception raised by the call
+
+     @return True if the call should be retried
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+     Read the Retry-After (or retry-after-ms) header of an error response, or the estimated_time of a HuggingFace
+     model that is loading.
+
+     @param error - The exception raised by the call
+
+     @return The seconds to wait or None if the server did not say
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None and getattr(error, "response", None) is not None:
+        headers = getattr(error.response, "headers", None)
+    try:
+        if headers and headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers and headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        return None
+    body = error_body(error)
+    if b"estimated_time" in body:
+        try:
+            estimated_time = json.loads(body).get("estimated_time")
+        except (ValueError, AttributeError):
+            return None
+        if isinstance(estimated_time, (int, float)):
+            return float(estimated_time)
+    return None
+
+#==================================================================================================
+# Circuit Breaker
+#==================================================================================================
+
+
+class CircuitOpenError(Exception):
+    """
+     Raised instead of calling an endpoint whose circuit is open. retry_after is the number of seconds before the
+     circuit lets a probe through.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+     Per-endpoint circuit breaker. After failure_threshold consecutive upstream failures the circuit opens and
+     calls fail immediately; after reset_timeout a single probe is let through and closes it again on success.
+     Throttling neither counts as a failure nor as a success.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = circuit_failure_threshold, reset_timeout: float = circuit_reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """
+         Check that a call may be sent.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            wait = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(f"Circuit for {self.name} is open, failing fast", wait)
+
+    def retry_in(self) -> float:
+        """
+         @return The seconds before the open circuit lets a probe through, 0 if a call may be sent now
+        """
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def skip(self) -> None:
+        """
+         Forget a call let through by before_call without recording an outcome, e.g. a throttled or cancelled call.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record(self, success: bool) -> None:
+        """
+         Record the outcome of a call let through by before_call.
+
+         @param success - False if the upstream failed (transient error), True otherwise
+        """
+        with self._lock:
+            self._probing = False
+            if success:
+                self.state = "closed"
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self):
+        """
+         Wrap one call, e.g. ``with get_breaker("huggingface").guard(): ...``. Raises CircuitOpenError when open.
+        """
+        self.before_call()
+        try:
+            yield
+        except Exception as e:
+            if is_throttled(e):
+                # The endpoint is up and said when to come back
+                self.skip()
+            else:
+                self.record(not is_upstream_failure(e))
+            raise
+        except BaseException:
+            # Cancelled, the outcome says nothing about the endpoint
+            self.skip()
+            raise
+        self.record(True)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """
+     Get the process-wide circuit breaker of an endpoint, creating it on first use.
+
+     @param name - The endpoint name, e.g. "openai" or "huggingface"
+
+     @return The circuit breaker
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+#==================================================================================================
+# Retry Policy
+#==================================================================================================
+
+
+class RetryPolicy:
+    """
+     Retries transient errors with capped exponential backoff and full jitter, honouring Retry-After up to
+     max_retry_after seconds. Fatal errors are raised at once, and retrying stops after max_retries attempts or
+     max_elapsed seconds.
+    """
+
+    def __init__(self,
+                 initial_delay: float = 1,
+                 exponential_base: float = 2,
+                 max_delay: float = 30,
+                 max_retries: int = retry_max_retries,
+                 max_elapsed: float = retry_max_elapsed,
+                 max_retry_after: float = retry_max_after):
+        self.initial_delay = initial_delay
+        self.exponential_base = exponential_base
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.max_elapsed = max_elapsed
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt: int, error: BaseException) -> float:
+        """
+         Seconds to wait before the next attempt.
+
+         @param attempt - The number of failed attempts so far, starting at 0
+         @param error - The error of the last attempt
+
+         @return The delay in seconds
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.initial_delay * self.exponential_base ** attempt))
+        server_delay = retry_after(error)
+        if server_delay is None:
+            return backoff
+        return max(backoff, min(server_delay, self.max_retry_after))
+
+    def _next_delay(self, attempt: int, error: BaseException, start: float) -> Optional[float]:
+        if not is_retryable(error) or attempt >= self.max_retries:
+            return None
+        delay = self.delay(attempt, error)
+        if time.monotonic() - start + delay > self.max_elapsed:
+            return None
+        print(f"{error} Retry attempt {attempt + 1} of {self.max_retries} in {round(delay, 2)} seconds...")
+        return delay
+
+    def call(self, breaker: CircuitBreaker, func: Callable, *args, **kwargs):
+        """
+         Call func through the circuit breaker, retrying transient errors.
+
+         @return The result of func. The last error is raised when it is fatal or the retry budget is spent.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                with breaker.guard():
+                    return func(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(attempt, e, start)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def async_call(self, breaker: CircuitBreaker, func: Callable, *args, **kwargs):
+        """
+         Asynchronous version of call, func must be a coroutine function.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                with breaker.guard():
+                    return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(attempt, e, start)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+default_retry_policy = RetryPolicy()
@@ -0,0 +1,248 @@
+import asyncio
+import concurrent.futures
+import inspect
+import queue
+import time
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from .worker_pool import worker_pool
+
+#==================================================================================================
+# Stage Graph
+#==================================================================================================
+
+
+class Stage:
+    """
+     One step of a pipeline. func is called with the results of the stages (or initial values) named in inputs
+     as keyword arguments, in the worker lane named by lane. When an optional stage fails its result is None and
+     the stages depending on it still run, otherwise they are skipped.
+     A stage with outputs streams its results: func is a generator (or an async generator) of (output, value)
+     pairs, and every output is available to the stages using it as soon as it is yielded. The result of the
+     stage itself is the dict of its outputs. An output that was never yielded counts as failed.
+    """
+
+    def __init__(self, name: str, func: Callable, inputs: Iterable[str] = (), optional: bool = False, lane: str = "stage",
+                 outputs: Iterable[str] = ()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.optional = optional
+        self.lane = lane
+        self.outputs = tuple(outputs)
+
+
+class StageScheduler:
+    """
+     Runs a graph of stages, starting every stage as soon as all of its inputs are ready, so the wall-clock time
+     is the one of the longest chain of dependent stages instead of the sum of the phases.
+     A scheduler runs one graph at a time, create one per run.
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = {stage.name: stage for stage in stages}
+        # The stage streaming each output
+        self.producers = {output: stage.name for stage in stages for output in stage.outputs}
+        if len(self.stages) != len(stages) or len(self.producers) != sum(len(stage.outputs) for stage in stages) \
+                or set(self.producers) & set(self.stages):
+            raise ValueError("Stage and output names must be unique")
+        for stage in stages:
+            if stage.name in stage.inputs:
+                raise ValueError(f"Stage {stage.name} depends on itself")
+        self.timings: Dict[str, Tuple[float, float]] = {}
+        self.errors: Dict[str, BaseException] = {}
+        self._check_acyclic()
+
+    def _check_acyclic(self) -> None:
+        state: Dict[str, str] = {}
+
+        def visit(name: str) -> None:
+            name = self.producers.get(name, name)
+            if state.get(name) == "done" or name not in self.stages:
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Stage {name} is part of a dependency cycle")
+            state[name] = "visiting"
+            for dependency in self.stages[name].inputs:
+                visit(dependency)
+            state[name] = "done"
+
+        for name in self.stages:
+            visit(name)
+
+    def _start(self, initial: Dict[str, Any]) -> Dict[str, Any]:
+        missing = {dependency for stage in self.stages.values() for dependency in stage.inputs
+                   if dependency not in self.stages and dependency not in self.producers and dependency not in initial}
+        if missing:
+            raise ValueError(f"Unknown stage inputs: {', '.join(sorted(missing))}")
+        self.timings = {}
+        self.errors = {}
+        self._origin = time.monotonic()
+        return dict(initial)
+
+    def _ready(self, pending: Dict[str, Stage], results: Dict[str, Any]) -> List[Stage]:
+        """Remove and return the pending stages whose inputs are all available, skipping those with a failed input."""
+        ready = []
+        for name, stage in list(pending.items()):
+            failed = [dependency for dependency in stage.inputs if dependency in self.errors]
+            if failed:
+                del pending[name]
+                self.errors[name] = RuntimeError(f"Skipped because {', '.join(failed)} failed")
+            elif all(dependency in results for dependency in stage.inputs):
+                del pending[name]
+                ready.append(stage)
+        return ready
+
+    def _emitted(self, output: str, results: Dict[str, Any], start: float, value: Any) -> None:
+        self.timings[output] = (start - self._origin, time.monotonic() - self._origin)
+        results[output] = value
+
+    def _finish(self, stage: Stage, results: Dict[str, Any], start: float, result: Any, error: BaseException) -> None:
+        self.timings[stage.name] = (start - self._origin, time.monotonic() - self._origin)
+        for output in stage.outputs:
+            if output not in results:
+                if stage.optional:
+                    results[output] = None
+                else:
+                    self.errors[output] = error or RuntimeError(f"Stage {stage.name} did not produce {output}")
+        if error is None:
+            results[stage.name] = result
+            return
+        print(f"Stage {stage.name} failed: {error}")
+        if stage.optional:
+            results[stage.name] = None
+        else:
+            self.errors[stage.name] = error
+
+    def _call(self, stage: Stage, kwargs: Dict[str, Any], emit: Callable[[str, float, Any], None]) -> Tuple[float, Any, BaseException]:
+        start = time.monotonic()
+        try:
+            if not stage.outputs:
+                return start, stage.func(**kwargs), None
+            streamed = {}
+            for output, value in stage.func(**kwargs):
+                if output in stage.outputs and output not in streamed:
+                    streamed[output] = value
+                    emit(output, start, value)
+            return start, streamed, None
+        except Exception as e:
+            return start, None, e
+
+    def run(self, **initial) -> Dict[str, Any]:
+        """
+         Run every stage in the worker lane of the stage.
+
+         @param initial - Values available to the stages from the start
+
+         @return The results by stage name (and the initial values). Failed stages are listed in errors.
+        """
+        results = self._start(initial)
+        pending = dict(self.stages)
+        running: Dict[concurrent.futures.Future, Stage] = {}
+        # Streamed outputs and finished stages, in the order they happen
+        events = queue.Queue()
+
+        def emit(output: str, start: float, value: Any) -> None:
+            events.put((output, start, value))
+
+        try:
+            while pending or running:
+                for stage in self._ready(pending, results):
+                    kwargs = {dependency: results[dependency] for dependency in stage.inputs}
+                    future = worker_pool.submit(stage.lane, self._call, stage, kwargs, emit)
+                    running[future] = stage
+                    future.add_done_callback(lambda future: events.put((future, None, None)))
+                if not running:
+                    break
+                event, start, value = events.get()
+                if isinstance(event, str):
+                    self._emitted(event, results, start, value)
+                else:
+                    self._finish(running.pop(event), results, *event.result())
+        finally:
+            concurrent.futures.wait(running)
+        return results
+
+    async def async_run(self, **initial) -> Dict[str, Any]:
+        """
+         Asynchronous version of run. Coroutine functions run on the event loop, plain functions in their lane.
+
+         @param initial - Values available to the stages from the start
+
+         @return The results by stage name (and the initial values). Failed stages are listed in errors.
+        """
+        results = self._start(initial)
+        pending = dict(self.stages)
+        running: Dict[asyncio.Task, Stage] = {}
+        events = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+
+        def emit(output: str, start: float, value: Any) -> None:
+            # Called on the loop by async generators and from the lane by plain generators
+            loop.call_soon_threadsafe(events.put_nowait, (output, start, value))
+
+        async def call(stage: Stage, kwargs: Dict[str, Any]) -> Tuple[float, Any, BaseException]:
+            start = time.monotonic()
+            try:
+                if inspect.isasyncgenfunction(stage.func):
+                    streamed = {}
+                    async for output, value in stage.func(**kwargs):
+                        if output in stage.outputs and output not in streamed:
+                            streamed[output] = value
+                            emit(output, start, value)
+                    return start, streamed, None
+                if asyncio.iscoroutinefunction(stage.func):
+                    return start, await stage.func(**kwargs), None
+                return await worker_pool.run(stage.lane, self._call, stage, kwargs, emit)
+            except Exception as e:
+                return start, None, e
+
+        try:
+            while pending or running:
+                for stage in self._ready(pending, results):
+                    kwargs = {dependency: results[dependency] for dependency in stage.inputs}
+                    task = asyncio.ensure_future(call(stage, kwargs))
+                    running[task] = stage
+                    task.add_done_callback(lambda task: events.put_nowait((task, None, None)))
+                if not running:
+                    break
+                event, start, value = await events.get()
+                if isinstance(event, str):
+                    self._emitted(event, results, start, value)
+                else:
+                    self._finish(running.pop(event), results, *event.result())
+        finally:
+            for task in running:
+                task.cancel()
+        return results
+
+    def critical_path(self) -> List[Tuple[str, float]]:
+        """
+         The chain of stages that determined the wall-clock time of the last run: starting from the stage that
+         finished last, follow the input that finished last, which is the one the stage was waiting for.
+
+         @return (stage name, seconds) pairs in execution order
+        """
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda stage: self.timings[stage][1])
+        path = []
+        while name is not None:
+            start, end = self.timings[name]
+            path.append((name, end - start))
+            # A streamed output waited on the inputs of the stage producing it
+            inputs = [dependency for dependency in self.stages[self.producers.get(name, name)].inputs if dependency in self.timings]
+            name = max(inputs, key=lambda stage: self.timings[stage][1]) if inputs else None
+        return path[::-1]
+
+    def report(self) -> str:
+        """
+         Describe the critical path of the last run.
+
+         @return A line such as "brief 2.1s -> content 18.4s -> site 0.0s (20.5s of 20.6s)"
+        """
+        path = self.critical_path()
+        if not path:
+            return "No stage ran"
+        wall = max(end for _, end in self.timings.values())
+        chain = " -> ".join(f"{name} {round(seconds, 1)}s" for name, seconds in path)
+        return f"{chain} ({round(sum(seconds for _, seconds in path), 1)}s of {round(wall, 1)}s)"
@@ -7,6 +7,7 @@ import time
 from threading import Thread
 from typing import List
 from dotenv import load_dotenv
+from model_router import seo_model_router
 
 # Load .env file
 load_dotenv()
@@ -16,7 +17,6 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 
 # Use the API key
 openai.api_key = openai_api_key
-openai.Model.list()
 
 
 def generate_response(prompt: str,
@@ -66,8 +66,9 @@ def chat_with_gpt3(stage: str,
                    p: float = 0.5,
                    freq: float = 0,
                    presence: float = 0,
-                   model: str = "gpt-3.5-turbo-16k") -> str:
+                   model: str = None) -> str:
     max_retries = 5
+    model = model or seo_model_router.model(stage)
     for retries in range(max_retries):
         response, prompt_tokens, completion_tokens, total_tokens = generate_response(prompt, temp, p, freq, presence, retries, max_retries, model)
         if response is not None:   # If a response was successfully received
@@ -223,7 +224,7 @@ def generate_content(company_name: str,
     # Write about 100 words.
     # Use this as the an outline for the content: {outline}
     
-    content = chat_with_gpt3("Content Generation", prompt, temp=0.7, p=0.8, model="gpt-3.5-turbo-16k")
+    content = chat_with_gpt3("Content Generation", prompt, temp=0.7, p=0.8)
     return content
     
 
@@ -237,7 +238,7 @@ def convert_to_html(content: str) -> str:
     - Include a meta description as well as a meta keywords tag:
     {content}
     """
-    website = chat_with_gpt3("HTML Conversion", prompt, temp=0.2, p=0.1, model = "gpt-3.5-turbo-16k")
+    website = chat_with_gpt3("HTML Conversion", prompt, temp=0.2, p=0.1)
     return website
 
 
@@ -272,7 +273,7 @@ def add(website: str, component: str) -> str:
     - Add a {component} in this HTML code:
     {website}
     """
-    website = chat_with_gpt3(f"Adding {component}", prompt, temp=0.2, p=0.1, model = "gpt-3.5-turbo-16k")
+    website = chat_with_gpt3(f"Adding {component}", prompt, temp=0.2, p=0.1)
     website = fail_safe(website)
     return website    
 
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+#==================================================================================================
+# Single-Flight
+#==================================================================================================
+
+
+class _AsyncCall:
+    """The shared task of one in-flight coroutine call and the number of callers awaiting it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+     Coalesces concurrent identical calls: while a call for a key is in flight, every other caller with the same
+     key waits for it and receives the same result or exception instead of issuing its own upstream request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self._async_calls: Dict[Tuple[int, Hashable], _AsyncCall] = {}
+
+    def do(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        """
+         Run func once for all concurrent callers using the same key.
+
+         @param key - Identifies identical requests
+         @param func - The function performing the upstream call
+
+         @return The result of the shared call. Its exception is raised in every caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def async_do(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        """
+         Asynchronous version of do. The call runs as a task shared by the callers of the running event loop.
+         A cancelled caller stops waiting without affecting the others, and the shared task is cancelled once
+         no caller is waiting for it anymore.
+
+         @param key - Identifies identical requests
+         @param func - The coroutine function performing the upstream call
+
+         @return The result of the shared call. Its exception is raised in every caller.
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        with self._lock:
+            call = self._async_calls.get(loop_key)
+            if call is None:
+                call = _AsyncCall(loop.create_task(func(*args, **kwargs)))
+                self._async_calls[loop_key] = call
+                call.task.add_done_callback(lambda task, call=call: self._forget_locked(loop_key, call))
+            call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            with self._lock:
+                call.waiters -= 1
+                abandoned = call.waiters == 0 and not call.task.done()
+                if abandoned:
+                    # Nobody is waiting anymore, new callers must not join a task that is being cancelled
+                    self._forget(loop_key, call)
+            if abandoned:
+                call.task.cancel()
+
+    def _forget(self, loop_key: Tuple[int, Hashable], call: _AsyncCall) -> None:
+        if self._async_calls.get(loop_key) is call:
+            del self._async_calls[loop_key]
+
+    def _forget_locked(self, loop_key: Tuple[int, Hashable], call: _AsyncCall) -> None:
+        with self._lock:
+            self._forget(loop_key, call)
@@ -0,0 +1,412 @@
+import concurrent.futures
+import functools
+import json
+import mimetypes
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional
+from .worker_pool import worker_pool
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# "local" keeps the assets in the workspace, "s3" uploads them to BUCKET_NAME. Production defaults to s3
+storage_backend = os.getenv("STORAGE_BACKEND", "") or ("s3" if os.getenv("MEMORY_DIRECTORY", "local") == "production" else "local")
+bucket_name = os.getenv("BUCKET_NAME", None)
+campaign_id = os.getenv("CAMPAIGN_ID", "0")
+# Endpoint of an S3-compatible server such as MinIO, the AWS endpoint when empty
+s3_endpoint_url = os.getenv("S3_ENDPOINT_URL", "") or None
+# Files above this size are uploaded in parts of the chunk size, several parts at a time
+multipart_threshold_mb = float(os.getenv("MULTIPART_THRESHOLD_MB", "8"))
+multipart_chunk_mb = float(os.getenv("MULTIPART_CHUNK_MB", "8"))
+# Parts of one file uploaded at the same time
+multipart_concurrency = int(os.getenv("MULTIPART_CONCURRENCY", "4"))
+# Assets are named after their content, so a URL always serves the same bytes and can be cached forever
+asset_cache_control = os.getenv("ASSET_CACHE_CONTROL", "public, max-age=31536000, immutable")
+
+#==================================================================================================
+# Content Addressing
+#==================================================================================================
+
+# Hex digits of the sha256 digest kept in asset names, 80 bits
+ASSET_HASH_LENGTH = 20
+
+
+def content_name(digest: str, extension: str) -> str:
+    """
+     Name an asset after its content.
+
+     @param digest - The hex sha256 digest of the file
+     @param extension - The file extension without the dot
+
+     @return The file name
+    """
+    return f"{digest[:ASSET_HASH_LENGTH]}.{extension}"
+
+
+class AssetManifest:
+    """
+     The asset keys used by the layout of every generated site, saved as JSON next to the local assets. The
+     reference count of an asset is the number of sites using it. Regenerating a site replaces its references and
+     deleting it releases them, an asset whose count drops to 0 is listed by unreferenced until it is deleted.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        # Keys by site, the references they make by key, and when each unreferenced key was released (epoch)
+        self._sites: Optional[Dict[str, List[str]]] = None
+        self._refs: Counter = Counter()
+        self._released: Dict[str, float] = {}
+
+    def _load(self) -> Dict[str, List[str]]:
+        if self._sites is None:
+            data = {}
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f"Unable to read the asset manifest, starting a new one: {e}")
+            self._sites = data.get("sites", {})
+            self._released = data.get("released", {})
+            self._refs = Counter(key for keys in self._sites.values() for key in set(keys))
+        return self._sites
+
+    def _save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            partial = self.path.with_name(self.path.name + ".part")
+            with open(partial, "w") as f:
+                json.dump({"sites": self._sites, "released": self._released}, f, indent=1, sort_keys=True)
+            # Replaced in one step, a reader never sees half a manifest
+            os.replace(partial, self.path)
+        except OSError as e:
+            print(f"Unable to save the asset manifest: {e}")
+
+    def _update(self, site: str, keys: List[str]) -> None:
+        sites = self._load()
+        now = time.time()
+        old, new = set(sites.get(site, ())), set(keys)
+        for key in new - old:
+            self._refs[key] += 1
+            self._released.pop(key, None)
+        for key in old - new:
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                del self._refs[key]
+                self._released[key] = now
+        if keys:
+            sites[site] = sorted(new)
+        else:
+            sites.pop(site, None)
+        self._save()
+
+    def set_site(self, site: str, keys: Iterable[str]) -> None:
+        """
+         Record the assets of a generated site, releasing those of its previous version.
+
+         @param site - Identifies the site
+         @param keys - The keys of every asset its layout uses
+        """
+        with self._lock:
+            self._update(site, list(keys))
+
+    def release_site(self, site: str) -> None:
+        """
+         Release the assets of a deleted site.
+
+         @param site - Identifies the site
+        """
+        with self._lock:
+            self._update(site, [])
+
+    def refs(self, key: str) -> int:
+        with self._lock:
+            self._load()
+            return self._refs[key]
+
+    def unreferenced(self) -> Dict[str, float]:
+        """
+         @return The keys of the assets no site uses anymore, with the time they were released
+        """
+        with self._lock:
+            self._load()
+            return dict(self._released)
+
+    def forget(self, keys: Iterable[str]) -> None:
+        """
+         Remove deleted assets from the manifest.
+
+         @param keys - The keys of the deleted assets
+        """
+        with self._lock:
+            self._load()
+            for key in keys:
+                self._released.pop(key, None)
+            self._save()
+
+#==================================================================================================
+# Storage Backends
+#==================================================================================================
+
+
+class StorageBackend:
+    """
+     Where the assets of a site are published. key names the asset in the backend, exists and put_file are
+     called from the upload lane.
+    """
+
+    def key(self, name: str) -> str:
+        return name
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def put_file(self, path: Path, key: str) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class LocalStorage(StorageBackend):
+    """
+     Keeps the assets in a local directory. Files saved in that directory already are left where they are.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def exists(self, key: str) -> bool:
+        return (self.root / key).exists()
+
+    def put_file(self, path: Path, key: str) -> None:
+        target = self.root / key
+        if Path(path).resolve() != target.resolve():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(path, target)
+
+    def delete(self, key: str) -> None:
+        (self.root / key).unlink(missing_ok=True)
+
+
+class S3Storage(StorageBackend):
+    """
+     Uploads the assets to the asset folder of the campaign in an S3-compatible bucket, with one client shared
+     by every upload thread. Each thread may upload transfer_concurrency parts at once, the connection pool of
+     the client has room for all of them.
+    """
+
+    def __init__(self, bucket: str, prefix: str, endpoint_url: Optional[str] = None, upload_threads: int = 10,
+                 transfer_concurrency: int = multipart_concurrency):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.upload_threads = max(1, upload_threads)
+        self.transfer_concurrency = max(1, transfer_concurrency)
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                # Imported on first upload, boto3 is slow to import and only needed in production
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+                from botocore.config import Config
+                self._client = boto3.client("s3", endpoint_url=self.endpoint_url,
+                                            config=Config(max_pool_connections=self.upload_threads * self.transfer_concurrency,
+                                                          retries={"max_attempts": 5, "mode": "adaptive"}))
+                self._transfer_config = TransferConfig(multipart_threshold=int(multipart_threshold_mb * 1024 * 1024),
+                                                       multipart_chunksize=int(multipart_chunk_mb * 1024 * 1024),
+                                                       max_concurrency=self.transfer_concurrency)
+            return self._client
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}/{name}"
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self._get_client().head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put_file(self, path: Path, key: str) -> None:
+        client = self._get_client()
+        content_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+        print("Uploading {}...".format(key))
+        client.upload_file(Filename=str(path), Bucket=self.bucket, Key=key,
+                           ExtraArgs={"ContentType": content_type, "CacheControl": asset_cache_control},
+                           Config=self._transfer_config)
+
+    def delete(self, key: str) -> None:
+        self._get_client().delete_object(Bucket=self.bucket, Key=key)
+
+#==================================================================================================
+# Upload Queue
+#==================================================================================================
+
+
+class AssetStore:
+    """
+     Publishes assets to a backend from the upload lane of the worker pool, so the render of the next image does
+     not wait for the upload of the previous one. Assets are named after their content, so an asset published
+     again, by this process or by any other one sharing the backend, is not uploaded again: the process skips
+     the keys it uploaded already, and checks the backend with exists for the others.
+     The manifest counts the sites using each asset, collect deletes the assets no site uses anymore.
+    """
+
+    # Keys remembered as uploaded, an asset published again after it was forgotten is only checked with exists
+    max_published = 10000
+
+    def __init__(self, backend: StorageBackend, manifest: Optional[AssetManifest] = None):
+        self.backend = backend
+        self.manifest = manifest
+        self._lock = threading.Lock()
+        # Uploads in progress and the time their key was last published, the time each uploaded key was last
+        # published and the error of the failed uploads, by key
+        self._uploads: dict = {}
+        self._requested: Dict[str, float] = {}
+        self._published: "OrderedDict[str, float]" = OrderedDict()
+        self._failed: dict = {}
+
+    def _upload(self, path: Path, key: str) -> None:
+        if not self.backend.exists(key):
+            self.backend.put_file(path, key)
+
+    def _done(self, key: str, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            requested = self._requested.get(key, 0)
+            if self._uploads.get(key) is future:
+                del self._uploads[key]
+                self._requested.pop(key, None)
+            if future.exception() is None:
+                # The time of the publish, not of the upload: a site released meanwhile must not keep the key
+                self._published[key] = requested
+                self._published.move_to_end(key)
+                while len(self._published) > self.max_published:
+                    self._published.popitem(last=False)
+            else:
+                # Kept until the asset is published again, which queues a new upload
+                self._failed[key] = future.exception()
+
+    def publish(self, path: Path) -> str:
+        """
+         Queue the upload of a saved asset.
+
+         @param path - The local file
+
+         @return The key the asset will have, usable in the layout before the upload completes
+        """
+        key = self.backend.key(Path(path).name)
+        future = None
+        with self._lock:
+            if key in self._published:
+                # The site being generated uses it, collect must not delete it before the site is registered
+                self._published[key] = time.time()
+                self._published.move_to_end(key)
+            else:
+                self._requested[key] = time.time()
+                if key not in self._uploads:
+                    self._failed.pop(key, None)
+                    future = self._uploads[key] = worker_pool.submit("upload", self._upload, Path(path), key)
+        if future is not None:
+            # Outside the lock, the callback runs at once if the upload is already done
+            future.add_done_callback(functools.partial(self._done, key))
+        return key
+
+    def wait(self, keys: Iterable[str], timeout: float = None) -> List[str]:
+        """
+         Wait for the uploads of some assets, e.g. those of one site. The uploads of the other sites are not
+         waited for.
+
+         @param keys - The keys returned by publish
+         @param timeout - Seconds to wait at most
+
+         @return The keys whose upload failed or did not complete in time
+        """
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            uploads = {key: self._uploads[key] for key in keys if key in self._uploads}
+        concurrent.futures.wait(uploads.values(), timeout=timeout)
+        failed = []
+        for key in keys:
+            future = uploads.get(key)
+            if future is not None:
+                # Checked on the future, its done callback may not have run yet
+                error = future.exception() if future.done() else TimeoutError("Upload not completed in time")
+            else:
+                with self._lock:
+                    error = self._failed.get(key)
+            if error is not None:
+                print(f"Upload of {key} failed: {error}")
+                failed.append(key)
+        return failed
+
+    def register(self, site: str, keys: Iterable[str]) -> None:
+        """
+         Count the references of a generated site to its assets, replacing those of its previous version.
+
+         @param site - Identifies the site
+         @param keys - The keys of every asset of its layout
+        """
+        if self.manifest is not None:
+            self.manifest.set_site(site, keys)
+
+    def release(self, site: str) -> None:
+        """
+         Drop the references of a deleted site.
+
+         @param site - Identifies the site
+        """
+        if self.manifest is not None:
+            self.manifest.release_site(site)
+
+    def collect(self) -> List[str]:
+        """
+         Delete the assets no site references anymore. An asset published again since it was released, by a site
+         that is still being generated, is kept.
+
+         @return The keys of the deleted assets
+        """
+        if self.manifest is None:
+            return []
+        deleted = []
+        for key, released in self.manifest.unreferenced().items():
+            # Under the lock, so that a publish of the same key does not skip its upload while it is deleted
+            with self._lock:
+                if key in self._uploads or self._published.get(key, 0) > released:
+                    continue
+                self._published.pop(key, None)
+                try:
+                    self.backend.delete(key)
+                    deleted.append(key)
+                except Exception as e:
+                    print(f"Unable to delete {key}: {e}")
+        self.manifest.forget(deleted)
+        return deleted
+
+
+def make_backend(workspace_path: str) -> StorageBackend:
+    """
+     Create the backend configured by STORAGE_BACKEND.
+
+     @param workspace_path - The workspace, the local backend keeps the assets in its content directory
+
+     @return The storage backend
+    """
+    if storage_backend == "s3":
+        return S3Storage(bucket_name, f"{campaign_id}/asset", s3_endpoint_url, upload_threads=worker_pool.lanes["upload"])
+    return LocalStorage(os.path.join(workspace_path, "content"))
@@ -0,0 +1,45 @@
+import sys
+import threading
+from pathlib import Path
+import pytest
+
+# The tests import the modules through the package alias of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from package_alias import register_package  # noqa: E402
+
+register_package()
+
+# Imported once the package is registered
+from seo_package.storage import StorageBackend  # noqa: E402
+
+
+class MemoryBackend(StorageBackend):
+    """
+     Keeps the uploaded keys in memory. The uploads of the keys in fail raise, those in block wait for release.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+        self.fail = set()
+        self.block = set()
+        self.release = threading.Event()
+
+    def exists(self, key):
+        return key in self.objects
+
+    def put_file(self, path, key):
+        if key in self.block:
+            self.release.wait(5)
+        self.puts.append(key)
+        if key in self.fail:
+            raise OSError(f"Upload of {key} refused")
+        self.objects[key] = path.read_bytes()
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+
+@pytest.fixture
+def backend():
+    return MemoryBackend()
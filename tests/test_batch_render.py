@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from seo_package import image_main
+from seo_package.image_cache import ImageCache
+
+
+@pytest.fixture
+def provider(monkeypatch, tmp_path):
+    # Every request is recorded, the images name their prompt and the request they came from
+    requests = []
+
+    def query_batch(prompts):
+        requests.append(("batch", list(prompts)))
+        return [f"batch {len(requests)}: {prompt}".encode() for prompt in prompts]
+
+    async def async_query_batch(prompts):
+        return query_batch(prompts)
+
+    def dall_e_images(prompt, n):
+        requests.append(("dalle", prompt, n))
+        return [f"{prompt} #{number}".encode() for number in range(n)]
+
+    def local_generate_batch(prompts):
+        requests.append(("local", list(prompts)))
+        return [prompt.encode() for prompt in prompts]
+
+    monkeypatch.setattr(image_main, "_query_batch", query_batch)
+    monkeypatch.setattr(image_main, "_async_query_batch", async_query_batch)
+    monkeypatch.setattr(image_main, "_dall_e_images", dall_e_images)
+    monkeypatch.setattr(image_main, "local_generate_batch", local_generate_batch)
+    monkeypatch.setattr(image_main, "valid_image", lambda method_name, prompt, image: image)
+    monkeypatch.setattr(image_main, "image_cache", ImageCache(str(tmp_path), enabled=False))
+    return requests
+
+
+def render(prompt):
+    return f"single: {prompt}".encode()
+
+
+def test_identical_prompts_share_a_dall_e_request(monkeypatch):
+    monkeypatch.setattr(image_main, "image_model", "dalle")
+    monkeypatch.setattr(image_main, "dall_e_max_n", 2)
+    prompts = ["barn", "lake", "barn", "barn"]
+    assert image_main.batch_groups(prompts) == [[0, 2], [3], [1]]
+
+
+def test_huggingface_prompts_are_chunked(monkeypatch):
+    monkeypatch.setattr(image_main, "image_model", "stabilityai")
+    monkeypatch.setattr(image_main, "hf_batch_size", 2)
+    assert image_main.batch_groups(["a", "b", "c", "d", "e"]) == [[0, 1], [2, 3], [4]]
+    # The default sends one prompt per request, the hosted Inference API renders a single input
+    monkeypatch.setattr(image_main, "hf_batch_size", 1)
+    assert image_main.batch_groups(["a", "b", "a"]) == [[0], [1], [2]]
+    monkeypatch.setattr(image_main, "image_model", "")
+    assert image_main.batch_groups(["a", "b"]) == [[0], [1]]
+
+
+def test_dall_e_batch_is_split_back_to_its_slots(monkeypatch, provider):
+    monkeypatch.setattr(image_main, "image_model", "dalle")
+    images = image_main.render_batch(render, ["barn", "lake", "barn"])
+    assert images == [b"barn #0", b"single: lake", b"barn #1"]
+    assert provider == [("dalle", "barn", 2)]
+
+
+def test_huggingface_batch_is_split_back_to_its_slots(monkeypatch, provider):
+    monkeypatch.setattr(image_main, "image_model", "stabilityai")
+    monkeypatch.setattr(image_main, "hf_batch_size", 2)
+    images = image_main.render_batch(render, ["a", "b", "c"])
+    assert provider == [("batch", ["a", "b"])]
+    assert images == [b"batch 1: a", b"batch 1: b", b"single: c"]
+
+
+def test_failed_huggingface_batch_renders_one_by_one(monkeypatch, provider):
+    monkeypatch.setattr(image_main, "image_model", "stabilityai")
+    monkeypatch.setattr(image_main, "_query_batch", lambda prompts: [])
+    assert image_main._render_group(render, ["a", "b", "c"], [0, 2]) == [b"single: a", b"single: c"]
+
+
+def test_local_batch(monkeypatch, provider):
+    monkeypatch.setattr(image_main, "image_model", "local")
+    monkeypatch.setattr(image_main, "local_batch_size", 4)
+    assert image_main.render_batch(render, ["a", "b"]) == [b"a", b"b"]
+    assert provider == [("local", ["a", "b"])]
+
+
+def test_async_batch_is_split_back_to_its_slots(monkeypatch, provider):
+    async def async_render(prompt):
+        return render(prompt)
+
+    async def valid_image(method_name, prompt, image):
+        return image
+
+    monkeypatch.setattr(image_main, "image_model", "stabilityai")
+    monkeypatch.setattr(image_main, "hf_batch_size", 2)
+    monkeypatch.setattr(image_main, "async_valid_image", valid_image)
+    images = asyncio.run(image_main.async_render_batch(async_render, ["a", "b", "c"]))
+    assert images == [b"batch 1: a", b"batch 1: b", b"single: c"]
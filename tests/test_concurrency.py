@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+import pytest
+from seo_package.concurrency import AIMDController
+
+
+def test_async_waiter_is_woken_by_release():
+    controller = AIMDController("test", initial=1)
+    controller.acquire()
+
+    async def main():
+        waiter = asyncio.ensure_future(controller.async_acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and len(controller._async_waiters) == 1
+        # Released from another thread, like a call finishing in a worker lane
+        released = time.monotonic()
+        threading.Thread(target=controller.release, args=(0.1,)).start()
+        await waiter
+        return time.monotonic() - released
+
+    assert asyncio.run(main()) < 0.04
+    assert controller.in_flight == 1
+    assert controller._async_waiters == {}
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    controller = AIMDController("test", initial=1)
+    controller.acquire()
+
+    async def main():
+        waiter = asyncio.ensure_future(controller.async_acquire())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(main())
+    assert controller._async_waiters == {}
+    controller.release(0.1)
+    assert controller.in_flight == 0
+
+
+def test_only_free_slots_are_handed_out():
+    controller = AIMDController("test", initial=2, maximum=2)
+    acquired = []
+
+    async def call(index):
+        async with controller.async_slot():
+            acquired.append(controller.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*(call(index) for index in range(6)))
+
+    asyncio.run(main())
+    assert len(acquired) == 6 and max(acquired) == 2
+    assert controller.in_flight == 0
+
+
+def test_closed_stream_is_neutral():
+    controller = AIMDController("test", initial=4)
+
+    def stream():
+        with controller.slot():
+            yield "first"
+            yield "second"
+
+    deltas = stream()
+    assert next(deltas) == "first"
+    deltas.close()
+    assert controller.in_flight == 0
+    assert controller.error_rate == 0.0
+    assert controller.latency_ewma is None
@@ -0,0 +1,73 @@
+import hashlib
+import io
+import numpy as np
+import pytest
+from PIL import Image
+from seo_package import image_main
+from seo_package.image_variants import make_variants
+from seo_package.storage import AssetStore, content_name
+
+
+def encode(format: str, seed: int = 0) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.default_rng(seed).integers(0, 255, (64, 64, 3)).astype("uint8")).save(buffer, format)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(image_main, "workspace_path", str(tmp_path))
+    monkeypatch.setattr(image_main, "asset_store", AssetStore(backend))
+    return tmp_path / "content"
+
+
+def test_content_name_is_the_sha256_prefix():
+    digest = hashlib.sha256(b"image").hexdigest()
+    assert content_name(digest, "jpg") == f"{digest[:20]}.jpg"
+
+
+def test_jpeg_is_named_after_its_bytes(tmp_path):
+    data = encode("JPEG")
+    name = image_main.save_as_jpg(data, tmp_path)
+    assert name == content_name(hashlib.sha256(data).hexdigest(), "jpg")
+    assert (tmp_path / name).read_bytes() == data
+    # A stream of the same bytes gets the same name
+    assert image_main.save_as_jpg(iter([data[:5], data[5:100], data[100:]]), tmp_path) == name
+    other = image_main.save_as_jpg(encode("JPEG", seed=1), tmp_path)
+    assert other != name
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([name, other])
+
+
+def test_converted_image_name_is_stable(tmp_path):
+    data = encode("PNG")
+    name = image_main.save_as_jpg(data, tmp_path)
+    assert name == image_main.save_as_jpg(data, tmp_path)
+    assert name == content_name(hashlib.sha256((tmp_path / name).read_bytes()).hexdigest(), "jpg")
+
+
+def test_saved_image_is_not_written_again(tmp_path, monkeypatch):
+    data = encode("JPEG")
+    name = image_main.save_as_jpg(data, tmp_path)
+    mtime = (tmp_path / name).stat().st_mtime_ns
+    monkeypatch.setattr(image_main.os, "replace", lambda *args: pytest.fail("rewritten"))
+    assert image_main.save_as_jpg(data, tmp_path) == name
+    assert (tmp_path / name).stat().st_mtime_ns == mtime
+
+
+def test_repeated_asset_is_published_once(workspace, backend):
+    data = encode("JPEG")
+    keys = [image_main.url_to_jpg(data, section) for section in ("banner", "about", "gallery")]
+    assert len(set(keys)) == 1
+    assert image_main.asset_store.wait(keys) == []
+    assert backend.puts == keys[:1]
+    assert [path.name for path in workspace.iterdir()] == keys[:1]
+
+
+def test_variant_names_are_stable(tmp_path):
+    path = tmp_path / image_main.save_as_jpg(encode("JPEG"), tmp_path)
+    first = make_variants(str(path), (32,), ("webp", "jpeg"), 80)
+    mtimes = {variant["file_name"]: (tmp_path / variant["file_name"]).stat().st_mtime_ns for variant in first}
+    assert make_variants(str(path), (32,), ("webp", "jpeg"), 80) == first
+    assert {name: (tmp_path / name).stat().st_mtime_ns for name in mtimes} == mtimes
+    # Another quality is another file
+    assert make_variants(str(path), (32,), ("webp",), 60)[0]["file_name"] != first[0]["file_name"]
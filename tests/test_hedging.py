@@ -0,0 +1,61 @@
+import threading
+import time
+from seo_package.concurrency import AIMDController
+from seo_package.hedging import Hedger, attempt_abandoned
+
+
+def test_slow_request_is_hedged_in_the_llm_lane():
+    hedger = Hedger(min_samples=1, max_ratio=1, enabled=True)
+    hedger.latencies.record("stage", 0.01)
+    controller = AIMDController("test", initial=4)
+    calls = []
+    loser_done = threading.Event()
+
+    def request():
+        index = len(calls)
+        calls.append(threading.current_thread().name)
+        with controller.slot():
+            time.sleep(0.5 if index == 0 else 0.01)
+        if index == 0:
+            calls.append(attempt_abandoned())
+            loser_done.set()
+        return index
+
+    assert hedger.call("stage", request) == 1
+    assert loser_done.wait(5)
+    assert all(name.startswith("llm-worker") for name in calls[:2])
+    # The loser knows it was abandoned and its slot was released without touching the statistics
+    assert calls[2] is True
+    assert controller.in_flight == 0
+    assert controller.latency_ewma < 0.1
+    assert hedger.metrics() == {"calls": 1, "hedges": 1}
+    assert max(hedger.latencies._samples["stage"]) < 0.4
+
+
+def test_fast_request_is_not_hedged():
+    hedger = Hedger(min_samples=1, max_ratio=1, enabled=True)
+    hedger.latencies.record("stage", 1.0)
+    calls = []
+    assert hedger.call("stage", lambda: calls.append(attempt_abandoned()) or "reply") == "reply"
+    assert calls == [False]
+    assert hedger.metrics() == {"calls": 1, "hedges": 0}
+
+
+def test_call_from_a_later_lane_is_not_hedged():
+    from seo_package.worker_pool import worker_pool
+    hedger = Hedger(min_samples=1, max_ratio=1, enabled=True)
+    hedger.latencies.record("stage", 0.01)
+    calls = []
+
+    def request():
+        calls.append(threading.current_thread().name)
+        time.sleep(0.05)
+        return "reply"
+
+    # An image lane thread never waits on the llm lane, the request runs in the calling thread
+    assert worker_pool.submit("image", hedger.call, "stage", request).result(5) == "reply"
+    assert len(calls) == 1 and calls[0].startswith("image-worker")
+    assert hedger.metrics() == {"calls": 1, "hedges": 0}
+    assert not worker_pool.waits_backwards("llm")
+    assert worker_pool.submit("stage", worker_pool.waits_backwards, "llm").result(5) is False
+    assert worker_pool.submit("io", worker_pool.waits_backwards, "image").result(5) is True
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import threading
+from seo_package import image_cache as image_cache_module
+from seo_package import image_main
+from seo_package.image_cache import ImageCache, image_key
+
+
+def test_key_ignores_case_and_whitespace():
+    key = image_key("huggingface", "model", "A  red\nbarn", "512x512")
+    assert key == image_key("huggingface", "model", "a red barn", "512x512")
+    assert key != image_key("huggingface", "model", "a red barn", "1024x1024")
+    assert key != image_key("dalle", "model", "a red barn", "512x512")
+
+
+def test_hit_and_miss(tmp_path):
+    cache = ImageCache(str(tmp_path), enabled=True)
+    assert cache.get("ab12") is None
+    cache.set("ab12", b"image")
+    assert cache.get("ab12") == b"image"
+    # The index is rebuilt from the directory by a new process
+    assert ImageCache(str(tmp_path), enabled=True).get("ab12") == b"image"
+    assert ImageCache(str(tmp_path), enabled=False).get("ab12") is None
+
+
+def test_unused_images_expire(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(image_cache_module.time, "time", lambda: now[0])
+    cache = ImageCache(str(tmp_path), enabled=True, ttl=60)
+    cache.set("ab12", b"image")
+    os.utime(cache._file("ab12"), (now[0], now[0]))
+    now[0] += 59
+    # A hit makes the image recently used again
+    assert cache.get("ab12") == b"image"
+    now[0] += 59
+    assert cache.get("ab12") == b"image"
+    now[0] += 61
+    assert cache.get("ab12") is None
+    assert not os.path.exists(cache._file("ab12"))
+    assert cache._size == 0
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=25, enabled=True)
+    for key in ("aa01", "bb02"):
+        cache.set(key, b"x" * 10)
+    assert cache.get("aa01") is not None
+    cache.set("cc03", b"x" * 10)
+    assert cache.get("bb02") is None
+    assert not os.path.exists(cache._file("bb02"))
+    assert cache.get("aa01") is not None and cache.get("cc03") is not None
+    assert cache._size == 20
+    # A single image larger than the limit is still kept
+    cache.set("dd04", b"x" * 40)
+    assert list(cache._entries) == ["dd04"]
+
+
+def test_async_cache_calls_run_in_the_io_lane(tmp_path, monkeypatch):
+    threads = []
+
+    class Recording(ImageCache):
+        def get(self, key):
+            threads.append(threading.current_thread())
+            return super().get(key)
+
+        def set(self, key, data):
+            threads.append(threading.current_thread())
+            super().set(key, data)
+
+    async def render(prompt):
+        return b"image"
+
+    monkeypatch.setattr(image_main, "image_cache", Recording(str(tmp_path), enabled=True))
+    monkeypatch.setattr(image_main, "async_valid_image", lambda method_name, prompt, image: render(prompt))
+
+    async def main():
+        images = [await image_main.async_cached_render(render, "a red barn") for _ in range(2)]
+        return images, threading.current_thread()
+
+    images, loop_thread = asyncio.run(main())
+    assert images == [b"image", b"image"]
+    # A miss and its store, then a hit
+    assert len(threads) == 3
+    assert loop_thread not in threads
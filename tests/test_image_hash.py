@@ -0,0 +1,55 @@
+import io
+import numpy as np
+from PIL import Image
+from seo_package.image_hash import HashIndex, dhash, find_duplicates
+
+
+def jpeg(pixels: np.ndarray, quality: int = 90) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.astype("uint8")).save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def noise(seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 255, (64, 64, 3))
+
+
+def test_recompressed_image_is_a_near_duplicate():
+    index = HashIndex(threshold=10)
+    assert index.add("first", dhash(jpeg(noise(0)))) is None
+    assert index.find(dhash(jpeg(noise(0), quality=40))) == "first"
+    assert index.find(dhash(jpeg(noise(1)))) is None
+    assert index.add("copy", dhash(jpeg(noise(0), quality=60)), unique=True) == "first"
+    assert len(index) == 1
+
+
+def test_index_grows_past_its_initial_array():
+    index = HashIndex(threshold=0)
+    for value in range(100):
+        index.add(str(value), value)
+    assert len(index) == 100
+    assert len(index._hashes) == 128
+    assert index.find(99) == "99" and index.find(0) == "0"
+    assert index.duplicates() == []
+
+
+def test_bounded_index_replaces_the_oldest_hashes():
+    index = HashIndex(threshold=0, capacity=20)
+    for value in range(50):
+        index.add(str(value), value)
+    assert len(index) == 20 and len(index._hashes) == 20
+    assert index.find(29) is None
+    assert [index.find(value) for value in (30, 49)] == ["30", "49"]
+    index.add("again", 49)
+    assert index.find(30) is None
+    assert [sorted(pair[:2]) for pair in index.duplicates()] == [["49", "again"]]
+
+
+def test_duplicates_are_found_across_site_directories(tmp_path):
+    for site, seed in (("bakery", 0), ("florist", 1)):
+        (tmp_path / site).mkdir()
+        (tmp_path / site / "gallery.jpg").write_bytes(jpeg(noise(seed)))
+    (tmp_path / "florist" / "copy.jpg").write_bytes(jpeg(noise(0), quality=50))
+    (tmp_path / "florist" / "notes.txt").write_text("not an image")
+    pairs = find_duplicates(str(tmp_path))
+    assert [(first, second) for first, second, _ in pairs] == [(str(tmp_path / "bakery" / "gallery.jpg"), str(tmp_path / "florist" / "copy.jpg"))]
@@ -0,0 +1,129 @@
+import seo_package.content_main as content_main
+import seo_package.llm_cache as llm_cache
+from seo_package.llm_cache import ResponseCache, make_key
+
+
+def rows(cache):
+    return cache._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def test_key_is_stable():
+    request = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hi"}], "temperature": 1, "top_p": 0.5}
+    reordered = {"top_p": 0.5, "temperature": 1.0, "messages": [{"role": "user", "content": "hi"}], "model": "gpt-3.5-turbo"}
+    assert make_key(request) == make_key(reordered)
+    assert make_key(request) != make_key(dict(request, temperature=0.9))
+    assert make_key(request) != make_key(dict(request, model="gpt-4"))
+
+
+def test_entries_expire(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), ttl=60, enabled=True)
+    cache.set("key", "reply")
+    now[0] += 59
+    assert cache.get("key") == "reply"
+    now[0] += 2
+    assert cache.get("key") is None
+    assert rows(cache) == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), ttl=0, max_entries=10, evict_fraction=0.3, enabled=True)
+    for index in range(10):
+        now[0] += 1
+        cache.set(f"key{index}", str(index))
+    now[0] += 1
+    assert cache.get("key0") == "0"
+    now[0] += 1
+    cache.set("key10", "10")
+    # Going over the limit evicts the least recently used entries down to 7, key0 was read and is kept
+    assert rows(cache) == 7
+    assert cache.get("key0") == "0"
+    assert [cache.get(f"key{index}") for index in range(1, 5)] == [None] * 4
+    assert cache.get("key10") == "10"
+
+
+def test_writes_under_the_limit_do_not_evict(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), ttl=0, max_entries=10, evict_fraction=0.3, enabled=True)
+    statements = []
+    cache._connect().set_trace_callback(statements.append)
+    for index in range(10):
+        cache.set(f"key{index}", str(index))
+    # Replacing an entry does not grow the cache
+    cache.set("key0", "again")
+    assert not [statement for statement in statements if statement.lstrip().startswith("DELETE")]
+    assert rows(cache) == 10
+
+
+def test_count_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(path, ttl=0, max_entries=5, evict_fraction=0.2, enabled=True)
+    for index in range(5):
+        cache.set(f"key{index}", str(index))
+    reopened = ResponseCache(path, ttl=0, max_entries=5, evict_fraction=0.2, enabled=True)
+    reopened.set("key5", "5")
+    assert rows(reopened) == 4
+
+
+def test_invalid_replies_are_not_cached(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), enabled=True)
+    monkeypatch.setattr(content_main, "response_cache", cache)
+    replies = iter(["not json", '{"banner": {}}'])
+    sent = []
+
+    def send(request, stage=None, hedge=False):
+        sent.append(request["model"])
+        return next(replies)
+
+    monkeypatch.setattr(content_main, "_send_chat", send)
+    for _ in range(2):
+        reply = content_main.chat_with_gpt3("prompt", model="gpt-3.5-turbo", validate=content_main.content_complete)
+    # The rejected reply was not served again, the valid one is
+    assert reply == '{"banner": {}}'
+    assert content_main.chat_with_gpt3("prompt", model="gpt-3.5-turbo", validate=content_main.content_complete) == reply
+    assert len(sent) == 2
+
+
+def test_async_cache_calls_run_in_the_io_lane(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), enabled=True)
+    threads = []
+
+    class Recording:
+        def get(self, key):
+            threads.append(threading.current_thread())
+            return cache.get(key)
+
+        def set(self, key, content):
+            threads.append(threading.current_thread())
+            cache.set(key, content)
+
+    async def send(request, stage=None, hedge=False):
+        return "reply"
+
+    monkeypatch.setattr(content_main, "response_cache", Recording())
+    monkeypatch.setattr(content_main, "_async_send_chat", send)
+
+    async def main():
+        loop_thread = threading.current_thread()
+        for _ in range(2):
+            assert await content_main.async_chat_with_gpt3("prompt", model="gpt-3.5-turbo") == "reply"
+        return loop_thread
+
+    loop_thread = asyncio.run(main())
+    # get, set, then a cache hit, none of them on the event loop thread
+    assert len(threads) == 3
+    assert loop_thread not in threads
+
+
+def test_creative_stages_bypass_the_cache(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), enabled=True)
+    monkeypatch.setattr(content_main, "response_cache", cache)
+    replies = iter(["Fresh Bread Daily", "Bread Baked At Dawn"])
+    monkeypatch.setattr(content_main, "_send_chat", lambda request, stage=None, hedge=False: next(replies))
+    titles = [content_main.generate_title("Bakery", "sourdough") for _ in range(2)]
+    assert titles == ["Fresh Bread Daily", "Bread Baked At Dawn"]
+    assert rows(cache) == 0
@@ -0,0 +1,57 @@
+import concurrent.futures
+import pytest
+from seo_package import local_diffusion
+from seo_package.local_diffusion import PromptBatcher
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    # The batches run in a thread instead of a diffusion worker process
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    batches = []
+
+    def submit_process(render, prompts, pool="cpu"):
+        batches.append(list(prompts))
+        return executor.submit(render, prompts)
+
+    monkeypatch.setattr(local_diffusion.worker_pool, "submit_process", submit_process)
+    yield batches
+    executor.shutdown()
+
+
+def render(prompts):
+    return [prompt.encode() for prompt in prompts]
+
+
+def test_full_batches_are_sent_at_once(renders):
+    batcher = PromptBatcher(render, batch_size=2, window=60)
+    futures = [batcher.submit(prompt) for prompt in ("banner", "about", "faq", "blog")]
+    assert [future.result(5) for future in futures] == [b"banner", b"about", b"faq", b"blog"]
+    assert renders == [["banner", "about"], ["faq", "blog"]]
+
+
+def test_partial_batch_is_sent_after_the_window(renders):
+    batcher = PromptBatcher(render, batch_size=4, window=0.05)
+    futures = [batcher.submit(prompt) for prompt in ("banner", "about")]
+    assert [future.result(5) for future in futures] == [b"banner", b"about"]
+    assert renders == [["banner", "about"]]
+
+
+def test_short_result_fails_the_unmatched_prompts(renders):
+    batcher = PromptBatcher(lambda prompts: render(prompts[:1]), batch_size=3, window=60)
+    futures = [batcher.submit(prompt) for prompt in ("banner", "about", "faq")]
+    assert futures[0].result(5) == b"banner"
+    for future in futures[1:]:
+        with pytest.raises(RuntimeError, match="1 images rendered for 3 prompts"):
+            future.result(5)
+
+
+def test_failed_render_fails_the_whole_batch(renders):
+    def fail(prompts):
+        raise MemoryError("out of memory")
+
+    batcher = PromptBatcher(fail, batch_size=2, window=60)
+    futures = [batcher.submit(prompt) for prompt in ("banner", "about")]
+    for future in futures:
+        with pytest.raises(MemoryError):
+            future.result(5)
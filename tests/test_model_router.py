@@ -0,0 +1,90 @@
+import asyncio
+from seo_package import model_router
+from seo_package.model_router import MODEL_ROUTES, SEO_MODEL_ROUTES, ModelRouter, load_routes
+
+ROUTES = {
+    "Content Generation": {"model": "cheap", "escalate": "strong"},
+    "Title Generation": {"model": "cheap", "escalate": None},
+    "Adding": {"model": "styling", "escalate": None},
+}
+
+
+def stub(*replies):
+    # Answers with the next reply and records the model of every call
+    models = []
+    replies = iter(replies)
+
+    def call(model):
+        models.append(model)
+        return next(replies)
+
+    return call, models
+
+
+def test_valid_reply_is_not_escalated():
+    call, models = stub("good")
+    assert ModelRouter(ROUTES).call("Content Generation", call, lambda reply: reply == "good") == "good"
+    assert models == ["cheap"]
+
+
+def test_invalid_reply_is_escalated_once():
+    call, models = stub("bad", "still bad")
+    router = ModelRouter(ROUTES)
+    assert router.call("Content Generation", call, lambda reply: reply == "good") == "still bad"
+    # The stronger model's reply is returned even if it fails validation too, there is no second escalation
+    assert models == ["cheap", "strong"]
+
+
+def test_stage_without_escalation_keeps_its_reply():
+    call, models = stub("bad")
+    assert ModelRouter(ROUTES).call("Title Generation", call, lambda reply: False) == "bad"
+    assert models == ["cheap"]
+
+
+def test_async_call_escalates_once():
+    models = []
+
+    async def call(model):
+        models.append(model)
+        return model
+
+    router = ModelRouter(ROUTES)
+    assert asyncio.run(router.async_call("Content Generation", call, lambda reply: reply == "strong")) == "strong"
+    assert models == ["cheap", "strong"]
+
+
+def test_unknown_and_prefixed_stages():
+    router = ModelRouter(ROUTES, default="fallback")
+    assert router.model("Adding footer") == "styling"
+    assert router.model("Addingfooter") == "fallback"
+    assert router.model("Site Brief") == "fallback"
+    assert router.model(None) == "fallback"
+
+
+def test_seo_stages_default_to_the_long_context_model(monkeypatch):
+    monkeypatch.setattr(model_router, "model_routes", "")
+    router = ModelRouter(load_routes(SEO_MODEL_ROUTES, "long"), "long")
+    # Short prompts use the cheap model, the stages sending whole pages the long context one
+    assert router.model("Title Generation") == "gpt-3.5-turbo"
+    assert router.model("Outline Generation") == "long"
+    assert router.model("Adding footer") == "long"
+    assert not any(route["escalate"] for route in SEO_MODEL_ROUTES.values())
+    # The main pipeline fits its outline in the cheap model
+    assert ModelRouter(load_routes()).model("Outline Generation") == "gpt-3.5-turbo"
+    assert set(SEO_MODEL_ROUTES) < set(MODEL_ROUTES)
+
+
+def test_overrides_apply_to_both_tables(monkeypatch):
+    monkeypatch.setattr(model_router, "model_routes", '{"Outline Generation": {"model": "custom"}, "New Stage": {"escalate": "strong"}}')
+    routes = load_routes(SEO_MODEL_ROUTES, "long")
+    assert routes["Outline Generation"] == {"model": "custom", "escalate": None}
+    assert routes["New Stage"] == {"model": "long", "escalate": "strong"}
+    assert load_routes()["Outline Generation"] == {"model": "custom", "escalate": None}
+    # The default tables are not modified
+    assert "Outline Generation" not in SEO_MODEL_ROUTES
+    assert MODEL_ROUTES["Outline Generation"]["model"] == "gpt-3.5-turbo"
+
+
+def test_invalid_overrides_are_ignored(monkeypatch):
+    monkeypatch.setattr(model_router, "model_routes", "not json")
+    assert load_routes() == MODEL_ROUTES
@@ -0,0 +1,114 @@
+import pytest
+from seo_package import rate_limiter
+from seo_package.rate_limiter import RateLimiter, _Bucket, parse_reset
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # A fake clock, sleeping advances it instead of waiting
+    now = [1000.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(rate_limiter.time, "sleep", sleep)
+    return now, sleeps
+
+
+def test_parse_reset():
+    assert parse_reset("20ms") == pytest.approx(0.02)
+    assert parse_reset("1s") == 1
+    assert parse_reset("6m0s") == 360
+    assert parse_reset("1h2m3.5s") == 3723.5
+    assert parse_reset("") == 0 and parse_reset(None) == 0 and parse_reset("soon") == 0
+
+
+def test_bucket_refills_continuously_up_to_its_limit(clock):
+    now, _ = clock
+    bucket = _Bucket(60)
+    bucket.available = 0
+    bucket.refill(now[0] + 10)
+    assert bucket.available == 10
+    bucket.refill(now[0] + 1000)
+    assert bucket.available == 60
+
+
+def test_bucket_wait_time(clock):
+    now, _ = clock
+    bucket = _Bucket(60)
+    bucket.available = 5
+    assert bucket.wait_time(5, now[0]) == 0
+    assert bucket.wait_time(20, now[0]) == 15
+    # A cost above the limit waits for a full bucket instead of forever
+    assert bucket.wait_time(600, now[0]) == 55
+    bucket.blocked_until = now[0] + 30
+    assert bucket.wait_time(1, now[0]) == 30
+
+
+def test_acquire_waits_for_the_request_budget(clock):
+    now, sleeps = clock
+    limiter = RateLimiter(requests_per_minute=2)
+    limiter.acquire()
+    limiter.acquire()
+    assert sleeps == []
+    limiter.acquire()
+    assert sleeps == [30]
+
+
+def test_acquire_waits_for_the_token_budget(clock):
+    _, sleeps = clock
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=600)
+    limiter.acquire(500)
+    limiter.acquire(400)
+    assert sleeps == [pytest.approx(30)]
+    assert limiter._tokens.available == pytest.approx(0)
+
+
+def test_record_usage_returns_the_unused_tokens(clock):
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=1000)
+    limiter.acquire(600)
+    limiter.record_usage(600, 200)
+    assert limiter._tokens.available == 800
+    # Usage above the estimate is taken from the budget, which never exceeds the limit
+    limiter.record_usage(100, 300)
+    assert limiter._tokens.available == 600
+    limiter.record_usage(5000, 0)
+    assert limiter._tokens.available == 1000
+    limiter.record_usage(100, None)
+    assert limiter._tokens.available == 1000
+    RateLimiter(requests_per_minute=100).record_usage(100, 10)
+
+
+def test_headers_update_limits_and_remaining(clock):
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=1000)
+    limiter.update_from_headers({"x-ratelimit-limit-requests": "500", "x-ratelimit-remaining-requests": "20",
+                                 "x-ratelimit-limit-tokens": "bad", "x-ratelimit-remaining-tokens": "300"})
+    assert limiter._requests.limit == 500 and limiter._requests.available == 20
+    # An invalid header leaves its whole bucket unchanged
+    assert limiter._tokens.limit == 1000
+    assert limiter._tokens.available == 1000
+
+
+def test_exhausted_budget_blocks_until_the_reset(clock):
+    now, sleeps = clock
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=1000)
+    limiter.update_from_headers({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "6s"})
+    assert limiter._tokens.blocked_until == now[0] + 6
+    limiter.acquire(1)
+    assert sleeps[0] == 6
+
+
+def test_retry_after_blocks_the_requests(clock):
+    now, sleeps = clock
+    limiter = RateLimiter(requests_per_minute=100)
+    limiter.update_from_headers({"retry-after": "2"})
+    assert limiter._requests.blocked_until == now[0] + 2
+    # A shorter or invalid retry-after does not shorten the block
+    limiter.update_from_headers({"retry-after": "1"})
+    limiter.update_from_headers({"retry-after": "later"})
+    assert limiter._requests.blocked_until == now[0] + 2
+    limiter.acquire()
+    assert sleeps == [2]
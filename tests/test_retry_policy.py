@@ -0,0 +1,145 @@
+import pytest
+import requests
+from seo_package import retry_policy
+from seo_package.retry_policy import (CircuitBreaker, CircuitOpenError, RetryPolicy, is_retryable, is_throttled,
+                                      is_upstream_failure, retry_after)
+
+LOADING = b'{"error": "Model stabilityai/stable-diffusion-2-1-base is currently loading", "estimated_time": 20.0}'
+
+
+def http_error(status: int, body: bytes = b"", headers: dict = None) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response.headers.update(headers or {})
+    return requests.HTTPError(f"{status} error", response=response)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry_policy.time, "monotonic", lambda: now[0])
+    return now
+
+
+def fail(breaker: CircuitBreaker, error: Exception) -> None:
+    with pytest.raises(type(error)):
+        with breaker.guard():
+            raise error
+
+
+#==================================================================================================
+# Error Classification
+#==================================================================================================
+
+@pytest.mark.parametrize("error, throttled, failure, retryable", [
+    (http_error(429), True, False, True),
+    (http_error(503, LOADING), True, False, True),
+    (http_error(503, b"Service Unavailable"), False, True, True),
+    (http_error(500), False, True, True),
+    (http_error(502), False, True, True),
+    (http_error(400), False, False, False),
+    (http_error(401), False, False, False),
+    (requests.exceptions.ConnectionError("refused"), False, True, True),
+    (requests.exceptions.ReadTimeout("slow"), False, True, True),
+    (CircuitOpenError("open"), False, False, False),
+    (ValueError("bad reply"), False, False, False),
+])
+def test_status_classification(error, throttled, failure, retryable):
+    assert is_throttled(error) == throttled
+    assert is_upstream_failure(error) == failure
+    assert is_retryable(error) == retryable
+
+
+def test_retry_after_header_and_estimated_time():
+    assert retry_after(http_error(429, headers={"retry-after": "7"})) == 7
+    assert retry_after(http_error(429, headers={"retry-after-ms": "1500"})) == 1.5
+    assert retry_after(http_error(503, LOADING)) == 20
+    assert retry_after(http_error(500)) is None
+
+
+def test_retry_after_is_capped():
+    policy = RetryPolicy(initial_delay=0.001, max_retry_after=5)
+    assert policy.delay(0, http_error(429, headers={"retry-after": "3"})) == 3
+    assert policy.delay(0, http_error(429, headers={"retry-after": "600"})) == 5
+    assert policy.delay(0, http_error(503, LOADING)) == 5
+    assert policy.delay(0, http_error(500)) <= 0.001
+
+
+def test_call_waits_for_a_loading_model(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(retry_policy.time, "sleep", sleeps.append)
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    responses = [http_error(503, LOADING), http_error(503, LOADING), "image"]
+
+    def render():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert RetryPolicy(initial_delay=0.001).call(breaker, render) == "image"
+    assert sleeps == [20, 20]
+    assert breaker.state == "closed"
+
+#==================================================================================================
+# Circuit Breaker
+#==================================================================================================
+
+
+def test_throttling_leaves_the_breaker_closed(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    for _ in range(10):
+        fail(breaker, http_error(429))
+        fail(breaker, http_error(503, LOADING))
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_client_errors_do_not_open_the_breaker(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    for _ in range(5):
+        fail(breaker, http_error(400))
+    assert breaker.state == "closed"
+
+
+def test_open_half_open_close_cycle(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    fail(breaker, http_error(500))
+    assert breaker.state == "closed"
+    fail(breaker, requests.exceptions.ConnectionError("refused"))
+    assert breaker.state == "open"
+
+    clock[0] += 10
+    with pytest.raises(CircuitOpenError) as raised:
+        breaker.before_call()
+    assert raised.value.retry_after == pytest.approx(20)
+
+    # After the reset timeout one probe is let through, the others still fail fast
+    clock[0] += 20
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # A failed probe opens the circuit again
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    clock[0] += 30
+    with breaker.guard():
+        pass
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_throttled_probe_keeps_the_breaker_half_open(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    fail(breaker, http_error(500))
+    clock[0] += 30
+    fail(breaker, http_error(429))
+    assert breaker.state == "half_open"
+    # The next call probes again
+    with breaker.guard():
+        pass
+    assert breaker.state == "closed"
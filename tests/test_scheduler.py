@@ -0,0 +1,154 @@
+import asyncio
+import time
+import pytest
+from seo_package.scheduler import Stage, StageScheduler
+
+
+def test_cycles_are_rejected():
+    with pytest.raises(ValueError, match="cycle"):
+        StageScheduler([Stage("a", dict, ["c"]), Stage("b", dict, ["a"]), Stage("c", dict, ["b"])])
+    with pytest.raises(ValueError, match="itself"):
+        StageScheduler([Stage("a", dict, ["a"])])
+    with pytest.raises(ValueError, match="unique"):
+        StageScheduler([Stage("a", dict), Stage("a", dict)])
+
+
+def test_unknown_inputs_are_rejected():
+    scheduler = StageScheduler([Stage("a", lambda topic: topic, ["topic"])])
+    with pytest.raises(ValueError, match="topic"):
+        scheduler.run()
+    assert scheduler.run(topic="bread") == {"topic": "bread", "a": "bread"}
+
+
+def test_stages_receive_their_inputs():
+    scheduler = StageScheduler([
+        Stage("title", lambda topic: topic.title(), ["topic"]),
+        Stage("page", lambda title, topic: f"{title}: {topic}", ["title", "topic"]),
+    ])
+    assert scheduler.run(topic="bread")["page"] == "Bread: bread"
+
+
+def fail():
+    raise RuntimeError("upstream")
+
+
+def test_failed_optional_stage_gives_none():
+    scheduler = StageScheduler([
+        Stage("logo", fail, optional=True),
+        Stage("site", lambda logo: logo or "placeholder", ["logo"]),
+    ])
+    results = scheduler.run()
+    assert results["logo"] is None
+    assert results["site"] == "placeholder"
+    assert scheduler.errors == {}
+
+
+def test_failed_stage_skips_its_dependents():
+    scheduler = StageScheduler([
+        Stage("content", fail),
+        Stage("site", lambda content: content, ["content"]),
+        Stage("footer", lambda: "footer"),
+    ])
+    results = scheduler.run()
+    assert results == {"footer": "footer"}
+    assert isinstance(scheduler.errors["content"], RuntimeError)
+    assert "content failed" in str(scheduler.errors["site"])
+
+
+def test_async_run_mixes_coroutines_and_functions():
+    async def brief(topic):
+        await asyncio.sleep(0.01)
+        return topic.upper()
+
+    scheduler = StageScheduler([
+        Stage("brief", brief, ["topic"]),
+        Stage("logo", fail, optional=True),
+        Stage("site", lambda brief, logo: (brief, logo), ["brief", "logo"]),
+    ])
+    results = asyncio.run(scheduler.async_run(topic="bread"))
+    assert results["site"] == ("BREAD", None)
+
+
+def test_critical_path_follows_the_slowest_inputs():
+    def wait(seconds):
+        return lambda **inputs: time.sleep(seconds)
+
+    scheduler = StageScheduler([
+        Stage("brief", wait(0.05)),
+        Stage("content", wait(0.2), ["brief"]),
+        Stage("images", wait(0.05), ["brief"]),
+        Stage("site", wait(0.0), ["content", "images"]),
+    ])
+    start = time.monotonic()
+    scheduler.run()
+    elapsed = time.monotonic() - start
+    # images runs next to content, the run takes the longest chain and not the sum of the stages
+    assert elapsed < 0.29
+    assert [name for name, _ in scheduler.critical_path()] == ["brief", "content", "site"]
+    assert "-> content 0.2s -> site 0.0s" in scheduler.report()
+
+
+def test_streamed_outputs_start_their_dependents_early():
+    finished = []
+
+    def sections():
+        yield "banner", "Banner"
+        time.sleep(0.1)
+        yield "faq", "FAQ"
+
+    def layout(banner):
+        finished.append(("banner_layout", time.monotonic()))
+        return banner.lower()
+
+    scheduler = StageScheduler([
+        Stage("content", sections, outputs=["banner", "faq"]),
+        Stage("banner_layout", layout, ["banner"]),
+        Stage("site", lambda banner_layout, faq: (banner_layout, faq), ["banner_layout", "faq"]),
+    ])
+    results = scheduler.run()
+    assert results["site"] == ("banner", "FAQ")
+    assert results["content"] == {"banner": "Banner", "faq": "FAQ"}
+    # The banner layout was done while the content was still streaming
+    assert scheduler.timings["banner_layout"][1] < scheduler.timings["content"][1] - 0.05
+    assert [name for name, _ in scheduler.critical_path()] == ["faq", "site"]
+
+
+def test_async_streamed_outputs():
+    async def sections():
+        yield "banner", "Banner"
+        await asyncio.sleep(0.05)
+        yield "faq", "FAQ"
+
+    def plain_sections():
+        yield "about", "About"
+
+    scheduler = StageScheduler([
+        Stage("content", sections, outputs=["banner", "faq"]),
+        Stage("more", plain_sections, outputs=["about"]),
+        Stage("site", lambda banner, faq, about: [banner, faq, about], ["banner", "faq", "about"]),
+    ])
+    results = asyncio.run(scheduler.async_run())
+    assert results["site"] == ["Banner", "FAQ", "About"]
+    assert scheduler.timings["banner"][1] < scheduler.timings["faq"][1]
+
+
+def test_missing_output_fails_its_dependents():
+    def sections():
+        yield "banner", "Banner"
+
+    scheduler = StageScheduler([
+        Stage("content", sections, outputs=["banner", "faq"]),
+        Stage("banner_layout", lambda banner: banner, ["banner"]),
+        Stage("faq_layout", lambda faq: faq, ["faq"]),
+    ])
+    results = scheduler.run()
+    assert results["banner_layout"] == "Banner"
+    assert "did not produce faq" in str(scheduler.errors["faq"])
+    assert "faq_layout" in scheduler.errors
+
+
+def test_output_names_must_be_unique():
+    with pytest.raises(ValueError, match="unique"):
+        StageScheduler([Stage("content", dict, outputs=["banner"]), Stage("banner", dict)])
+    with pytest.raises(ValueError, match="cycle"):
+        StageScheduler([Stage("content", dict, ["layout"], outputs=["banner"]), Stage("layout", dict, ["banner"])])
@@ -0,0 +1,80 @@
+import json
+from seo_package.content_main import SectionStreamParser
+
+CONTENT = {
+    "banner": {"h1": "Fresh {bread} daily", "h2": "Baked at 5am"},
+    "about": {"h2": "About \"us\"", "p": "A [family] bakery, since 1990 \\ proudly"},
+    "faq": [{"question": "Open on Sundays?", "answer": "Yes, {9}-5"}],
+    "rating": 4.5,
+}
+
+
+def parse(chunks):
+    parser = SectionStreamParser()
+    sections = []
+    for chunk in chunks:
+        sections.extend(parser.feed(chunk))
+    return parser, sections
+
+
+def test_sections_are_emitted_whatever_the_chunk_boundaries():
+    text = "Here is the content: " + json.dumps(CONTENT, indent=2)
+    expected = list(CONTENT.items())
+    for size in (1, 2, 3, 7, len(text)):
+        parser, sections = parse(text[i:i + size] for i in range(0, len(text), size))
+        assert sections == expected
+        assert parser.done
+
+
+def test_each_section_is_emitted_as_soon_as_it_is_complete():
+    parser = SectionStreamParser()
+    assert parser.feed('{"banner": {"h1": "Title"') == []
+    assert parser.feed('}, "about": ') == [("banner", {"h1": "Title"})]
+    assert parser.feed('"text"') == [("about", "text")]
+
+
+def test_escaped_quotes_and_braces_inside_strings():
+    text = r'{"about": {"p": "She said \"{not a brace}\" and left \\"}, "blog": "[x] \"}\""}'
+    parser, sections = parse(text)
+    assert sections == [("about", {"p": 'She said "{not a brace}" and left \\'}), ("blog", '[x] "}"')]
+    assert parser.done
+
+
+def test_trailing_commas_are_tolerated():
+    parser, sections = parse('{"faq": [{"question": "Q", "answer": "A",},], "rating": 5,}')
+    assert sections == [("faq", [{"question": "Q", "answer": "A"}]), ("rating", 5)]
+    assert parser.done
+
+
+def test_truncated_stream_keeps_the_finished_sections():
+    text = json.dumps(CONTENT)
+    cut = text.index('"faq"') + 20
+    parser, sections = parse([text[:cut]])
+    assert sections == [("banner", CONTENT["banner"]), ("about", CONTENT["about"])]
+    assert not parser.done
+    assert parser.text == text[:cut]
+
+
+def test_streamed_usage_is_recorded(monkeypatch):
+    import seo_package.content_main as content_main
+    chunks = [{"choices": [{"delta": {"content": text}}]} for text in ("a" * 40, "b" * 40)]
+    recorded = []
+
+    class Chunk(dict):
+        @property
+        def choices(self):
+            return self["choices"]
+
+    monkeypatch.setattr(content_main, "_open_chat_stream", lambda request: iter(Chunk(chunk) for chunk in chunks))
+    monkeypatch.setattr(content_main.chat_rate_limiter, "acquire", lambda tokens: None)
+    monkeypatch.setattr(content_main.chat_rate_limiter, "record_usage", lambda estimated, actual: recorded.append((estimated, actual)))
+    stream = content_main.stream_chat_with_gpt3("prompt", model="gpt-3.5-turbo")
+    assert next(stream) == "a" * 40
+    # A reader stopping early still corrects the budget with what it received
+    stream.close()
+    assert len(recorded) == 1 and recorded[0][1] < recorded[0][0]
+    recorded.clear()
+    assert "".join(content_main.stream_chat_with_gpt3("prompt", model="gpt-3.5-turbo")) == "a" * 40 + "b" * 40
+    estimated, actual = recorded[0]
+    messages = content_main.chat_request("prompt", 1.0, 1.0, 0.0, 0.0, "gpt-3.5-turbo")["messages"]
+    assert actual == content_main.estimate_usage(messages, "a" * 40 + "b" * 40)
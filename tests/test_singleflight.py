@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+import pytest
+from seo_package.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return value * 2
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", fetch, 21)))
+    leader.start()
+    assert started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("key", fetch, 21))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    # Give the followers time to join the call in flight
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == [42] * 4
+    assert calls == [21]
+    # The key is free again once the call is over
+    assert flight.do("key", fetch, 1) == 2
+
+
+def test_exception_is_raised_in_every_caller():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("upstream")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("key", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    assert started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+
+def test_async_calls_are_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def main():
+        results = await asyncio.gather(*(flight.async_do("key", fetch, 21) for _ in range(4)),
+                                       flight.async_do("other", fetch, 1))
+        return results, flight._async_calls
+
+    results, pending = asyncio.run(main())
+    assert results == [42, 42, 42, 42, 2]
+    assert calls == [21, 1]
+    assert pending == {}
+
+
+def test_cancelled_waiter_does_not_cancel_the_others():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def fetch():
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "reply"
+
+    async def main():
+        first = asyncio.ensure_future(flight.async_do("key", fetch))
+        second = asyncio.ensure_future(flight.async_do("key", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "reply"
+    assert cancelled == []
+
+
+def test_shared_task_is_cancelled_when_the_last_waiter_leaves():
+    flight = SingleFlight()
+    cancelled = []
+    calls = []
+
+    async def fetch():
+        calls.append(True)
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "stale"
+
+    async def fresh():
+        return "fresh"
+
+    async def main():
+        waiters = [asyncio.ensure_future(flight.async_do("key", fetch)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        # A new caller starts its own call instead of joining the cancelled one
+        result = await flight.async_do("key", fresh)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == "fresh"
+    assert calls == [True]
+    assert cancelled == [True]
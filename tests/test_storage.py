@@ -0,0 +1,111 @@
+import time
+import pytest
+from seo_package.storage import AssetManifest, AssetStore
+
+
+@pytest.fixture
+def assets(tmp_path):
+    def make(name):
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        return path
+    return make
+
+
+def test_asset_is_uploaded_once(assets, backend):
+    store = AssetStore(backend)
+    keys = [store.publish(assets("a.jpg")) for _ in range(3)]
+    assert store.wait(keys) == []
+    assert store.publish(assets("a.jpg")) == "a.jpg"
+    assert store.wait(["a.jpg"]) == []
+    assert backend.puts == ["a.jpg"]
+
+
+def test_wait_ignores_the_uploads_of_other_sites(assets, backend):
+    backend.fail.add("other.jpg")
+    backend.block.add("slow.jpg")
+    store = AssetStore(backend)
+    site = [store.publish(assets("site.jpg"))]
+    store.publish(assets("other.jpg"))
+    store.publish(assets("slow.jpg"))
+    assert store.wait(site, timeout=1) == []
+    assert store.wait(["other.jpg"]) == ["other.jpg"]
+    backend.release.set()
+
+
+def test_failed_upload_is_queued_again(assets, backend):
+    backend.fail.add("a.jpg")
+    store = AssetStore(backend)
+    store.publish(assets("a.jpg"))
+    assert store.wait(["a.jpg"]) == ["a.jpg"]
+    # Reported to every site waiting on it until it is published again
+    assert store.wait(["a.jpg"]) == ["a.jpg"]
+    backend.fail.clear()
+    store.publish(assets("a.jpg"))
+    assert store.wait(["a.jpg"]) == []
+    assert backend.puts == ["a.jpg", "a.jpg"]
+
+
+def test_completed_uploads_are_not_kept(assets, backend, monkeypatch):
+    monkeypatch.setattr(AssetStore, "max_published", 5)
+    store = AssetStore(backend)
+    keys = [store.publish(assets(f"{index}.jpg")) for index in range(20)]
+    assert store.wait(keys) == []
+    # The done callbacks run just after the waiters are woken
+    deadline = time.monotonic() + 5
+    while store._uploads and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(store._uploads) == 0
+    assert len(store._published) == 5
+
+
+def test_shared_asset_is_uploaded_once_and_counted_per_site(assets, backend, tmp_path):
+    store = AssetStore(backend, AssetManifest(str(tmp_path / "manifest.json")))
+    shared, first, second = assets("shared.jpg"), assets("first.jpg"), assets("second.jpg")
+    site_a = [store.publish(shared), store.publish(first)]
+    site_b = [store.publish(shared), store.publish(second)]
+    assert store.wait(site_a + site_b) == []
+    store.register("a", site_a)
+    store.register("b", site_b)
+    assert sorted(backend.puts) == ["first.jpg", "second.jpg", "shared.jpg"]
+    assert store.manifest.refs("shared.jpg") == 2
+    # Deleting one site keeps what the other one uses
+    store.release("a")
+    assert store.collect() == ["first.jpg"]
+    assert sorted(backend.objects) == ["second.jpg", "shared.jpg"]
+    store.release("b")
+    assert sorted(store.collect()) == ["second.jpg", "shared.jpg"]
+    assert backend.objects == {}
+    assert store.manifest.unreferenced() == {}
+
+
+def test_regenerated_site_releases_its_old_assets(assets, backend, tmp_path):
+    path = str(tmp_path / "manifest.json")
+    store = AssetStore(backend, AssetManifest(path))
+    old = [store.publish(assets("logo.jpg")), store.publish(assets("old.jpg"))]
+    assert store.wait(old) == []
+    store.register("site", old)
+    new = [store.publish(assets("logo.jpg")), store.publish(assets("new.jpg"))]
+    assert store.wait(new) == []
+    store.register("site", new)
+    # The manifest is saved, another process sees the same references
+    manifest = AssetManifest(path)
+    assert manifest.refs("logo.jpg") == 1 and manifest.refs("old.jpg") == 0
+    assert list(manifest.unreferenced()) == ["old.jpg"]
+    assert store.collect() == ["old.jpg"]
+    assert sorted(backend.objects) == ["logo.jpg", "new.jpg"]
+
+
+def test_asset_published_again_after_its_release_is_kept(assets, backend, tmp_path):
+    store = AssetStore(backend, AssetManifest(str(tmp_path / "manifest.json")))
+    keys = [store.publish(assets("a.jpg"))]
+    assert store.wait(keys) == []
+    store.register("site", keys)
+    store.release("site")
+    time.sleep(0.01)
+    # A site being generated uses it again but is not registered yet
+    store.publish(assets("a.jpg"))
+    assert store.collect() == []
+    assert "a.jpg" in backend.objects
+    store.register("other", keys)
+    assert store.manifest.unreferenced() == {}
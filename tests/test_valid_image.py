@@ -0,0 +1,90 @@
+import asyncio
+import io
+import numpy as np
+import pytest
+from PIL import Image
+from seo_package import image_main, retry_policy
+from seo_package.retry_policy import CircuitBreaker
+
+
+def jpeg(pixels: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.astype("uint8")).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+BLACK = jpeg(np.zeros((64, 64, 3)))
+VALID = jpeg(np.random.default_rng(0).integers(0, 255, (64, 64, 3)))
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(image_main, "sleep", delays.append)
+    return delays
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker("huggingface", failure_threshold=1, reset_timeout=30)
+    monkeypatch.setitem(retry_policy._breakers, "huggingface", breaker)
+    return breaker
+
+
+def test_rejected_image_is_rendered_again(monkeypatch, sleeps):
+    monkeypatch.setattr(image_main, "image_model", "dalle")
+    renders = [BLACK, VALID]
+    calls = []
+
+    def method(prompt):
+        calls.append(prompt)
+        return renders.pop(0)
+
+    assert image_main.valid_image(method, "a fox", BLACK) == VALID
+    assert calls == ["a fox", "a fox"]
+    assert len(sleeps) == 2
+
+
+def test_gives_up_after_the_render_attempts(monkeypatch, sleeps):
+    monkeypatch.setattr(image_main, "image_model", "dalle")
+    monkeypatch.setattr(image_main, "image_render_attempts", 3)
+    assert image_main.valid_image(lambda prompt: BLACK, "a fox", BLACK) is None
+    assert len(sleeps) == 2
+
+
+def test_huggingface_rerender_bypasses_the_cache(monkeypatch, sleeps, breaker):
+    monkeypatch.setattr(image_main, "image_model", "stabilityai")
+    queries = []
+
+    def query(parameters):
+        queries.append(parameters)
+        return BLACK if len(queries) == 1 else VALID
+
+    monkeypatch.setattr(image_main, "query", query)
+    assert image_main.valid_image(image_main.stabilityai_generate, "a fox", BLACK) == VALID
+    assert [parameters["options"] for parameters in queries] == [{"use_cache": False}] * 2
+    # Every render samples with a new seed
+    assert queries[0]["parameters"]["seed"] != queries[1]["parameters"]["seed"]
+
+
+def test_open_circuit_is_waited_for(monkeypatch, sleeps, breaker):
+    monkeypatch.setattr(image_main, "image_model", "stabilityai")
+    monkeypatch.setattr(image_main, "image_render_attempts", 1)
+    breaker.record(False)
+    assert breaker.state == "open"
+    monkeypatch.setattr(image_main, "query", lambda parameters: VALID)
+    # The empty response of the open circuit does not use up the only attempt
+    assert image_main.valid_image(image_main.stabilityai_generate, "a fox", b"") == VALID
+    assert sleeps == [pytest.approx(30, abs=1)]
+
+
+def test_async_rejected_image_is_rendered_again(monkeypatch):
+    monkeypatch.setattr(image_main, "image_model", "dalle")
+    monkeypatch.setattr(image_main, "render_backoff", lambda attempt, retry_after=None: 0)
+    renders = [BLACK, VALID]
+
+    async def method(prompt):
+        return renders.pop(0)
+
+    assert asyncio.run(image_main.async_valid_image(method, "a fox", b"")) == VALID
+    assert renders == []
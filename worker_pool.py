@@ -0,0 +1,187 @@
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import threading
+from typing import Any, Callable, Dict, List
+
+#==================================================================================================
+# Load Parameters
+#==================================================================================================
+
+# Threads of each lane, shared by every site generated in the process
+stage_workers = int(os.getenv("STAGE_WORKERS", "32"))
+llm_workers = int(os.getenv("LLM_WORKERS", "32"))
+image_workers = int(os.getenv("IMAGE_WORKERS", "16"))
+io_workers = int(os.getenv("IO_WORKERS", "16"))
+upload_workers = int(os.getenv("UPLOAD_WORKERS", "8"))
+cpu_workers = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 4)))
+# Processes for the CPU work the GIL would serialise, such as image encoding
+process_workers = int(os.getenv("PROCESS_WORKERS", str(os.cpu_count() or 4)))
+# Processes rendering with the local Stable Diffusion pipeline (IMAGE_MODEL=local), each loads its own copy of the model
+diffusion_workers = int(os.getenv("DIFFUSION_WORKERS", "1"))
+
+#==================================================================================================
+# Worker Lanes
+#==================================================================================================
+
+# "stage" runs the steps that wait on other lanes, the other lanes run the calls themselves. "upload" is separate
+# from "io" so that an upload queued while saving an image never runs inline in the saving thread.
+# A task only waits on lanes after its own in this order, so a full lane can never wait on itself.
+LANES: Dict[str, int] = {
+    "stage": stage_workers,
+    "llm": llm_workers,
+    "image": image_workers,
+    "io": io_workers,
+    "cpu": cpu_workers,
+    "upload": upload_workers,
+}
+# Process pools, kept apart so that the variant encoding never queues behind a diffusion batch
+PROCESS_POOLS: Dict[str, int] = {
+    "cpu": process_workers,
+    "diffusion": diffusion_workers,
+}
+
+
+class WorkerPool:
+    """
+     Process-wide set of bounded thread pools, one per kind of work, so the number of threads does not grow with
+     the number of sites or the nesting of the stages. A task submitted to the lane it is already running in is
+     run inline instead of waiting for a free worker of its own lane.
+    """
+
+    def __init__(self, lanes: Dict[str, int], processes: Dict[str, int] = PROCESS_POOLS):
+        self.lanes = dict(lanes)
+        self.processes = dict(processes)
+        self._executors: Dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+        self._process_executors: Dict[str, concurrent.futures.ProcessPoolExecutor] = {}
+        self._active = {lane: 0 for lane in lanes}
+        self._queued = {lane: 0 for lane in lanes}
+        self._peak = {lane: 0 for lane in lanes}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def executor(self, lane: str) -> concurrent.futures.ThreadPoolExecutor:
+        """
+         Get the executor of a lane, creating it on first use.
+
+         @param lane - One of the LANES names
+
+         @return The ThreadPoolExecutor of the lane
+        """
+        if lane not in self.lanes:
+            raise ValueError(f"Unknown worker lane: {lane}")
+        with self._lock:
+            if lane not in self._executors:
+                self._executors[lane] = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.lanes[lane]),
+                                                                              thread_name_prefix=f"{lane}-worker")
+            return self._executors[lane]
+
+    def process_executor(self, pool: str = "cpu") -> concurrent.futures.ProcessPoolExecutor:
+        """
+         Get a process pool, creating it on first use. The processes are spawned rather than forked so they do
+         not inherit the locks held by the threads of the lanes.
+
+         @param pool - One of the PROCESS_POOLS names
+
+         @return The ProcessPoolExecutor
+        """
+        if pool not in self.processes:
+            raise ValueError(f"Unknown process pool: {pool}")
+        with self._lock:
+            if pool not in self._process_executors:
+                self._process_executors[pool] = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=max(1, self.processes[pool]), mp_context=multiprocessing.get_context("spawn"))
+            return self._process_executors[pool]
+
+    def submit_process(self, func: Callable, *args, pool: str = "cpu", **kwargs) -> concurrent.futures.Future:
+        """
+         Run a function in a process pool. func and its arguments must be picklable, i.e. defined at module level.
+
+         @param pool - One of the PROCESS_POOLS names
+
+         @return The future of its result
+        """
+        return self.process_executor(pool).submit(func, *args, **kwargs)
+
+    def _run(self, lane: str, func: Callable, args: tuple, kwargs: dict) -> Any:
+        with self._lock:
+            self._queued[lane] -= 1
+            self._active[lane] += 1
+            self._peak[lane] = max(self._peak[lane], self._active[lane])
+        self._local.lane = lane
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.lane = None
+            with self._lock:
+                self._active[lane] -= 1
+
+    def waits_backwards(self, lane: str) -> bool:
+        """
+         Check whether the current thread runs in a lane after lane, and so must not wait on it.
+
+         @param lane - One of the LANES names
+
+         @return True if waiting on lane would break the order of the lanes
+        """
+        current = getattr(self._local, "lane", None)
+        order = list(self.lanes)
+        return current is not None and order.index(current) > order.index(lane)
+
+    def submit(self, lane: str, func: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        """
+         Run a function in a lane.
+
+         @param lane - One of the LANES names
+         @param func - The function to run with args and kwargs
+
+         @return The future of its result
+        """
+        executor = self.executor(lane)
+        if getattr(self._local, "lane", None) == lane:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        with self._lock:
+            self._queued[lane] += 1
+        return executor.submit(self._run, lane, func, args, kwargs)
+
+    async def run(self, lane: str, func: Callable, *args, **kwargs) -> Any:
+        """
+         Asynchronous version of submit, used instead of asyncio.to_thread to keep the calls in their lane.
+
+         @return The result of the function
+        """
+        executor = self.executor(lane)
+        with self._lock:
+            self._queued[lane] += 1
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(self._run, lane, func, args, kwargs))
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+         Stop every lane and process pool. Those used afterwards are created again.
+        """
+        with self._lock:
+            executors, self._executors = list(self._executors.values()), {}
+            executors += self._process_executors.values()
+            self._process_executors = {}
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
+    def metrics(self) -> List[Dict]:
+        """
+         Current load of every lane.
+
+         @return A list with the name, the size, the running, the queued and the most tasks ever running of each lane
+        """
+        with self._lock:
+            return [{"name": lane, "workers": size, "active": self._active[lane], "queued": self._queued[lane],
+                     "peak": self._peak[lane]} for lane, size in self.lanes.items()]
+
+
+worker_pool = WorkerPool(LANES)